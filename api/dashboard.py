@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections
+
+from main.db_router import get_replica, is_pinned, use_primary, use_replica
+
+from .serializers import ProductSerializer
+
+
+def get_profit_section(store, period):
+    return {
+        "profit": store.get_profit_by_period(period=period),
+        "profit_report": list(store.get_profit_report_by_period(period=period))
+    }
+
+
+def get_orders_section(store, period):
+    return {
+        "orders_record": list(store.get_orders_report_by_period(period=period)),
+        "number_of_orders": store.get_num_of_orders_report_by_period(period=period)
+    }
+
+
+def get_stock_section(store, period):
+    low_products_report = store.get_low_products_stock()
+    best_selling_report = store.get_best_selling_product_by_period(period=period)
+    return {
+        "low_products": ProductSerializer(low_products_report, many=True).data,
+        "best_selling_products": ProductSerializer(best_selling_report).data if best_selling_report else None
+    }
+
+
+SECTIONS = {
+    "profit": get_profit_section,
+    "orders": get_orders_section,
+    "stock": get_stock_section,
+}
+
+
+def get_section_cache_key(store, section, period):
+    return f"dashboard:{store.pk}:{section}:{period}"
+
+
+def _compute_section(store, section, period):
+    value = SECTIONS[section](store, period)
+    cache.set(
+        get_section_cache_key(store, section, period),
+        value,
+        settings.DASHBOARD_CACHE_TTLS[section]
+    )
+    return value
+
+
+def _compute_section_in_thread(store, section, period, pinned, replica):
+    try:
+        if pinned:
+            # The caller wrote, its sections must read from the primary too
+            with use_primary():
+                return _compute_section(store, section, period)
+        if replica:
+            # The replica of the caller, so the sections agree
+            with use_replica(replica):
+                return _compute_section(store, section, period)
+        return _compute_section(store, section, period)
+    finally:
+        # Connections are per thread, don't leave this one behind
+        connections.close_all()
+
+
+def get_store_dashboard(store, period):
+    """
+    Build every dashboard section for the store, reading each one from the
+    cache first. Missing sections are computed concurrently unless the caller
+    is inside a transaction, whose rows other connections can't see.
+    """
+    keys = { section: get_section_cache_key(store, section, period) for section in SECTIONS }
+    cached = cache.get_many(list(keys.values()))
+    dashboard = { section: cached[key] for section, key in keys.items() if key in cached }
+    missing = [ section for section in SECTIONS if section not in dashboard ]
+
+    if len(missing) > 1 and not connection.in_atomic_block:
+        with ThreadPoolExecutor(max_workers=settings.DASHBOARD_MAX_WORKERS) as executor:
+            futures = {
+                section: executor.submit(_compute_section_in_thread, store, section, period, is_pinned(), get_replica())
+                for section in missing
+            }
+            for section, future in futures.items():
+                dashboard[section] = future.result()
+    else:
+        for section in missing:
+            dashboard[section] = _compute_section(store, section, period)
+
+    return dashboard
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections, router
+from django.db.models.functions import Greatest
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+from main.generators import is_order_number
+
+_trigram_databases = {}
+
+
+def has_trigram(using):
+    """Whether pg_trgm is installed in the database"""
+    if using not in _trigram_databases:
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_databases[using] = bool(cursor.fetchone())
+    return _trigram_databases[using]
+
+
+class TrigramSearchFilter(filters.SearchFilter):
+    """
+    ``SearchFilter`` matching the same way, ``icontains`` on each term, which
+    the trigram indexes of the search fields serve instead of a scan. With
+    pg_trgm results are ranked by their similarity to the search, unless the
+    client asked for an ordering, so list it after ``OrderingFilter``.
+
+    Only searches with at most ``SEARCH_RANK_MAX_MATCHES`` matches are ranked.
+    An unselective term is scanned anyway, and ranking all its matches before
+    the first page would make it slower than the unranked search.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        queryset = super().filter_queryset(request, queryset, view)
+
+        if not search_fields or not search_terms or not has_trigram(router.db_for_read(queryset.model)):
+            return queryset
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            return queryset
+        # Stops counting past the limit
+        if queryset.order_by()[:settings.SEARCH_RANK_MAX_MATCHES + 1].count() > settings.SEARCH_RANK_MAX_MATCHES:
+            return queryset
+
+        search = ' '.join(search_terms)
+        similarities = [
+            TrigramSimilarity(search_field.lstrip(''.join(self.lookup_prefixes)), search)
+            for search_field in search_fields
+        ]
+        queryset = queryset.annotate(
+            search_rank=Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+        )
+        return queryset.order_by('-search_rank', *(queryset.query.order_by or queryset.model._meta.ordering))
+
+
+class OrderSearchFilter(TrigramSearchFilter):
+    """
+    Search of the orders on their ``search_document``, the number and customer
+    name in one indexed column instead of a join with the customers. A search
+    for an order number is an exact lookup on the number index.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if len(search_terms) == 1 and is_order_number(search_terms[0]):
+            return queryset.filter( number=search_terms[0].upper() )
+        return super().filter_queryset(request, queryset, view)
@@ -6,6 +6,7 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from rest_framework import serializers
 
+from main.images import get_variant_urls
 from main.models import (
     Store,
     Category,
@@ -205,12 +206,16 @@ class StoreSerializer( serializers.ModelSerializer ):
         queryset=Admin.objects.all()
     )
     compressed_logo_url = serializers.SerializerMethodField( read_only=True )
+    logo_variants = serializers.SerializerMethodField( read_only=True )
     my_subscription = StoreSubscriptionSerializer( read_only=True )
 
 
     def get_compressed_logo_url(self, obj):
         return f"https://{settings.AWS_S3_COMPRESSED_IMAGES_DOMAIN}/{obj.logo_url.name}" if obj.logo_url else ""
 
+    def get_logo_variants(self, obj):
+        return get_variant_urls( obj.logo_variants )
+
     class Meta:
         model = Store
         fields = "__all__"
@@ -233,12 +238,16 @@ class SimpleStoreSerializer( serializers.ModelSerializer ):
     categories = CategorySerializer(many=True, read_only=True)
 
     compressed_logo_url = serializers.SerializerMethodField( read_only=True )
+    logo_variants = serializers.SerializerMethodField( read_only=True )
 
 
     def get_compressed_logo_url(self, obj):
         print( obj.logo_url )
         return f"https://{settings.AWS_S3_COMPRESSED_IMAGES_DOMAIN}/{obj.logo_url.name}" if obj.logo_url else ""
 
+    def get_logo_variants(self, obj):
+        return get_variant_urls( obj.logo_variants )
+
     class Meta:
         model = Store
         fields = "__all__"
@@ -344,6 +353,7 @@ class ProductSerializer(serializers.ModelSerializer):
     total_stock = serializers.SerializerMethodField()
     num_of_orders =serializers.SerializerMethodField()
     compressed_product_picture_url = serializers.SerializerMethodField( read_only=True )
+    product_picture_variants = serializers.SerializerMethodField( read_only=True )
     is_active = serializers.BooleanField( default=True )
 
     def get_total_stock(self, obj):
@@ -355,6 +365,9 @@ class ProductSerializer(serializers.ModelSerializer):
     def get_compressed_product_picture_url(self, obj):
         return f"https://{settings.AWS_S3_COMPRESSED_IMAGES_DOMAIN}/{obj.product_picture_url.name}" if obj.product_picture_url else ""
 
+    def get_product_picture_variants(self, obj):
+        return get_variant_urls( obj.product_picture_variants )
+
     class Meta:
         model = Product
         fields = ("__all__")
@@ -365,6 +378,7 @@ class SimpleProductSerializer(serializers.ModelSerializer):
     total_stock = serializers.SerializerMethodField()
     num_of_orders =serializers.SerializerMethodField()
     compressed_product_picture_url = serializers.SerializerMethodField( read_only=True )
+    product_picture_variants = serializers.SerializerMethodField( read_only=True )
 
     def get_total_stock(self, obj):
         return obj.get_total_stock()
@@ -375,6 +389,9 @@ class SimpleProductSerializer(serializers.ModelSerializer):
     def get_compressed_product_picture_url(self, obj):
         return f"https://{settings.AWS_S3_COMPRESSED_IMAGES_DOMAIN}/{obj.product_picture_url.name}" if obj.product_picture_url else ""
 
+    def get_product_picture_variants(self, obj):
+        return get_variant_urls( obj.product_picture_variants )
+
     class Meta:
         model = Product
         fields = ("__all__")
@@ -404,6 +421,7 @@ class StoreProductSerializer(serializers.ModelSerializer):
     total_stock = serializers.SerializerMethodField()
     num_of_orders =serializers.SerializerMethodField()
     compressed_product_picture_url = serializers.SerializerMethodField( read_only=True )
+    product_picture_variants = serializers.SerializerMethodField( read_only=True )
 
     def get_total_stock(self, obj):
         return obj.get_total_stock()
@@ -413,6 +431,9 @@ class StoreProductSerializer(serializers.ModelSerializer):
 
     def get_compressed_product_picture_url(self, obj):
         return f"https://{settings.AWS_S3_COMPRESSED_IMAGES_DOMAIN}/{obj.product_picture_url.name}" if obj.product_picture_url else ""
+
+    def get_product_picture_variants(self, obj):
+        return get_variant_urls( obj.product_picture_variants )
     class Meta:
         model = Product
         fields = ("__all__")
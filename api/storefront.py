@@ -0,0 +1,166 @@
+"""
+The anonymous storefront, served from the cache.
+
+``StorefrontCacheMiddleware`` keeps the anonymous GET responses of
+``STOREFRONT_URL_NAMES`` for ``STOREFRONT_CACHE_TTL`` seconds, by path, query
+string and the ``VARY_HEADERS``: Accept, as the browsable API renders HTML,
+and Origin for CORS. A response varying on another header, like the HTML
+pages on Cookie, isn't cached.
+
+``get_application`` builds the async storefront server on the same cache. A
+cached response is sent without running Django. Other requests are handled
+by Django in a pool of ``STOREFRONT_MAX_WORKERS`` threads, so each worker
+waits on many clients at once while only that many threads query the
+database, each with its own connection.
+"""
+import asyncio
+import hashlib
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from aiohttp import web
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import cc_delim_re
+from django.urls import Resolver404, resolve
+
+STOREFRONT_URL_NAMES = ( 'store_for_customers', 'store_products_for_customers' )
+
+# Set by the WSGI server or the client, not part of the cached response
+SKIPPED_HEADERS = ( 'content-length', 'date', 'server', 'transfer-encoding', 'connection' )
+
+# Request headers the cached responses may vary on, part of their key
+VARY_HEADERS = ( 'accept', 'origin' )
+
+
+def is_storefront(path):
+    try:
+        return resolve(path).url_name in STOREFRONT_URL_NAMES
+    except Resolver404:
+        return False
+
+
+def get_cache_key(environ):
+    """Key of the cached response to the request of the WSGI ``environ``, None when it isn't cached"""
+    # A token, even an invalid one, is checked by Django
+    if environ['REQUEST_METHOD'] != 'GET' or environ.get('HTTP_AUTHORIZATION') or not is_storefront(environ['PATH_INFO']):
+        return None
+    request = '\n'.join([
+        environ['PATH_INFO'],
+        environ.get('QUERY_STRING', ''),
+        *( environ.get(f"HTTP_{header.upper()}", '') for header in VARY_HEADERS )
+    ])
+    return f"storefront:{hashlib.sha256(request.encode()).hexdigest()}"
+
+
+def is_keyed(response):
+    """Whether the headers the response varies on are all part of its cache key"""
+    vary = cc_delim_re.split(response.get('Vary', ''))
+    return all( header.lower() in VARY_HEADERS for header in vary if header )
+
+
+class StorefrontCacheMiddleware(object):
+    """Before the middlewares adding headers, so the cached responses have them"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        key = get_cache_key(request.META)
+        if not key:
+            return self.get_response(request)
+
+        cached = cache.get(key)
+        if cached:
+            status, headers, body = cached
+            response = HttpResponse(body, status=status)
+            for header, value in headers:
+                response[header] = value
+            return response
+
+        response = self.get_response(request)
+        if response.status_code == 200 and not response.streaming and not response.cookies and is_keyed(response):
+            headers = [ (header, value) for header, value in response.items() if header.lower() not in SKIPPED_HEADERS ]
+            cache.set(key, (response.status_code, headers, response.content), settings.STOREFRONT_CACHE_TTL)
+        return response
+
+
+def get_environ(request, body):
+    """WSGI environ of the aiohttp ``request``"""
+    host, _, port = request.host.partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(request.raw_path.split('?', 1)[0], 'latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or ('443' if request.secure else '80'),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for header, value in request.headers.items():
+        name = header.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = value
+    return environ
+
+
+def get_web_response(status, headers, body):
+    headers = [ (header, value) for header, value in headers if header.lower() not in SKIPPED_HEADERS ]
+    return web.Response(status=status, headers=headers, body=body)
+
+
+def get_application(wsgi_application):
+    """aiohttp application serving the storefront urls, handled by ``wsgi_application`` when not cached"""
+
+    def render(environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        result = wsgi_application(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            # Django's sends request_finished, which closes the old connections
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], body
+
+    async def serve(request):
+        loop = asyncio.get_event_loop()
+        environ = get_environ(request, await request.read())
+        key = get_cache_key(environ)
+        if key:
+            # The cache client blocks, but not for long
+            cached = await loop.run_in_executor(None, cache.get, key)
+            if cached:
+                return get_web_response(*cached)
+        elif not is_storefront(environ['PATH_INFO']):
+            raise web.HTTPNotFound()
+        return get_web_response(*await loop.run_in_executor(request.app['django'], render, environ))
+
+    async def start(application):
+        application['django'] = ThreadPoolExecutor(settings.STOREFRONT_MAX_WORKERS)
+
+    async def stop(application):
+        application['django'].shutdown()
+
+    application = web.Application()
+    application.router.add_route('*', '/{path:.*}', serve)
+    application.on_startup.append(start)
+    application.on_cleanup.append(stop)
+    return application
@@ -28,9 +28,11 @@ urlpatterns = [
     path("stores/<uuid:pk>/profit-report/", views.StoreProfitReportEndpoint.as_view(), name="store_profit_report"),
     path("stores/<uuid:pk>/orders-report/", views.StoreOrdersReportEndpoint.as_view(), name="store_orders_report"),
     path("stores/<uuid:pk>/stock-report/", views.StoreProductStocksReportEndpoint.as_view(), name="store_stock_report"),
+    path("stores/<uuid:pk>/dashboard/", views.StoreDashboardEndpoint.as_view(), name="store_dashboard"),
     path("stores/<uuid:pk>/admins/", views.StoreAdminsEndpoint.as_view(), name="store_admins"),
     path("stores/<uuid:pk>/customers/", views.StoreCustomersEndpoint.as_view(), name="store_customers"),
     path("stores/<uuid:pk>/products/", views.StoreProductsEndpoint.as_view(), name="store_products"),
+    path("stores/<uuid:pk>/products/images/", views.StoreProductImagesEndpoint.as_view(), name="store_product_images"),
     path("stores/<uuid:pk>/orders/", views.StoreOrdersEndpoint.as_view(), name="store_orders"),
     path("customers/", views.CustomersEndpoint.as_view(), name="customers"),
     path("customers/<uuid:pk>/", views.CustomerEndpoint.as_view(), name="customer_details"),
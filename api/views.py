@@ -15,8 +15,10 @@ from django_filters.rest_framework import DjangoFilterBackend
 
 from django.http.response import HttpResponseRedirect
 from django.core.exceptions import ValidationError
+from django.core.validators import validate_image_file_extension
 from django.contrib.auth import authenticate, get_user_model
 from django.conf import settings
+from django.db import transaction
 from django.contrib.auth.password_validation import validate_password, get_password_validators
 
 from rest_framework import generics
@@ -31,10 +33,12 @@ from rest_framework.parsers import FileUploadParser, JSONParser, MultiPartParser
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.permissions import AllowAny
 
+from main.images import open_image_batch, stage_images
 from main.tasks import (
     send_email_async,
     send_sms_async
 )
+from .filters import OrderSearchFilter, TrigramSearchFilter
 from .serializers import (
     UserSerializer,
     AuthTokenSerializer,
@@ -74,11 +78,13 @@ from main.models import (
     Payment,
     Category,
     Subscriber,
-    SubscriptionPlan
+    SubscriptionPlan,
+    OutboxMessage
 )
 from .permissions import (
     ProductsLimitPermission
 )
+from .dashboard import get_store_dashboard
 
 User = get_user_model()
 
@@ -98,11 +104,13 @@ class UsersEndpoint(generics.ListCreateAPIView):
             headers=headers,
         )
 
+    @transaction.atomic
     def perform_create(self, serializer):
         user = serializer.save()
         verification_code = VerificationCode.objects.create(email=user.email)
         confirm_email_url = f"users/verify/?code={verification_code.code}"
-        send_email_async.delay(
+        OutboxMessage.objects.enqueue(
+            send_email_async,
             template_id=settings.TEMPLATE_EMAIL_WITH_URL_ID,
             tos=[user.email],
             subject='Souko - Account Confirmation Email',
@@ -173,7 +181,8 @@ class ResentVerificationCodeEndpoint(generics.GenericAPIView):
             user = get_object_or_404(User, email=verification_code.email)
 
             confirm_email_url = f"users/verify/?code={verification_code.code}"
-            send_email_async.delay(
+            OutboxMessage.objects.enqueue(
+                send_email_async,
                 template_id=settings.TEMPLATE_EMAIL_WITH_URL_ID,
                 tos=[user.email],
                 subject='Souko - Account Confirmation Email',
@@ -334,12 +343,25 @@ class StoreProductStocksReportEndpoint(generics.GenericAPIView):
             return Response( {"message": str(e)}, status=status.HTTP_400_BAD_REQUEST )
 
 
+class StoreDashboardEndpoint(generics.GenericAPIView):
+    permission_classes = ( IsAuthenticated, )
+    schema = None
+
+    def get(self, request, pk, *args, **kwargs):
+        try:
+            store = get_object_or_404( Store, pk=pk )
+            period = int(request.query_params.get("period", 3))
+            return Response( get_store_dashboard( store, period ) )
+        except Exception as e:
+            return Response( {"message": str(e)}, status=status.HTTP_400_BAD_REQUEST )
+
+
 class StoreCustomersEndpoint(generics.ListAPIView):
     serializer_class = StoreCustomerSerializer
     permission_classes = ( IsAuthenticated, )
     filter_backends = [
-        filters.SearchFilter,
         filters.OrderingFilter,
+        TrigramSearchFilter,
     ]
     ordering = ["-created_at"]
     ordering_fields = [ "created_at", ]
@@ -356,8 +378,8 @@ class StoreProductsEndpoint(generics.ListAPIView):
     serializer_class = StoreProductSerializer
     permission_classes = ( IsAuthenticated, )
     filter_backends = [
-        filters.SearchFilter,
         filters.OrderingFilter,
+        TrigramSearchFilter,
     ]
     ordering = ["-created_at"]
     ordering_fields = [ "created_at", ]
@@ -370,12 +392,52 @@ class StoreProductsEndpoint(generics.ListAPIView):
         return store.products.filter( is_active=True )
 
 
+class StoreProductImagesEndpoint(generics.GenericAPIView):
+    """
+    Set the pictures of many products of the store at once, sent as files
+    named after the product ids in a zip under ``archive``, or as files under
+    the product ids. Their variants are made in the background.
+    """
+    permission_classes = ( IsAuthenticated, )
+    parser_classes = ( MultiPartParser, )
+    schema = None
+
+    def post(self, request, pk, *args, **kwargs):
+        try:
+            store = get_object_or_404( Store, pk=pk )
+            with open_image_batch( request.FILES ) as images:
+                if not images:
+                    raise ValidationError( "No image was sent" )
+                if len( images ) > settings.IMAGE_BULK_UPLOAD_MAX_FILES:
+                    raise ValidationError( f"At most {settings.IMAGE_BULK_UPLOAD_MAX_FILES} images can be sent at once" )
+                for image in images.values():
+                    validate_image_file_extension( image )
+
+                products = { str( product.pk ): product for product in store.products.filter( pk__in=list( images ) ) }
+                unknown = sorted( set( images ) - set( products ) )
+                if unknown:
+                    raise ValidationError( f"No product {', '.join( unknown )} in this store" )
+                stage_images( 'product_picture_url', [ ( products[key], image ) for key, image in images.items() ] )
+
+            with transaction.atomic():
+                for product in products.values():
+                    product.save( update_fields=[ 'product_picture_url', 'product_picture_variants', 'updated_at' ] )
+            return Response({
+                "products": [
+                    { "id": key, "product_picture_url": product.product_picture_url.url }
+                    for key, product in products.items()
+                ]
+            })
+        except Exception as e:
+            return Response( {"message": e.messages[0] if isinstance( e, ValidationError ) else str(e)}, status=status.HTTP_400_BAD_REQUEST )
+
+
 class StoreProductsForCustomersEndpoint(generics.ListAPIView):
     serializer_class = SimpleProductSerializer
     permission_classes = ( AllowAny, )
     filter_backends = [
-        filters.SearchFilter,
         filters.OrderingFilter,
+        TrigramSearchFilter,
     ]
     ordering = ["-created_at"]
     ordering_fields = [ "created_at", ]
@@ -392,16 +454,14 @@ class StoreOrdersEndpoint(generics.ListAPIView):
     serializer_class = StoreOrderSerializer
     permission_classes = ( IsAuthenticated, )
     filter_backends = [
-        filters.SearchFilter,
         filters.OrderingFilter,
+        OrderSearchFilter,
         DjangoFilterBackend,
     ]
     ordering_fields = ["created_at", "payment_status"]
     ordering = ["-created_at"]
     search_fields = [
-        "customer__first_name",
-        "customer__last_name",
-        "number"
+        "search_document"
     ]
     filterset_fields = ["payment_status", "confirmed"]
 
@@ -451,11 +511,13 @@ class CustomersPlaceOrderEndpoint( generics.CreateAPIView ):
             headers=headers,
         )
 
+    @transaction.atomic
     def perform_create(self, serializer):
         order = serializer.save( confirmed=self.customer_is_verified )
         if not self.customer_is_verified:
             confirmation_code = OrderConfirmationCode.objects.create(order=order)
-            send_email_async.delay(
+            OutboxMessage.objects.enqueue(
+                send_email_async,
                 template_id=settings.TEMPLATE_EMAIL_WITH_MESSAGE_ID,
                 tos=[order.customer.email],
                 subject='Souko - Order Confirmation Email',
@@ -467,7 +529,8 @@ class CustomersPlaceOrderEndpoint( generics.CreateAPIView ):
                 index=0
             )
         else:
-            send_email_async.delay(
+            OutboxMessage.objects.enqueue(
+                send_email_async,
                 template_id=settings.TEMPLATE_EMAIL_WITH_MESSAGE_ID,
                 tos=[order.store.admins.all().first().user.email],
                 subject='Souko - Order Alert',
@@ -489,7 +552,8 @@ class ResentOrderConfirmationCodeEndpoint( generics.GenericAPIView ):
             order = Order.objects.get( id=data['order_id'] )
 
             confirmation_code = OrderConfirmationCode.objects.get(order=order)
-            send_email_async.delay(
+            OutboxMessage.objects.enqueue(
+                send_email_async,
                 template_id=settings.TEMPLATE_EMAIL_WITH_MESSAGE_ID,
                 tos=[order.customer.email],
                 subject='Souko - Order Confirmation Email',
@@ -527,7 +591,8 @@ class CustomersConfirmOrderEndpoint(generics.GenericAPIView):
                 order.confirmed = True
                 order.save(update_fields=["confirmed"])
             confirmation_code.delete()
-            send_email_async.delay(
+            OutboxMessage.objects.enqueue(
+                send_email_async,
                 template_id=settings.TEMPLATE_EMAIL_WITH_MESSAGE_ID,
                 tos=[order.store.admins.all().first().user.email],
                 subject='Souko - Order Alert',
@@ -565,16 +630,14 @@ class CustomerOrdersEndpoint(generics.ListAPIView):
     serializer_class = CustomerOrderSerializer
     permission_classes = ( IsAuthenticated, )
     filter_backends = [
-        filters.SearchFilter,
         filters.OrderingFilter,
+        OrderSearchFilter,
         DjangoFilterBackend,
     ]
     ordering = ["-created_at"]
     ordering_fields = [ "created_at", ]
     search_fields = [
-        "customer__first_name",
-        "customer__last_name",
-        "number"
+        "search_document"
     ]
     filterset_fields = ["payment_status", "confirmed"]
 
@@ -655,8 +718,8 @@ class ProductCustomersEndpoint(generics.ListAPIView):
     serializer_class = ProductCustomerSerializer
     permission_classes = ( IsAuthenticated, )
     filter_backends = [
-        filters.SearchFilter,
-        filters.OrderingFilter
+        filters.OrderingFilter,
+        TrigramSearchFilter
     ]
     ordering = ["-created_at"]
     ordering_fields = [ "created_at", ]
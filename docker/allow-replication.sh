@@ -0,0 +1,3 @@
+#!/bin/sh
+# Let the replica of docker-compose.replica.yml stream the WAL of the primary
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
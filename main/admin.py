@@ -20,7 +20,10 @@ models = [
     Subscriber,
     SubscriptionPlan,
     StoreSubscription,
-    OrderConfirmationCode
+    OrderConfirmationCode,
+    EmailMessage,
+    OutboxMessage,
+    QueryStatsSnapshot
 ]
 
 class UserCreationForm(forms.ModelForm):
@@ -6,3 +6,8 @@ class MainConfig(AppConfig):
 
     def ready(self):
         import main.signals
+        import main.task_registry
+        import main.metrics
+        import main.query_stats
+        import main.db_router
+        import main.db_connections
@@ -0,0 +1,48 @@
+"""
+Postgres backend checking persistent connections before reusing them.
+
+With ``CONN_MAX_AGE`` a connection outlives its request, and Postgres or
+PgBouncer may close it in between, failing the first query of the next
+request. When ``CONN_HEALTH_CHECKS`` is set, a connection is checked the way
+Django 4.1 does: once per request or task, before its first query, and
+replaced if the check fails.
+"""
+from django.db.backends.postgresql import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+
+    def connect(self):
+        # A new connection needs no check
+        self.health_check_done = True
+        super().connect()
+
+    def close_if_health_check_failed(self):
+        if (
+            self.connection is None
+            or self.health_check_done
+            or self.in_atomic_block
+            or not self.settings_dict.get('CONN_HEALTH_CHECKS')
+        ):
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        # Called when a request or task starts and finishes, check the
+        # connection again before its next query
+        self.health_check_done = False
+        super().close_if_unusable_or_obsolete()
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
+
+    def set_autocommit(self, *args, **kwargs):
+        self.close_if_health_check_failed()
+        return super().set_autocommit(*args, **kwargs)
@@ -0,0 +1,411 @@
+"""
+Benchmarks of the API endpoints.
+
+``seed`` fills a store with orders at one of the ``SCALES``, ``run`` requests
+every endpoint of ``ENDPOINTS`` through the test client and measures its
+latency, SQL queries and response size, and ``compare`` checks the results
+against the baselines of ``BENCHMARK_BASELINES`` within
+``BENCHMARK_THRESHOLDS``.
+
+Every request runs in a transaction rolled back afterwards, so writes don't
+change the data the next requests see, and uploads go to a temporary
+directory.
+"""
+import io
+import json
+import math
+import os
+import tempfile
+import time
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import override_settings
+from django.urls import reverse
+from django_rest_passwordreset.models import ResetPasswordToken
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .models import (
+    Admin, Category, Customer, Order, OrderConfirmationCode, OrderItem,
+    Payment, Product, ProductStock, Store, VerificationCode
+)
+from .utils.auth_utils import generate_jwt_token
+
+User = get_user_model()
+
+# Orders of the benchmarked store
+SCALES = {
+    'small': 100,
+    'medium': 10_000,
+    'large': 1_000_000,
+}
+
+# Below the products limit of the free plan, so products can still be created
+PRODUCTS = 30
+
+PASSWORD = '2Password_'
+
+BATCH_SIZE = 5000
+
+# ``pk`` names the fixture in the url, ``data`` builds the payload from the
+# fixtures, sent as JSON unless ``format`` is 'multipart'
+Endpoint = namedtuple('Endpoint', 'method url_name pk query data format')
+Endpoint.__new__.__defaults__ = (None, '', None, None)
+
+Result = namedtuple('Result', 'name status p50 p95 queries bytes')
+
+
+def get_name(endpoint):
+    name = f'{endpoint.method.upper()} {endpoint.url_name}'
+    if endpoint.query and not callable(endpoint.query):
+        name += f'?{endpoint.query}'
+    return name
+
+
+def _order(fixtures):
+    return {
+        'store_id': str(fixtures.store.pk),
+        'customer_id': str(fixtures.customer.pk),
+        'delivery_fee': 0.0
+    }
+
+
+def _place_order(fixtures):
+    return {
+        'order': {
+            'store_id': str(fixtures.store.pk),
+            'confirmed': False
+        },
+        'customer': {
+            'store_id': str(fixtures.store.pk),
+            'first_name': 'Guitoo',
+            'last_name': 'Stephan',
+            'phone_number': '+233209456202',
+            'city': 'Accra',
+            'email': 'benchmark.buyer@souko.com',
+            'country': 'GH',
+            'address': 'BP 21 Bonoua'
+        }
+    }
+
+
+def _reset_password_confirm(fixtures):
+    token = ResetPasswordToken.objects.create( user=fixtures.user, user_agent='', ip_address='' )
+    return { 'password': PASSWORD, 'token': token.key }
+
+
+def _product_images(fixtures):
+    content = io.BytesIO()
+    Image.new('RGB', (800, 600), (200, 120, 40)).save(content, 'JPEG')
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as images:
+        for product in fixtures.store.products.all()[:10]:
+            images.writestr(f'{product.pk}.jpg', content.getvalue())
+    return { 'archive': SimpleUploadedFile('images.zip', archive.getvalue(), content_type='application/zip') }
+
+
+def _resend_verification_code(fixtures):
+    VerificationCode.objects.create( email=fixtures.user.email )
+    return { 'email': fixtures.user.email }
+
+
+def _resend_order_confirmation_code(fixtures):
+    OrderConfirmationCode.objects.create( order=fixtures.order )
+    return { 'order_id': str(fixtures.order.pk) }
+
+
+def _confirm_order(fixtures):
+    return { 'code': OrderConfirmationCode.objects.create( order=fixtures.order ).code }
+
+
+ENDPOINTS = [
+    Endpoint('post', 'subscribers', data=lambda f: { 'email': 'benchmark.subscriber@souko.com' }),
+    Endpoint('get', 'subscription_plans'),
+    Endpoint('get', 'users'),
+    Endpoint('post', 'users', data=lambda f: {
+        'email': 'benchmark.signup@souko.com',
+        'password': PASSWORD,
+        'first_name': 'Guy',
+        'username': 'benchmark_signup',
+        'last_name': 'Tanoh'
+    }),
+    Endpoint('get', 'user_details', 'user'),
+    Endpoint('put', 'user_details', 'user', data=lambda f: { 'first_name': 'Stephane' }),
+    Endpoint('post', 'users_login', data=lambda f: { 'email': f.user.email, 'password': PASSWORD }),
+    Endpoint(
+        'get', 'users_verify',
+        query=lambda f: f'code={VerificationCode.objects.create( email=f.user.email ).code}'
+    ),
+    Endpoint('post', 'users_resend_verification_code', data=_resend_verification_code),
+    Endpoint('post', 'reset_password_request_token', data=lambda f: { 'email': f.user.email }),
+    Endpoint('post', 'reset_password_confirm', data=_reset_password_confirm),
+    Endpoint('post', 'change_password', data=lambda f: { 'old_password': PASSWORD, 'new_password': PASSWORD }),
+    Endpoint('get', 'categories'),
+    Endpoint('post', 'categories', data=lambda f: { 'name': 'Bags' }),
+    Endpoint('get', 'stores'),
+    Endpoint('post', 'stores', data=lambda f: {
+        'name': 'Benchmark Studios',
+        'phone_number': '+233209456202',
+        'categories_ids': [ str(f.category.pk) ]
+    }),
+    Endpoint('get', 'store_details', 'store'),
+    Endpoint('put', 'store_details', 'store', data=lambda f: { 'city': 'Accra' }),
+    Endpoint('get', 'store_profit_report', 'store', query='period=3'),
+    Endpoint('get', 'store_orders_report', 'store', query='period=3'),
+    Endpoint('get', 'store_stock_report', 'store', query='period=3'),
+    Endpoint('get', 'store_dashboard', 'store', query='period=3'),
+    Endpoint('get', 'store_admins', 'store'),
+    Endpoint('get', 'store_customers', 'store'),
+    Endpoint('get', 'store_customers', 'store', query='search=Customer+12'),
+    Endpoint('get', 'store_products', 'store'),
+    Endpoint('get', 'store_products', 'store', query='search=Product+1'),
+    Endpoint('post', 'store_product_images', 'store', data=_product_images, format='multipart'),
+    Endpoint('get', 'store_orders', 'store'),
+    Endpoint('get', 'store_orders', 'store', query='search=Customer&payment_status=PAID'),
+    Endpoint('get', 'customers'),
+    Endpoint('post', 'customers', data=lambda f: {
+        'store_id': str(f.store.pk),
+        'first_name': 'Guitoo',
+        'last_name': 'Stephan',
+        'email': 'benchmark.customer@souko.com'
+    }),
+    Endpoint('get', 'customer_details', 'customer'),
+    Endpoint('put', 'customer_details', 'customer', data=lambda f: { 'first_name': 'Gustave' }),
+    Endpoint('get', 'customer_orders', 'customer'),
+    Endpoint('get', 'customer_ordered_products', 'customer'),
+    Endpoint('get', 'products'),
+    Endpoint('post', 'products', data=lambda f: {
+        'store_id': str(f.store.pk),
+        'name': 'Gucci Bags',
+        'quantity': ['9'],
+        'buying_price': 150.0,
+        'selling_price': 250.0
+    }),
+    Endpoint('get', 'product_details', 'product'),
+    Endpoint('put', 'product_details', 'product', data=lambda f: { 'name': 'Louis Vuitton Bags' }),
+    Endpoint('delete', 'product_details', 'product'),
+    Endpoint('get', 'product_product_stocks', 'product'),
+    Endpoint('get', 'product_customers', 'product'),
+    Endpoint('get', 'product_customers', 'product', query='search=Customer'),
+    Endpoint('get', 'product_stocks'),
+    Endpoint('post', 'product_stocks', data=lambda f: { 'product_id': str(f.product.pk), 'quantity': 10 }),
+    Endpoint('get', 'product_stock_details', 'stock'),
+    Endpoint('put', 'product_stock_details', 'stock', data=lambda f: { 'quantity': 10 }),
+    Endpoint('delete', 'product_stock_details', 'stock'),
+    Endpoint('get', 'orders'),
+    Endpoint('post', 'orders', data=_order),
+    Endpoint('get', 'order_details', 'order'),
+    Endpoint('put', 'order_details', 'order', data=lambda f: { 'delivery_fee': 5.0 }),
+    Endpoint('delete', 'order_details', 'order'),
+    Endpoint('get', 'order_order_items', 'order'),
+    Endpoint('get', 'order_payments', 'order'),
+    Endpoint('post', 'order_items', data=lambda f: {
+        'order_id': str(f.order.pk),
+        'product_id': str(f.product.pk),
+        'quantity': 1
+    }),
+    Endpoint('get', 'order_item_details', 'order_item'),
+    Endpoint('put', 'order_item_details', 'order_item', data=lambda f: { 'quantity': 2 }),
+    Endpoint('delete', 'order_item_details', 'order_item'),
+    Endpoint('get', 'payments'),
+    Endpoint('post', 'payments', data=lambda f: { 'order_id': str(f.order.pk), 'amount': 50.0 }),
+    Endpoint('get', 'payment_details', 'payment'),
+    Endpoint('put', 'payment_details', 'payment', data=lambda f: { 'amount': 20.0 }),
+    Endpoint('get', 'store_products_for_customers', 'store'),
+    Endpoint('get', 'store_products_for_customers', 'store', query='search=Product+1'),
+    Endpoint('get', 'store_for_customers', 'store'),
+    Endpoint('post', 'customers_place_order', 'store', data=_place_order),
+    Endpoint('post', 'customers_resend_confirmation_code', 'store', data=_resend_order_confirmation_code),
+    Endpoint('post', 'customers_confirm_order', 'store', data=_confirm_order),
+]
+
+
+def _batches(count, size=BATCH_SIZE):
+    for start in range(0, count, size):
+        yield range(start, min(start + size, count))
+
+
+def seed(orders):
+    """
+    Create a store with ``orders`` orders, each with an item and half of them
+    paid, between a tenth as many customers, and return the fixtures the
+    endpoints are requested with.
+    """
+    user = User.objects.create_user(
+        email='benchmark.owner@souko.com',
+        password=PASSWORD,
+        username='benchmark_owner',
+        first_name='Guy',
+        last_name='Tanoh',
+        is_email_confirmed=True
+    )
+    category = Category.objects.create( name='Benchmark' )
+    store = Store.objects.create( name='Benchmark Store', phone_number='+233209456202' )
+    store.categories.set( [ category ] )
+    Admin.objects.create( user=user, store=store, role='OWNER' )
+
+    products = Product.objects.bulk_create([
+        Product( store=store, name=f'Product {i}', buying_price=100.0, selling_price=150.0 + i )
+        for i in range(PRODUCTS)
+    ])
+    stocks = ProductStock.objects.bulk_create([
+        ProductStock( product=product, quantity=orders ) for product in products
+    ])
+
+    customers = []
+    for batch in _batches(max(1, orders // 10)):
+        customers += Customer.objects.bulk_create([
+            Customer( store=store, first_name='Customer', last_name=str(i), email=f'customer{i}@souko.com' )
+            for i in batch
+        ], batch_size=BATCH_SIZE)
+
+    for batch in _batches(orders):
+        created = Order.objects.bulk_create([
+            Order( store=store, customer=customers[i % len(customers)], confirmed=True )
+            for i in batch
+        ])
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=products[i % PRODUCTS],
+                product_stock=stocks[i % PRODUCTS],
+                quantity=1,
+                cost=products[i % PRODUCTS].selling_price
+            )
+            for i, order in zip(batch, created)
+        ])
+        paid = [ (order, item) for order, item in zip(created, items) if order.pk.int % 2 ]
+        Payment.objects.bulk_create([ Payment( order=order, amount=item.cost ) for order, item in paid ])
+        Order.objects.filter( pk__in=[ order.pk for order, item in paid ] ).update( payment_status='PAID' )
+    Order.objects.build_search_documents(store.pk)
+
+    order = Order.objects.filter( store=store ).first()
+    return SimpleNamespace(
+        user=user,
+        token=generate_jwt_token(user),
+        category=category,
+        store=store,
+        product=products[0],
+        stock=stocks[0],
+        customer=order.customer,
+        order=order,
+        order_item=order.order_items.first(),
+        payment=order.payments.first() or Payment.objects.create( order=order, amount=0.0 ),
+    )
+
+
+def _percentile(timings, percent):
+    ordered = sorted(timings)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class QueryCounter(object):
+    """
+    ``execute_wrapper`` counting queries, unlike ``connection.queries`` it
+    isn't capped to the last 9000
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(client, endpoint, fixtures, repeat):
+    url = reverse(endpoint.url_name, kwargs={ 'pk': getattr(fixtures, endpoint.pk).pk } if endpoint.pk else None)
+    timings = []
+    # A first request that isn't timed warms the caches and imports
+    for _ in range(repeat + 1):
+        with transaction.atomic():
+            query = endpoint.query(fixtures) if callable(endpoint.query) else endpoint.query
+            data = endpoint.data(fixtures) if endpoint.data else None
+            if endpoint.format:
+                kwargs = { 'data': data, 'format': endpoint.format }
+            else:
+                kwargs = { 'data': json.dumps(data), 'content_type': 'application/json' } if data is not None else {}
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                start = time.perf_counter()
+                response = getattr(client, endpoint.method)(f'{url}?{query}' if query else url, **kwargs)
+                timings.append(time.perf_counter() - start)
+            transaction.set_rollback(True)
+
+    timings = timings[1:]
+    return Result(
+        name=get_name(endpoint),
+        status=response.status_code,
+        p50=_percentile(timings, 50) * 1000,
+        p95=_percentile(timings, 95) * 1000,
+        queries=queries.count,
+        bytes=len(response.content)
+    )
+
+
+@contextmanager
+def local_storage():
+    """Keep the uploads in a temporary directory rather than the default storage"""
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+        DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+        MEDIA_ROOT=os.path.join(directory, 'media'),
+        IMAGE_STAGING_ROOT=os.path.join(directory, 'staging'),
+    ):
+        yield
+
+
+def run(fixtures, repeat=20, endpoints=None):
+    client = APIClient( SERVER_NAME='localhost' )
+    client.credentials( HTTP_AUTHORIZATION='Token ' + fixtures.token )
+    with local_storage():
+        return [ measure(client, endpoint, fixtures, repeat) for endpoint in endpoints or ENDPOINTS ]
+
+
+def load_baselines(path=None):
+    try:
+        with open(path or settings.BENCHMARK_BASELINES) as baselines:
+            return json.load(baselines)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(scale, results, path=None):
+    baselines = load_baselines(path)
+    baselines.setdefault(scale, {}).update({
+        result.name: {
+            'p50': round(result.p50, 2),
+            'p95': round(result.p95, 2),
+            'queries': result.queries,
+            'bytes': result.bytes,
+        }
+        for result in results
+    })
+    with open(path or settings.BENCHMARK_BASELINES, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def compare(results, baselines, thresholds=None):
+    """Regressions of ``results`` over their ``baselines``, as messages"""
+    thresholds = thresholds or settings.BENCHMARK_THRESHOLDS
+    regressions = []
+    for result in results:
+        baseline = baselines.get(result.name)
+        if not baseline:
+            continue
+        # The slack keeps the noise of fast endpoints from failing them
+        budget = baseline['p95'] * thresholds['latency'] + thresholds['latency_slack']
+        if result.p95 > budget:
+            regressions.append(f"{result.name}: p95 {result.p95:.1f}ms over {budget:.1f}ms")
+        if result.queries > baseline['queries'] + thresholds['queries']:
+            regressions.append(f"{result.name}: {result.queries} queries instead of {baseline['queries']}")
+        if result.bytes > baseline['bytes'] * thresholds['bytes']:
+            regressions.append(f"{result.name}: {result.bytes} bytes instead of {baseline['bytes']}")
+    return regressions
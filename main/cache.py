@@ -0,0 +1,34 @@
+"""
+Cache backends counting their hits and misses for main.performance.
+"""
+from django.core.cache.backends.locmem import LocMemCache as BaseLocMemCache
+from django_redis.cache import RedisCache as BaseRedisCache
+
+from .performance import record_cache
+
+_missing = object()
+
+
+class CacheStatsMixin(object):
+
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super().get(key, _missing, version=version, **kwargs)
+        if value is _missing:
+            record_cache(0, 1)
+            return default
+        record_cache(1, 0)
+        return value
+
+
+class RedisCache(CacheStatsMixin, BaseRedisCache):
+
+    def get_many(self, keys, version=None, **kwargs):
+        # Unlike the default one, it doesn't go through ``get``
+        keys = list(keys)
+        values = super().get_many(keys, version=version, **kwargs)
+        record_cache(len(values), len(keys) - len(values))
+        return values
+
+
+class LocMemCache(CacheStatsMixin, BaseLocMemCache):
+    pass
@@ -8,3 +8,15 @@ MONTHLY_SUBSCRIPTION_PERIOD = 1
 YEARLY_SUBSCRIPTION_PERIOD = 12
 
 FREE_PLAN = 'FREE'
+
+# Crontab of the store metrics schedules
+EVERY_FIVE_MINUTES = {
+    'minute': '*/5',
+    'hour': '*',
+    'day_of_week': '*',
+    'day_of_month': '*',
+    'month_of_year': '*'
+}
+
+# Postgres channel the outbox relay listens on
+OUTBOX_CHANNEL = 'souko_outbox'
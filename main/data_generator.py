@@ -0,0 +1,380 @@
+"""
+Synthetic data for load tests.
+
+``plan_stores`` spreads the orders between the stores along a Zipf
+distribution, so a few whale stores get most of them and the rest form a long
+tail. Customers and products are picked along power laws too, giving repeat
+buyers and best sellers.
+
+Every row is derived from the seed and its position, never from what was
+generated before it, so stores and chunks of orders are generated by parallel
+processes in any order and the same seed still gives the same data. Rows are
+written with ``COPY``.
+"""
+import csv
+import hashlib
+import io
+import random
+import string
+import uuid
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
+
+from .models import (
+    Admin, Category, Customer, Order, OrderItem, OrdersTimestampedMetric,
+    Payment, Product, ProductStock, ProfitTimestampedMetric, Store,
+    StoreSubscription, SubscriptionPlan
+)
+
+User = get_user_model()
+
+DEFAULTS = {
+    'seed': 0,
+    'stores': 100,
+    'orders': 100_000,
+    # Zipf exponent of the orders per store, higher makes bigger whales
+    'store_skew': 1.1,
+    # Power of the customer and product picks, 1 is uniform
+    'customer_skew': 2.0,
+    'product_skew': 1.5,
+    'customers_per_order': 0.3,
+    'products': 50,
+    'max_items': 4,
+    'paid_ratio': 0.7,
+    'confirmed_ratio': 0.95,
+    'days': 365,
+    'batch_size': 20_000,
+    'workers': 1,
+}
+
+# Owners of the generated stores log in with it
+PASSWORD = 'souko-load-test'
+
+CATEGORIES = ['Fashion', 'Electronics', 'Food', 'Beauty', 'Home']
+
+StorePlan = namedtuple('StorePlan', 'index id orders customers products')
+
+
+def make_uuid(*parts):
+    digest = hashlib.md5(':'.join(map(str, parts)).encode()).digest()
+    return uuid.UUID(bytes=digest, version=4)
+
+
+def get_owner_email(seed, index):
+    return f'owner{index}.{seed}@souko.test'
+
+
+def plan_stores(config):
+    weights = [ 1 / (rank + 1) ** config['store_skew'] for rank in range(config['stores']) ]
+    total = sum(weights)
+    orders = [ int(config['orders'] * weight / total) for weight in weights ]
+    # What the rounding left goes to the biggest store
+    orders[0] += config['orders'] - sum(orders)
+    return [
+        StorePlan(
+            index=index,
+            id=make_uuid(config['seed'], 'store', index),
+            orders=store_orders,
+            customers=max(1, int(store_orders * config['customers_per_order'])),
+            products=config['products']
+        )
+        for index, store_orders in enumerate(orders)
+    ]
+
+
+def _csv_value(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def copy_rows(cursor, model, rows, batch_size=None):
+    """
+    ``COPY`` the ``rows`` dicts, keyed by attname, into the table of
+    ``model``. Missing fields take their default, timestamps the
+    ``created_at`` of the row.
+    """
+    batch_size = batch_size or DEFAULTS['batch_size']
+    fields = [
+        field for field in model._meta.concrete_fields
+        if not isinstance(field, models.AutoField)
+    ]
+    defaults = { field.attname: field.get_default() for field in fields }
+    timestamps = { field.attname for field in fields if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False) }
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    sql = f"COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            _csv_value(row[name] if name in row else row['created_at'] if name in timestamps else defaults[name])
+            for name in defaults
+        ])
+        count += 1
+        if count % batch_size == 0:
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+    if count % batch_size:
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+    return count
+
+
+def _product(seed, store, index):
+    rng = random.Random(f'{seed}:{store.index}:product:{index}')
+    buying_price = round(rng.uniform(5, 200), 2)
+    return {
+        'id': make_uuid(seed, store.index, 'product', index),
+        'stock_id': make_uuid(seed, store.index, 'stock', index),
+        'buying_price': buying_price,
+        'selling_price': round(buying_price * rng.uniform(1.1, 2.0), 2),
+    }
+
+
+def create_stores(config, stores):
+    """Owners, stores and subscriptions, in the calling process"""
+    seed = config['seed']
+    now = timezone.now()
+    created_at = now - timedelta(days=config['days'])
+    categories = [ Category.objects.get_or_create(name=name)[0] for name in CATEGORIES ]
+    plan = SubscriptionPlan.objects.get(plan_type=SubscriptionPlan.FREE)
+    password = make_password(PASSWORD)
+
+    with connection.cursor() as cursor:
+        copy_rows(cursor, User, (
+            {
+                'id': make_uuid(seed, 'owner', store.index),
+                'password': password,
+                'email': get_owner_email(seed, store.index),
+                'username': f'owner{store.index}_{seed}',
+                'first_name': 'Owner',
+                'last_name': str(store.index),
+                'is_email_confirmed': True,
+                'is_onboarded': True,
+                'date_joined': created_at,
+                'created_at': created_at,
+            }
+            for store in stores
+        ))
+        copy_rows(cursor, Store, (
+            { 'id': store.id, 'name': f'Store {store.index}', 'city': 'Accra', 'created_at': created_at }
+            for store in stores
+        ))
+        copy_rows(cursor, Store.categories.through, (
+            { 'store_id': store.id, 'category_id': categories[store.index % len(categories)].id }
+            for store in stores
+        ))
+        copy_rows(cursor, Admin, (
+            {
+                'id': make_uuid(seed, 'admin', store.index),
+                'user_id': make_uuid(seed, 'owner', store.index),
+                'store_id': store.id,
+                'role': 'OWNER',
+                'created_at': created_at,
+            }
+            for store in stores
+        ))
+        copy_rows(cursor, StoreSubscription, (
+            { 'store_id': store.id, 'plan_id': plan.id, 'created_at': created_at }
+            for store in stores
+        ))
+
+
+def generate_catalog(config, store):
+    """Products, their stock and the customers of ``store``"""
+    seed = config['seed']
+    rng = random.Random(f'{seed}:{store.index}:catalog')
+    created_at = timezone.now() - timedelta(days=config['days'])
+    products = [ _product(seed, store, index) for index in range(store.products) ]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        copy_rows(cursor, Product, (
+            {
+                'id': product['id'],
+                'store_id': store.id,
+                'name': f'Product {index}',
+                'buying_price': product['buying_price'],
+                'selling_price': product['selling_price'],
+                'created_at': created_at,
+            }
+            for index, product in enumerate(products)
+        ))
+        copy_rows(cursor, ProductStock, (
+            {
+                'id': product['stock_id'],
+                'product_id': product['id'],
+                'quantity': rng.randint(0, 500),
+                'created_at': created_at,
+            }
+            for product in products
+        ))
+        copy_rows(cursor, Customer, (
+            {
+                'id': make_uuid(seed, store.index, 'customer', index),
+                'store_id': store.id,
+                'email': f'customer{index}.{store.index}.{seed}@souko.test',
+                'first_name': rng.choice(('Ama', 'Kofi', 'Yaw', 'Akosua', 'Kwame', 'Adjoa')),
+                'last_name': f'Customer {index}',
+                'city': rng.choice(('Accra', 'Kumasi', 'Abidjan', 'Lagos')),
+                'created_at': created_at,
+            }
+            for index in range(store.customers)
+        ), config['batch_size'])
+
+
+def generate_orders(config, store, start, count):
+    """
+    Orders ``start`` to ``start + count`` of ``store`` with their items and
+    payments. Returns the orders and profit metrics of the chunk per day.
+    """
+    seed = config['seed']
+    rng = random.Random(f'{seed}:{store.index}:orders:{start}')
+    now = timezone.now()
+    today = now.date()
+    products = [ _product(seed, store, index) for index in range(store.products) ]
+    orders, items, payments = [], [], []
+    orders_metrics, profit_metrics = Counter(), Counter()
+
+    for position in range(start, start + count):
+        order_id = make_uuid(seed, store.index, 'order', position)
+        created_at = now - timedelta(seconds=rng.random() * config['days'] * 86400)
+        confirmed = rng.random() < config['confirmed_ratio']
+        delivery_fee = rng.choice((0.0, 0.0, 5.0, 10.0))
+
+        total, profit = 0.0, -delivery_fee
+        for item in range(1 + int(rng.random() ** 2 * config['max_items'])):
+            product = products[int(store.products * rng.random() ** config['product_skew'])]
+            quantity = rng.randint(1, 3)
+            cost = round(quantity * product['selling_price'], 2)
+            total += cost
+            profit += cost - quantity * product['buying_price']
+            items.append({
+                'id': make_uuid(seed, store.index, 'item', position, item),
+                'order_id': order_id,
+                'product_stock_id': product['stock_id'],
+                'product_id': product['id'],
+                'quantity': quantity,
+                'cost': cost,
+                'created_at': created_at,
+            })
+
+        payment = rng.random()
+        if payment < config['paid_ratio']:
+            payment_status, amount = 'PAID', total
+            paid_on = min(today, (created_at + timedelta(days=rng.randint(0, 3))).date())
+        elif payment < (1 + config['paid_ratio']) / 2:
+            payment_status, amount, paid_on = 'PARTIALLY_PAID', round(total / 2, 2), None
+        else:
+            payment_status, amount, paid_on = 'PENDING', None, None
+        if amount:
+            payments.append({
+                'id': make_uuid(seed, store.index, 'payment', position),
+                'order_id': order_id,
+                'amount': amount,
+                'created_at': created_at,
+            })
+
+        orders.append({
+            'id': order_id,
+            'store_id': store.id,
+            'customer_id': make_uuid(seed, store.index, 'customer', int(store.customers * rng.random() ** config['customer_skew'])),
+            'payment_status': payment_status,
+            'paid_on': paid_on,
+            'delivery_fee': delivery_fee,
+            'confirmed': confirmed,
+            'number': ''.join(rng.choice(string.ascii_uppercase) for _ in range(4)) + created_at.strftime('%m%d%Y%H%M%S'),
+            'created_at': created_at,
+        })
+        # Same metrics as create_store_orders_metrics and create_store_profit_metrics
+        if confirmed:
+            orders_metrics[created_at.date()] += 1
+            if paid_on:
+                profit_metrics[paid_on] += profit
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        copy_rows(cursor, Order, orders)
+        copy_rows(cursor, OrderItem, items)
+        copy_rows(cursor, Payment, payments)
+    return store.id, orders_metrics, profit_metrics
+
+
+def _generate_catalog(args):
+    return generate_catalog(*args)
+
+
+def _generate_orders(args):
+    return generate_orders(*args)
+
+
+def generate(config, log=None):
+    """
+    Generate the dataset described by ``config``, see ``DEFAULTS``, and
+    return the plan of its stores.
+    """
+    config = { **DEFAULTS, **config }
+    log = log or (lambda message: None)
+    stores = plan_stores(config)
+
+    with transaction.atomic():
+        create_stores(config, stores)
+    log(f"Created {len(stores)} stores, the biggest has {stores[0].orders} orders")
+
+    catalogs = [ (config, store) for store in stores ]
+    chunks = [
+        (config, store, start, min(config['batch_size'], store.orders - start))
+        for store in stores
+        for start in range(0, store.orders, config['batch_size'])
+    ]
+    orders_metrics, profit_metrics = Counter(), Counter()
+
+    def merge(result):
+        store_id, orders, profit = result
+        for date, value in orders.items():
+            orders_metrics[(store_id, date)] += value
+        for date, value in profit.items():
+            profit_metrics[(store_id, date)] += value
+
+    if config['workers'] > 1:
+        # Forked processes must open their own connections
+        connections.close_all()
+        with Pool(config['workers']) as pool:
+            pool.map(_generate_catalog, catalogs)
+            log("Created the products and customers")
+            for done, result in enumerate(pool.imap_unordered(_generate_orders, chunks), 1):
+                merge(result)
+                log(f"Created {done}/{len(chunks)} chunks of orders")
+    else:
+        for catalog in catalogs:
+            _generate_catalog(catalog)
+        log("Created the products and customers")
+        for done, chunk in enumerate(chunks, 1):
+            merge(_generate_orders(chunk))
+            log(f"Created {done}/{len(chunks)} chunks of orders")
+
+    # The orders were copied without their search documents
+    for store in stores:
+        Order.objects.build_search_documents(store.id)
+    log("Built the search documents of the orders")
+
+    OrdersTimestampedMetric.objects.upsert(
+        (store_id, date, value) for (store_id, date), value in orders_metrics.items()
+    )
+    ProfitTimestampedMetric.objects.upsert(
+        (store_id, date, round(value, 2)) for (store_id, date), value in profit_metrics.items()
+    )
+    log(f"Created {len(orders_metrics) + len(profit_metrics)} metrics")
+    return stores
@@ -0,0 +1,29 @@
+"""
+Persistent database connections in the Celery workers.
+
+Celery's Django fixup closes every connection before and after each task,
+so each task opened its own. ``CELERY_DB_REUSE_MAX`` turns that off and the
+tasks are handled like Django handles requests instead: their connections
+are kept for ``CONN_MAX_AGE`` seconds, closed after an error they can't
+recover from and checked before their first query (see
+``main.backends.postgresql``). The connections of a thread are only used by
+the tasks it runs, one at a time.
+"""
+from celery.signals import task_postrun, task_prerun
+from django.db import close_old_connections
+
+
+def _close_old_connections(task):
+    # Eager tasks run in the request or transaction of their caller
+    if not task.request.is_eager:
+        close_old_connections()
+
+
+@task_prerun.connect
+def start_task_connections(task=None, **kwargs):
+    _close_old_connections(task)
+
+
+@task_postrun.connect
+def end_task_connections(task=None, **kwargs):
+    _close_old_connections(task)
@@ -0,0 +1,141 @@
+"""
+Reads from the database replicas of ``REPLICA_DATABASES``.
+
+``ReplicaMiddleware`` sends the reads of safe requests (GET, HEAD, OPTIONS)
+to a replica, and the reports decorated with ``reads_from_replica`` read from
+one wherever they run. Everything else, writes and the reads of other
+requests or of the Celery tasks, goes to ``default``. A request reads from
+one replica picked at its start, so its queries agree even if the replicas
+lag by different amounts.
+
+A client that wrote keeps reading from ``default`` for
+``REPLICA_STICKY_SECONDS``, so it sees its writes even if the replicas lag.
+Clients are told apart by their Authorization header or session cookie, and
+the response to a write sets ``STICKY_COOKIE``. That covers the first
+request with the credentials of a login. A safe request that writes reads
+from ``default`` from then on.
+"""
+import hashlib
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from celery.signals import task_prerun
+from django.conf import settings
+from django.core.cache import cache
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+STICKY_COOKIE = 'souko-db-sticky'
+
+_local = threading.local()
+
+
+def get_replica():
+    """The replica the reads of this thread go to, None when they go to ``default``"""
+    return getattr(_local, 'replica', None)
+
+
+@contextmanager
+def use_replica(replica=None):
+    """
+    Send the reads of this thread to ``replica``, unless it wrote. By default
+    the one it already reads from, or one picked at random.
+    """
+    previous = get_replica()
+    if settings.REPLICA_DATABASES:
+        _local.replica = replica or previous or random.choice(settings.REPLICA_DATABASES)
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+@contextmanager
+def use_primary():
+    """Send the reads of this thread to ``default``, e.g. after a write"""
+    previous = getattr(_local, 'pinned', False)
+    _local.pinned = True
+    try:
+        yield
+    finally:
+        _local.pinned = previous
+
+
+def is_pinned():
+    """Whether the reads of this thread must see its writes"""
+    return getattr(_local, 'pinned', False)
+
+
+def reads_from_replica(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        replica = get_replica()
+        if replica and not is_pinned():
+            return replica
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        # Its next reads must see the write
+        _local.pinned = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.REPLICA_DATABASES
+
+
+def get_sticky_key(request):
+    client = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if client:
+        return f"souko:db-sticky:{hashlib.sha256(client.encode()).hexdigest()}"
+
+
+class ReplicaMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_DATABASES:
+            return self.get_response(request)
+
+        key = get_sticky_key(request)
+        if request.method not in SAFE_METHODS:
+            if key:
+                cache.set(key, True, settings.REPLICA_STICKY_SECONDS)
+            with use_primary():
+                response = self.get_response(request)
+            # The credentials may change with this request, e.g. a login
+            response.set_cookie(STICKY_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS, httponly=True)
+            return response
+
+        if (key and cache.get(key)) or request.COOKIES.get(STICKY_COOKIE):
+            with use_primary():
+                return self.get_response(request)
+
+        previous = is_pinned()
+        _local.pinned = False
+        try:
+            with use_replica():
+                return self.get_response(request)
+        finally:
+            _local.pinned = previous
+
+
+@task_prerun.connect
+def unpin_task(**kwargs):
+    # The writes of the previous task on this thread are committed
+    _local.pinned = False
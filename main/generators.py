@@ -1,3 +1,4 @@
+import re
 from datetime import datetime
 
 from django.utils.crypto import get_random_string
@@ -10,3 +11,7 @@ def generate_verification_code():
 def generate_order_number():
     now = datetime.now()
     return f"{get_random_string(length=4, allowed_chars='ABCDEFJHIGKLMNOPQRSTUVWXYZ')}{now.strftime('%m%d%Y%H%M%S')}"
+
+
+def is_order_number(value):
+    return bool(re.fullmatch(r"[A-Z]{4}\d{14}", value.upper()))
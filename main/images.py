@@ -0,0 +1,131 @@
+"""
+Resized variants of the uploaded images.
+
+Each image gets a variant per size of ``IMAGE_VARIANTS``, which is its
+longest side in pixels, in each format of ``IMAGE_FORMATS``. They are named
+after the original, ``<name>_<variant>.<format>``, and their names are kept
+as JSON on the model, ``{"<variant>": {"<format>": "<name>"}}``.
+"""
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.template.defaultfilters import filesizeformat
+from PIL import Image, ImageOps
+
+# Pillow format of each extension
+IMAGE_FORMATS = {
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+
+
+def get_variant_name(name, variant, extension):
+    root, _ = os.path.splitext(name)
+    return f"{root}_{variant}.{extension}"
+
+
+def render_variants(name, file):
+    """Name and content of each variant of the image in ``file``"""
+    image = Image.open(file)
+    # Phones save the orientation apart from the pixels
+    image = ImageOps.exif_transpose(image)
+    for variant, size in settings.IMAGE_VARIANTS.items():
+        resized = image.copy()
+        # Smaller images are kept as they are
+        resized.thumbnail((size, size), Image.LANCZOS)
+        for extension, image_format in IMAGE_FORMATS.items():
+            content = io.BytesIO()
+            if image_format == 'JPEG':
+                # No transparency nor palette in JPEG
+                resized.convert('RGB').save(content, image_format, quality=settings.IMAGE_QUALITY, optimize=True, progressive=True)
+            else:
+                resized.save(content, image_format, quality=settings.IMAGE_QUALITY)
+            yield (variant, extension), get_variant_name(name, variant, extension), content.getvalue()
+
+
+def get_stored_variants(name):
+    """Names of the variants of ``name`` already in the default storage, like those kept on the model"""
+    variants = {}
+    for variant in settings.IMAGE_VARIANTS:
+        for extension in IMAGE_FORMATS:
+            variant_name = get_variant_name(name, variant, extension)
+            if default_storage.exists(variant_name):
+                variants.setdefault(variant, {})[extension] = variant_name
+    return variants
+
+
+def get_variant_urls(variants):
+    """Urls of the variants whose names are in the JSON ``variants``, by variant and format"""
+    if not variants:
+        return {}
+    return {
+        variant: { extension: default_storage.url(name) for extension, name in formats.items() }
+        for variant, formats in json.loads(variants).items()
+    }
+
+
+@contextmanager
+def open_image_batch(files):
+    """
+    Images of the uploaded ``files`` by key. The images of a zip sent as
+    ``archive`` are keyed by their file name without extension, the other
+    files by their field name. The zip is closed on exit.
+
+    Raises ``ValidationError`` when an image is larger than
+    ``IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE`` or all of them than
+    ``IMAGE_BULK_UPLOAD_MAX_SIZE``, uncompressed, before anything is read.
+    """
+    images = {}
+    sizes = {}
+    with ExitStack() as stack:
+        for key, file in files.items():
+            if key != 'archive':
+                images[key] = file
+                sizes[file.name] = file.size
+                continue
+            archive = stack.enter_context(zipfile.ZipFile(file))
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                # Folders, hidden files and the metadata macOS adds
+                if info.is_dir() or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                    continue
+                images[os.path.splitext(name)[0]] = File(stack.enter_context(archive.open(info)), name=name)
+                # Reading a member stops at its declared size, whatever the data
+                sizes[info.filename] = info.file_size
+        check_batch_sizes(sizes)
+        yield images
+
+
+def check_batch_sizes(sizes):
+    """Check the uncompressed ``sizes`` of the images of a batch, by file name"""
+    for name, size in sizes.items():
+        if size > settings.IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE:
+            limit = filesizeformat(settings.IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE)
+            raise ValidationError(f"{name} is larger than {limit}")
+    if sum(sizes.values()) > settings.IMAGE_BULK_UPLOAD_MAX_SIZE:
+        limit = filesizeformat(settings.IMAGE_BULK_UPLOAD_MAX_SIZE)
+        raise ValidationError(f"The images are larger than {limit} in all")
+
+
+def stage_images(field_name, uploads):
+    """
+    Save the files of ``uploads``, (instance, file) pairs, to the image field
+    ``field_name`` of their instance, ``IMAGE_BULK_UPLOAD_WORKERS`` at a time.
+    Their variants are made once the instances are saved.
+    """
+    def stage(upload):
+        instance, file = upload
+        getattr(instance, field_name).save(os.path.basename(file.name), file, save=False)
+        instance._meta.get_field(field_name).mark_staged(instance)
+
+    with ThreadPoolExecutor(settings.IMAGE_BULK_UPLOAD_WORKERS) as executor:
+        # Raises the first error
+        list(executor.map(stage, uploads))
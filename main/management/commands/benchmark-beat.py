@@ -0,0 +1,65 @@
+import json
+import time
+import tracemalloc
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django_celery_beat.models import PeriodicTask
+
+from soukoapi.celery import app
+from main import constants
+from main.models import get_crontab_schedule
+from main.scheduler import SmartScheduler
+
+STORE_TASKS = (
+    "main.tasks.create_store_orders_metrics",
+    "main.tasks.create_store_profit_metrics",
+)
+
+
+def measure_schedule_load():
+    tracemalloc.start()
+    start = time.perf_counter()
+    scheduler = SmartScheduler(app=app, lazy=True)
+    schedule = scheduler.all_as_schedule()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(schedule), elapsed, peak
+
+
+class Command(BaseCommand):
+    help = "Measure beat start-up time and memory with per-store and fan out schedules"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stores", type=int, default=50000)
+
+    def handle(self, *args, **options):
+        stores = options["stores"]
+
+        self.stdout.write(f"{'schedule':>10} {'entries':>9} {'load s':>8} {'peak MB':>9}")
+        # Nothing written here outlives the command
+        with transaction.atomic():
+            schedule = get_crontab_schedule(**constants.EVERY_FIVE_MINUTES)
+
+            entries, elapsed, peak = measure_schedule_load()
+            self.stdout.write(f"{'fan out':>10} {entries:>9} {elapsed:>8.2f} {peak / 2 ** 20:>9.1f}")
+
+            PeriodicTask.objects.bulk_create(
+                [
+                    PeriodicTask(
+                        name=f"{task} {uuid.uuid4()}",
+                        task=task,
+                        crontab=schedule,
+                        args=json.dumps([str(uuid.uuid4())])
+                    )
+                    for _ in range(stores) for task in STORE_TASKS
+                ],
+                batch_size=5000
+            )
+
+            entries, elapsed, peak = measure_schedule_load()
+            self.stdout.write(f"{'per store':>10} {entries:>9} {elapsed:>8.2f} {peak / 2 ** 20:>9.1f}")
+
+            transaction.set_rollback(True)
@@ -0,0 +1,108 @@
+import io
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.util import setup_testing_defaults
+
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from main.utils.auth_utils import generate_jwt_token
+
+User = get_user_model()
+
+EMAIL = "benchmark-connections@souko.local"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the requests per second of an endpoint opening a database connection "
+        "per request with persistent connections, with and without health checks. "
+        "Requests go through the WSGI handler from threads, like gunicorn threads."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--threads", type=int, default=4, help="Requests handled at the same time")
+        parser.add_argument("--path", default="/api/v1/categories/", help="GET requested as a confirmed user")
+        parser.add_argument("--max-age", type=int, default=60, help="CONN_MAX_AGE of the persistent connections")
+
+    def handle(self, *args, **options):
+        User.objects.filter(email=EMAIL).delete()
+        user = User.objects.create_user(
+            email=EMAIL, password=None, username=EMAIL, first_name="Benchmark", is_email_confirmed=True
+        )
+        path, _, query = options["path"].partition("?")
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": "localhost",
+            "HTTP_AUTHORIZATION": "Token " + generate_jwt_token(user),
+        }
+        setup_testing_defaults(environ)
+
+        opened = itertools.count()
+        count_connection = lambda **kwargs: next(opened)
+        connection_created.connect(count_connection)
+        databases = list(connections.databases.values())
+        previous = [ (database["CONN_MAX_AGE"], database.get("CONN_HEALTH_CHECKS")) for database in databases ]
+        # Don't log every request
+        logging.disable(logging.WARNING)
+
+        self.stdout.write(f"{'connections':>24} {'seconds':>8} {'requests/s':>11} {'opened':>7}")
+        try:
+            for name, max_age, health_checks in (
+                ("new per request", 0, False),
+                ("persistent", options["max_age"], False),
+                ("persistent, checked", options["max_age"], True),
+            ):
+                for database in databases:
+                    database.update(CONN_MAX_AGE=max_age, CONN_HEALTH_CHECKS=health_checks)
+                start_opened = next(opened)
+                elapsed = self.run(environ, options["requests"], options["threads"])
+                self.stdout.write(
+                    f"{name:>24} {elapsed:>8.2f} {options['requests'] / elapsed:>11.0f} "
+                    f"{next(opened) - start_opened - 1:>7}"
+                )
+        finally:
+            logging.disable(logging.NOTSET)
+            connection_created.disconnect(count_connection)
+            for database, (max_age, health_checks) in zip(databases, previous):
+                database.update(CONN_MAX_AGE=max_age, CONN_HEALTH_CHECKS=health_checks)
+            user.delete()
+
+    def run(self, environ, requests, threads):
+        handler = WSGIHandler()
+        statuses = []
+
+        def start_response(status, headers):
+            statuses.append(status)
+
+        def request(count):
+            try:
+                for _ in range(count):
+                    response = handler({ **environ, "wsgi.input": io.BytesIO() }, start_response)
+                    # Sends request_finished, like a WSGI server
+                    response.close()
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            futures = [
+                executor.submit(request, requests // threads + (index < requests % threads))
+                for index in range(threads)
+            ]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        failed = [ status for status in statuses if not status.startswith("200") ]
+        if failed:
+            raise CommandError(f"{len(failed)} requests failed, first with {failed[0]}")
+        return elapsed
@@ -0,0 +1,58 @@
+import json
+import time
+from unittest.mock import patch
+
+import sendgrid
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import EmailMessage
+from main.tasks import send_email_batch
+from main.utils.mail.emailer import Emailer
+from main.utils.mail.fake_server import FakeSendGridServer
+
+
+class Command(BaseCommand):
+    help = "Compare sending emails one by one and in batches against a local fake SendGrid"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--emails", type=int, default=2000)
+        parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request")
+
+    def handle(self, *args, **options):
+        emails = options["emails"]
+        messages = [
+            ([f"customer{i}@example.com"], "Your order", {"order": i}) for i in range(emails)
+        ]
+        server = FakeSendGridServer(latency=options["latency"]).start()
+        client = sendgrid.SendGridAPIClient("benchmark", host=server.url)
+
+        self.stdout.write(f"{'mode':>10} {'requests':>9} {'seconds':>8} {'emails/s':>9}")
+        try:
+            with patch("main.utils.mail.emailer.sg", client):
+                start = time.perf_counter()
+                for tos, subject, context in messages:
+                    Emailer("benchmark", tos, subject, context).send()
+                self.report("single", server, emails, time.perf_counter() - start)
+
+                server.requests = 0
+                # Nothing written here outlives the command
+                with transaction.atomic():
+                    EmailMessage.objects.bulk_create([
+                        EmailMessage(
+                            template_id="benchmark",
+                            tos=json.dumps(tos),
+                            subject=subject,
+                            context=json.dumps(context)
+                        )
+                        for tos, subject, context in messages
+                    ])
+                    start = time.perf_counter()
+                    send_email_batch("benchmark")
+                    self.report("batched", server, emails, time.perf_counter() - start)
+                    transaction.set_rollback(True)
+        finally:
+            server.stop()
+
+    def report(self, mode, server, emails, elapsed):
+        self.stdout.write(f"{mode:>10} {server.requests:>9} {elapsed:>8.2f} {emails / elapsed:>9.0f}")
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Request every API endpoint against a seeded store and compare latency, "
+        "queries and response size with the baselines. Latency baselines only "
+        "hold on the machine they were recorded on."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=list(benchmarks.SCALES), default="small")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed requests per endpoint")
+        parser.add_argument("--endpoint", action="append", dest="url_names", help="Only benchmark this url name")
+        parser.add_argument("--update-baselines", action="store_true", help="Store the results as the baselines")
+
+    def handle(self, *args, **options):
+        scale = options["scale"]
+        endpoints = [
+            endpoint for endpoint in benchmarks.ENDPOINTS
+            if not options["url_names"] or endpoint.url_name in options["url_names"]
+        ]
+        if not endpoints:
+            raise CommandError("No endpoint to benchmark")
+
+        # Nothing the benchmark creates is kept
+        with transaction.atomic():
+            self.stdout.write(f"Seeding {benchmarks.SCALES[scale]} orders")
+            fixtures = benchmarks.seed(benchmarks.SCALES[scale])
+            results = benchmarks.run(fixtures, options["repeat"], endpoints)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'endpoint':<60} {'status':>6} {'p50 ms':>9} {'p95 ms':>9} {'queries':>8} {'bytes':>9}")
+        for result in results:
+            self.stdout.write(
+                f"{result.name:<60} {result.status:>6} {result.p50:>9.2f} {result.p95:>9.2f} "
+                f"{result.queries:>8} {result.bytes:>9}"
+            )
+
+        if options["update_baselines"]:
+            benchmarks.save_baselines(scale, results)
+            self.stdout.write(f"Saved the {scale} baselines")
+            return
+
+        regressions = benchmarks.compare(results, benchmarks.load_baselines().get(scale, {}))
+        if regressions:
+            raise CommandError("Regressions over the baselines:\n" + "\n".join(regressions))
+        self.stdout.write("No regression")
@@ -0,0 +1,64 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sendgrid
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from main.utils.async_sender import send_all
+from main.utils.clients import get_client, get_pool_stats, ProviderRequest
+from main.utils.mail.fake_server import FakeSendGridServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare a new SendGrid client per message, the pooled client and the async sender "
+        "against a local fake SendGrid. The async sender takes its tokens from Redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=4, help="Messages sent at the same time, like worker threads")
+        parser.add_argument("--latency", type=float, default=0.005, help="Seconds per request")
+        parser.add_argument("--handshake", type=float, default=0.03, help="Seconds to set up a connection")
+
+    def handle(self, *args, **options):
+        server = FakeSendGridServer(latency=options["latency"], handshake=options["handshake"]).start()
+        messages = options["messages"]
+        message = {"personalizations": [{"to": [{"email": "customer@example.com"}]}]}
+
+        def send_with_new_client():
+            sendgrid.SendGridAPIClient("benchmark", host=server.url).send(message=message)
+
+        def send_with_pooled_client():
+            get_client("sendgrid").send(message=message)
+
+        def send_concurrently():
+            client = get_client("sendgrid")
+            request = ProviderRequest("sendgrid", "POST", client.url, {"json": message, "headers": client.headers})
+            send_all([request] * messages)
+
+        self.stdout.write(f"{'client':>8} {'seconds':>8} {'messages/s':>11}")
+        try:
+            self.run("new", send_with_new_client, messages, options["threads"])
+            with override_settings(SENDGRID_API_KEY="benchmark", SENDGRID_API_HOST=server.url):
+                self.run("pooled", send_with_pooled_client, messages, options["threads"])
+                self.stdout.write(f"pool: {get_pool_stats()['sendgrid']}")
+
+                server.peak_concurrent = 0
+                with override_settings(PROVIDER_RATE_LIMITS={"sendgrid": {"rate": 1e6, "burst": 1e6}}):
+                    self.run("async", send_concurrently, messages)
+                self.stdout.write(f"async peak in flight: {server.peak_concurrent}")
+        finally:
+            server.stop()
+
+    def run(self, name, send, messages, threads=None):
+        start = time.perf_counter()
+        if threads:
+            with ThreadPoolExecutor(threads) as executor:
+                for _ in range(messages):
+                    executor.submit(send)
+        else:
+            send()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"{name:>8} {elapsed:>8.2f} {messages / elapsed:>11.0f}")
@@ -0,0 +1,68 @@
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from soukoapi.celery import app
+from main.task_registry import get_task_signature, is_in_flight
+
+TASK = "main.tasks.create_store_orders_metrics"
+
+
+def scan_queue(client, queue_name, task):
+    # What SmartScheduler used to do for every due entry
+    for message in client.lrange(queue_name, 0, -1):
+        if json.loads(message)["headers"]["task"] == task:
+            return True
+    return False
+
+
+def fill_queue(client, queue_name, depth, chunk_size=1000):
+    client.delete(queue_name)
+    for start in range(0, depth, chunk_size):
+        pipe = client.pipeline()
+        for _ in range(min(chunk_size, depth - start)):
+            pipe.lpush(queue_name, json.dumps({
+                "body": "",
+                "headers": {"task": "main.tasks.other_task", "id": uuid.uuid4().hex, "argsrepr": "()"},
+                "properties": {"delivery_tag": uuid.uuid4().hex}
+            }))
+        pipe.execute()
+
+
+class Command(BaseCommand):
+    help = "Measure the duplicate check cost of a beat tick against queue depth"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--depths", default="0,1000,10000,50000")
+        parser.add_argument("--entries", type=int, default=20, help="Due entries per tick")
+        parser.add_argument("--queue", default="benchmark_fetch_reports")
+
+    def handle(self, *args, **options):
+        depths = [int(depth) for depth in options["depths"].split(",")]
+        entries = [
+            get_task_signature(TASK, [str(uuid.uuid4())]) for _ in range(options["entries"])
+        ]
+        queue_name = options["queue"]
+
+        self.stdout.write(f"{'depth':>10} {'scan ms/tick':>14} {'registry ms/tick':>18}")
+        with app.pool.acquire(block=True) as conn:
+            client = conn.default_channel.client
+            try:
+                for depth in depths:
+                    fill_queue(client, queue_name, depth)
+
+                    start = time.perf_counter()
+                    for _ in entries:
+                        scan_queue(client, queue_name, TASK)
+                    scan = (time.perf_counter() - start) * 1000
+
+                    start = time.perf_counter()
+                    for signature in entries:
+                        is_in_flight(signature)
+                    registry = (time.perf_counter() - start) * 1000
+
+                    self.stdout.write(f"{depth:>10} {scan:>14.2f} {registry:>18.2f}")
+            finally:
+                client.delete(queue_name)
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import aiohttp
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from main.models import Store
+
+
+async def load(urls, requests, concurrency):
+    """Request ``urls`` in turn ``requests`` times, ``concurrency`` at a time"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+
+        async def request(url):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[ request(urls[index % len(urls)]) for index in range(requests) ])
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return (
+        requests / elapsed,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000,
+        errors,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare how the sync workers and the async storefront server hold up as more "
+        "anonymous storefront requests come at the same time. Start both servers first, "
+        "on the same database and cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sync-url", default="http://127.0.0.1:8000")
+        parser.add_argument("--async-url", default="http://127.0.0.1:8001")
+        parser.add_argument("--store", help="Id of the store, the first one by default")
+        parser.add_argument("--requests", type=int, default=2000, help="Requests per server and concurrency")
+        parser.add_argument("--concurrency", default="1,10,50,200", help="Requests in flight at the same time")
+
+    def handle(self, *args, **options):
+        store = Store.objects.filter(pk=options["store"]).first() if options["store"] else Store.objects.first()
+        if not store:
+            raise CommandError("No store to request")
+        paths = [
+            reverse("store_for_customers", kwargs={"pk": store.pk}),
+            reverse("store_products_for_customers", kwargs={"pk": store.pk}) + "?limit=20",
+        ]
+
+        loop = asyncio.get_event_loop()
+        self.stdout.write(f"{'server':>7} {'concurrency':>12} {'requests/s':>11} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+        for server in ("sync", "async"):
+            urls = [ options[f"{server}_url"].rstrip("/") + path for path in paths ]
+            # Fill the cache first
+            loop.run_until_complete(load(urls, len(urls), 1))
+            for concurrency in [ int(concurrency) for concurrency in options["concurrency"].split(",") ]:
+                rate, p50, p95, errors = loop.run_until_complete(load(urls, options["requests"], concurrency))
+                self.stdout.write(f"{server:>7} {concurrency:>12} {rate:>11.0f} {p50:>9.2f} {p95:>9.2f} {errors:>7}")
@@ -0,0 +1,91 @@
+import json
+import tempfile
+
+from django.apps import apps
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from main.images import get_stored_variants, get_variant_name
+from main.storage import copy_hashing, get_content_name, get_staging_storage
+
+# Image fields with their variants, by model
+IMAGE_FIELDS = (
+    ("main.Product", "product_picture_url"),
+    ("main.Store", "logo_url"),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rename the stored product pictures and store logos after the hash of their "
+        "content, like IMAGE_CONTENT_ADDRESSED does for new uploads, so rows with the "
+        "same image share one file and its variants."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only count the duplicates")
+        parser.add_argument("--delete", action="store_true", help="Delete the files no row uses anymore")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'field':<35} {'files':>7} {'renamed':>8} {'duplicates':>11} {'skipped':>8} {'dup MB':>9}")
+        for model, field_name in IMAGE_FIELDS:
+            counts = self.deduplicate(apps.get_model(model), field_name, options["dry_run"], options["delete"])
+            self.stdout.write(
+                f"{model + '.' + field_name:<35} {counts['files']:>7} {counts['renamed']:>8} "
+                f"{counts['duplicates']:>11} {counts['skipped']:>8} {counts['duplicate_bytes'] / 1024 / 1024:>9.1f}"
+            )
+
+    def deduplicate(self, model, field_name, dry_run, delete):
+        variants_field = model._meta.get_field(field_name).variants_field
+        names = model.objects.exclude( **{ field_name: "" } ).exclude( **{ f"{field_name}__isnull": True } ) \
+            .order_by(field_name).values_list(field_name, flat=True).distinct()
+        staging = get_staging_storage()
+        counts = { "files": 0, "renamed": 0, "duplicates": 0, "skipped": 0, "duplicate_bytes": 0 }
+        stored = set()
+
+        for name in names.iterator():
+            counts["files"] += 1
+            # Still waiting for create_image_variants, or gone
+            if staging.exists(name) or not default_storage.exists(name):
+                counts["skipped"] += 1
+                continue
+
+            with default_storage.open(name) as original, tempfile.TemporaryFile() as file:
+                target = get_content_name(name, copy_hashing(original, file))
+                if target == name:
+                    stored.add(name)
+                    continue
+
+                counts["renamed"] += 1
+                duplicate = target in stored or default_storage.exists(target)
+                if duplicate:
+                    counts["duplicates"] += 1
+                    counts["duplicate_bytes"] += default_storage.size(name)
+                stored.add(target)
+                if dry_run:
+                    continue
+                if not duplicate:
+                    file.seek(0)
+                    default_storage.save(target, File(file))
+
+            rows = model.objects.filter( **{ field_name: name } )
+            variants = json.loads(rows.values_list(variants_field, flat=True).first() or "{}")
+            renamed = {}
+            for variant, formats in variants.items():
+                for extension, variant_name in formats.items():
+                    renamed.setdefault(variant, {})[extension] = self.rename(
+                        variant_name, get_variant_name(target, variant, extension), delete
+                    )
+            rows.update(**{ field_name: target, variants_field: json.dumps(renamed or get_stored_variants(target)) })
+            if delete:
+                default_storage.delete(name)
+        return counts
+
+    def rename(self, name, target, delete):
+        if not default_storage.exists(target):
+            with default_storage.open(name) as file:
+                default_storage.save(target, file)
+        if delete:
+            default_storage.delete(name)
+        return target
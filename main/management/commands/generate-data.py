@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from main import data_generator
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate stores with their products, customers, orders, payments and "
+        "metrics for load tests. The same seed gives the same data, use another "
+        "one to add more to a database."
+    )
+
+    def add_arguments(self, parser):
+        defaults = data_generator.DEFAULTS
+        for name, default in defaults.items():
+            parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+
+    def handle(self, *args, **options):
+        config = { name: options[name] for name in data_generator.DEFAULTS }
+        stores = data_generator.generate(config, log=self.stdout.write)
+
+        self.stdout.write(f"{'owner':<40} {'orders':>10} {'customers':>10}")
+        for store in stores[:5]:
+            self.stdout.write(
+                f"{data_generator.get_owner_email(config['seed'], store.index):<40} "
+                f"{store.orders:>10} {store.customers:>10}"
+            )
+        self.stdout.write(f"Owners log in with the password {data_generator.PASSWORD}")
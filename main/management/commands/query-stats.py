@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import QueryStatsSnapshot
+from main.query_stats import ORDERS, TAGS_RE, QueryStatsUnavailable
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshot pg_stat_statements, or rank the statements by what they cost "
+        "since the latest snapshot or between two of them. Take one after each "
+        "deploy to find its hot queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--snapshot", action="store_true", help="Store the current statistics")
+        parser.add_argument("--label", default="", help="Label of the snapshot, e.g. the release")
+        parser.add_argument("--list", action="store_true", help="List the snapshots")
+        parser.add_argument("--before", help="Id or label of the snapshot to start from, the latest one by default")
+        parser.add_argument("--after", help="Id or label of the snapshot to end at, now by default")
+        parser.add_argument("--order", choices=ORDERS, default="total_time")
+        parser.add_argument("--limit", type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            if options["snapshot"]:
+                snapshot = QueryStatsSnapshot.objects.take(options["label"])
+                self.stdout.write(f"Snapshot {snapshot.pk} of {len(snapshot.get_statements())} statements")
+                return
+
+            if options["list"]:
+                for snapshot in QueryStatsSnapshot.objects.all():
+                    self.stdout.write(f"{snapshot.pk} {snapshot.created_at:%Y-%m-%d %H:%M:%S} {snapshot.label}")
+                return
+
+            before, after, statements = QueryStatsSnapshot.objects.report(
+                options["before"], options["after"], options["order"], options["limit"]
+            )
+        except (QueryStatsUnavailable, QueryStatsSnapshot.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        start = f"{before.created_at:%Y-%m-%d %H:%M:%S}" if before else "the last reset"
+        end = f"{after.created_at:%Y-%m-%d %H:%M:%S}" if after else "now"
+        self.stdout.write(f"From {start} to {end}")
+        self.stdout.write(
+            f"{'total ms':>12} {'calls':>9} {'mean ms':>9} {'rows':>9}  {'view':<45} {'model':<25} query"
+        )
+        for statement in statements:
+            # The tags are in their own columns
+            query = " ".join(TAGS_RE.sub("", statement["query"]).split())
+            self.stdout.write(
+                f"{statement['total_time']:>12.1f} {statement['calls']:>9} {statement['mean_time']:>9.2f} "
+                f"{statement['rows']:>9}  {statement['view'] or '-':<45} {statement['model'] or '-':<25} "
+                f"{query[:100]}"
+            )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from main.outbox import relay_outbox, run_relay
+
+
+class Command(BaseCommand):
+    help = "Publish the tasks stored in the outbox once their transaction committed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Publish what is in the outbox and exit")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            published = 0
+            while True:
+                batch = relay_outbox()
+                if not batch:
+                    break
+                published += batch
+            self.stdout.write(f"Published {published} outbox messages")
+            return
+
+        self.stdout.write("Relaying the outbox")
+        run_relay()
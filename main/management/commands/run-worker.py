@@ -1,16 +1,105 @@
-import shlex
+import atexit
+import os
+import signal
 import subprocess
+import sys
+import threading
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import autoreload
 
 
-def restart_celery():
-    subprocess.call(shlex.split("pkill celery"))
-    subprocess.call(shlex.split("celery -A soukoapi worker -l info"))
+def get_worker_command(name, pool, loglevel="info"):
+    """``celery worker`` arguments for a pool of ``WORKER_POOLS``"""
+    command = [
+        sys.executable, "-m", "celery", "-A", "soukoapi", "worker",
+        "-l", loglevel,
+        "-n", f"{name}@%h",
+        "-Q", ",".join(pool["queues"]),
+        # Hand tasks to idle processes only, so short ones don't wait behind long ones
+        "-O", "fair",
+    ]
+    if pool.get("autoscale"):
+        command.append("--autoscale={},{}".format(*pool["autoscale"]))
+    else:
+        command.append(f"--concurrency={pool['concurrency']}")
+    if pool.get("prefetch_multiplier"):
+        command.append(f"--prefetch-multiplier={pool['prefetch_multiplier']}")
+    if pool.get("max_tasks_per_child"):
+        command.append(f"--max-tasks-per-child={pool['max_tasks_per_child']}")
+    return command
+
+
+def get_worker_env(name, index):
+    """
+    Environment of the workers of a pool. When metrics are served, each pool
+    gets its own port and directory for the samples of its processes.
+    """
+    env = dict(os.environ)
+    if settings.WORKER_METRICS_PORT:
+        env["WORKER_METRICS_PORT"] = str(int(settings.WORKER_METRICS_PORT) + index)
+        directory = env.get("PROMETHEUS_MULTIPROC_DIR", "/tmp/souko-worker-metrics")
+        env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(directory, name)
+    return env
 
 
 class Command(BaseCommand):
+    help = "Start a celery worker for each pool of WORKER_POOLS"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pool", action="append", dest="pools",
+            help="Only start this pool, a single pool replaces this process"
+        )
+        parser.add_argument(
+            "--reload", action="store_true",
+            help="Restart the workers when the code changes, for development"
+        )
+        parser.add_argument("--loglevel", default="info")
+
     def handle(self, *args, **options):
-        print("Starting celery worker with autoreload")
-        autoreload.run_with_reloader(restart_celery)
+        pools = settings.WORKER_POOLS
+        names = options["pools"] or list(pools)
+        unknown = set(names) - set(pools)
+        if unknown:
+            raise CommandError(f"Unknown worker pools: {', '.join(sorted(unknown))}")
+
+        commands = [
+            # Ports follow the order of WORKER_POOLS, whichever pools are started
+            (get_worker_command(name, pools[name], options["loglevel"]), get_worker_env(name, list(pools).index(name)))
+            for name in names
+        ]
+
+        if options["reload"]:
+            self.stdout.write("Starting celery workers with autoreload")
+            autoreload.run_with_reloader(self.run_workers, commands)
+        elif len(commands) == 1:
+            command, env = commands[0]
+            os.execvpe(command[0], command, env)
+        else:
+            sys.exit(self.run_workers(commands))
+
+    def run_workers(self, commands):
+        """
+        Run the workers until one of them stops, then stop the others and
+        return its exit code so the process manager restarts everything.
+        """
+        processes = [ subprocess.Popen(command, env=env) for command, env in commands ]
+
+        def stop_workers(*args):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+
+        # The reloader exits this process on code changes, the workers go with it
+        atexit.register(stop_workers)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, stop_workers)
+            signal.signal(signal.SIGINT, stop_workers)
+
+        pid, status = os.wait()
+        stop_workers()
+        for process in processes:
+            process.wait()
+        return os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
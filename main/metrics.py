@@ -0,0 +1,185 @@
+"""
+Prometheus metrics of the API views and the Celery tasks.
+
+Gunicorn and Celery fork their worker processes, so when
+``PROMETHEUS_MULTIPROC_DIR`` is set each process writes its samples to files
+in that directory and the exposition adds them up. It has to be set before
+this module is imported: soukoapi/gunicorn_config.py does it for the web
+processes and run-worker for each pool of workers, whose main process serves
+the metrics on ``WORKER_METRICS_PORT``.
+
+The depth of the Celery queues is read from Redis when the metrics are
+scraped, with one ``LLEN`` per priority of each queue.
+"""
+import os
+import shutil
+import time
+
+from celery.signals import (
+    before_task_publish, task_failure, task_postrun, task_prerun, task_retry,
+    worker_init, worker_process_shutdown
+)
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest, multiprocess, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from soukoapi.celery import app
+
+from .performance import get_view_name
+
+TASK_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+REQUESTS = Counter(
+    'souko_http_requests_total', 'HTTP requests', ['view', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'souko_http_request_duration_seconds', 'HTTP request latency', ['view', 'method']
+)
+REQUEST_ERRORS = Counter(
+    'souko_http_request_errors_total', 'HTTP requests answered with a server error', ['view', 'method']
+)
+TASK_RUNTIME = Histogram(
+    'souko_celery_task_runtime_seconds', 'Celery task runtime', ['task', 'state'], buckets=TASK_BUCKETS
+)
+TASK_QUEUE_WAIT = Histogram(
+    'souko_celery_task_queue_wait_seconds', 'Time Celery tasks waited in their queue',
+    ['task'], buckets=TASK_BUCKETS
+)
+TASK_RETRIES = Counter('souko_celery_task_retries_total', 'Celery task retries', ['task'])
+TASK_FAILURES = Counter('souko_celery_task_failures_total', 'Celery task failures', ['task'])
+
+_started = {}
+
+
+def get_multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+def get_registry():
+    if not get_multiprocess_dir():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def get_queue_depths():
+    """Messages waiting in each queue of ``WORKER_POOLS``"""
+    queues = sorted({ queue for pool in settings.WORKER_POOLS.values() for queue in pool['queues'] })
+    with app.pool.acquire(block=True) as conn:
+        channel = conn.default_channel
+        pipe = channel.client.pipeline()
+        for queue in queues:
+            # Messages of each priority are in their own list
+            for priority in channel.priority_steps:
+                pipe.llen(channel._q_for_pri(queue, priority))
+        lengths = pipe.execute()
+
+    steps = len(channel.priority_steps)
+    return {
+        queue: sum(lengths[index * steps:(index + 1) * steps])
+        for index, queue in enumerate(queues)
+    }
+
+
+class QueueDepthCollector(object):
+
+    def collect(self):
+        gauge = GaugeMetricFamily('souko_celery_queue_depth', 'Messages waiting in each Celery queue', labels=['queue'])
+        if settings.REDIS_URL:
+            for queue, depth in get_queue_depths().items():
+                gauge.add_metric([queue], depth)
+        yield gauge
+
+
+queue_registry = CollectorRegistry(auto_describe=False)
+queue_registry.register(QueueDepthCollector())
+
+
+def metrics(request):
+    # Closed without a token, unless in development
+    if settings.METRICS_TOKEN:
+        if request.META.get('HTTP_AUTHORIZATION') != f'Bearer {settings.METRICS_TOKEN}':
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+    return HttpResponse(
+        generate_latest(get_registry()) + generate_latest(queue_registry),
+        content_type=CONTENT_TYPE_LATEST
+    )
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.metrics_view = 'unresolved'
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view, method = request.metrics_view, request.method
+        REQUESTS.labels(view, method, response.status_code).inc()
+        REQUEST_LATENCY.labels(view, method).observe(duration)
+        if response.status_code >= 500:
+            REQUEST_ERRORS.labels(view, method).inc()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = get_view_name(view_func)
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    # Read back as ``task.request.published_at`` by the worker
+    headers.setdefault('published_at', time.time())
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.monotonic()
+    published_at = task.request.get('published_at')
+    # Tasks with an ETA are meant to wait
+    if published_at and not task.request.eta:
+        TASK_QUEUE_WAIT.labels(task.name).observe(max(0.0, time.time() - published_at))
+
+
+@task_postrun.connect
+def record_task_runtime(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        TASK_RUNTIME.labels(task.name, state or 'UNKNOWN').observe(time.monotonic() - started)
+
+
+@task_retry.connect
+def record_task_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+@task_failure.connect
+def record_task_failure(sender=None, **kwargs):
+    TASK_FAILURES.labels(sender.name).inc()
+
+
+@worker_init.connect
+def serve_worker_metrics(**kwargs):
+    if not settings.WORKER_METRICS_PORT:
+        return
+    directory = get_multiprocess_dir()
+    if directory:
+        # Files of the processes of a previous run
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+    start_http_server(int(settings.WORKER_METRICS_PORT), registry=get_registry())
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    if get_multiprocess_dir():
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.5 on 2026-10-19 09:00
+
+from django.db import migrations
+from django.db.models import Count, F
+
+
+def dedupe_metrics(apps, schema_editor):
+    for model_name, field in (
+        ('OrdersTimestampedMetric', 'orders'),
+        ('ProfitTimestampedMetric', 'profit'),
+    ):
+        Metric = apps.get_model('main', model_name)
+        # Without the historical ordering, ('id',), which would be grouped by
+        duplicates = Metric.objects.order_by().values('store_id', 'date').annotate(
+            count=Count('id')
+        ).filter(count__gt=1)
+        for duplicate in duplicates:
+            rows = Metric.objects.filter(
+                store_id=duplicate['store_id'], date=duplicate['date']
+            ).order_by(F(field).desc(nulls_last=True), 'id')
+            # No timestamp tells the latest row apart, keep the highest value
+            # rather than a NULL profit
+            keep = rows.first()
+            rows.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0029_auto_20210705_0815'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_metrics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.5 on 2026-10-19 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0030_dedupe_timestamped_metrics'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='orderstimestampedmetric',
+            options={'ordering': ('date',)},
+        ),
+        migrations.AlterModelOptions(
+            name='profittimestampedmetric',
+            options={'ordering': ('date',)},
+        ),
+        # Unique constraints covering the metric value (Postgres 11+)
+        migrations.RunSQL(
+            sql='ALTER TABLE main_orderstimestampedmetric ADD CONSTRAINT main_ordersmetric_store_date_uniq UNIQUE (store_id, date) INCLUDE (orders)',
+            reverse_sql='ALTER TABLE main_orderstimestampedmetric DROP CONSTRAINT main_ordersmetric_store_date_uniq',
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='orderstimestampedmetric',
+                    constraint=models.UniqueConstraint(fields=('store', 'date'), name='main_ordersmetric_store_date_uniq'),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            sql='ALTER TABLE main_profittimestampedmetric ADD CONSTRAINT main_profitmetric_store_date_uniq UNIQUE (store_id, date) INCLUDE (profit)',
+            reverse_sql='ALTER TABLE main_profittimestampedmetric DROP CONSTRAINT main_profitmetric_store_date_uniq',
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='profittimestampedmetric',
+                    constraint=models.UniqueConstraint(fields=('store', 'date'), name='main_profitmetric_store_date_uniq'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 2.2.5 on 2026-10-19 11:00
+
+import json
+
+from django.db import migrations
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from main import constants
+
+STORE_TASKS = {
+    'Create stores orders metrics': 'main.tasks.create_store_orders_metrics',
+    'Create stores profit metrics': 'main.tasks.create_store_profit_metrics',
+}
+
+CRONTAB_FIELDS = ('minute', 'hour', 'day_of_week', 'day_of_month', 'month_of_year', 'timezone')
+
+
+def fan_out_store_metrics(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTasks = apps.get_model('django_celery_beat', 'PeriodicTasks')
+    CrontabSchedule = apps.get_model('django_celery_beat', 'CrontabSchedule')
+
+    # One entry per store is replaced by one fan out entry per task
+    PeriodicTask.objects.filter(task__in=STORE_TASKS.values()).delete()
+
+    # Point every task at the first of identical crontabs, then drop the others
+    duplicates = CrontabSchedule.objects.values(*CRONTAB_FIELDS).annotate(
+        count=Count('id'), keep=Min('id')
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        schedules = CrontabSchedule.objects.filter(
+            **{ field: duplicate[field] for field in CRONTAB_FIELDS }
+        ).exclude(pk=duplicate['keep'])
+        PeriodicTask.objects.filter(crontab__in=schedules).update(crontab_id=duplicate['keep'])
+        schedules.delete()
+
+    schedule = CrontabSchedule.objects.filter(
+        **constants.EVERY_FIVE_MINUTES
+    ).order_by('id').first() or CrontabSchedule.objects.create(**constants.EVERY_FIVE_MINUTES)
+
+    for name, task in STORE_TASKS.items():
+        PeriodicTask.objects.update_or_create(
+            name=name,
+            defaults={
+                'crontab': schedule,
+                'task': 'main.tasks.fan_out_store_task',
+                'args': json.dumps([task]),
+                'enabled': True,
+            }
+        )
+
+    # Let a running beat know the schedule changed
+    PeriodicTasks.objects.update_or_create(ident=1, defaults={'last_update': timezone.now()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0008_auto_20180914_1922'),
+        ('main', '0031_timestamped_metrics_store_date_uniq'),
+    ]
+
+    operations = [
+        migrations.RunPython(fan_out_store_metrics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0032_fan_out_store_metrics_schedules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailMessage',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='Email Message Id')),
+                ('template_id', models.CharField(max_length=255)),
+                ('tos', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('context', models.TextField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('SENDING', 'Sending'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='PENDING', max_length=20)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('batch_id', models.UUIDField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'email_messages',
+                'ordering': ('created_at',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['template_id', 'status', 'created_at'], name='main_emailm_templat_3f3239_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.5 on 2026-10-19 14:00
+
+from django.db import migrations, models
+import uuid
+
+# The extension needs its library in shared_preload_libraries (see
+# docker-compose.yml) and a superuser, skip it where it can't be created
+CREATE_PG_STAT_STATEMENTS = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
+    END IF;
+EXCEPTION WHEN insufficient_privilege THEN
+    RAISE NOTICE 'Not allowed to create pg_stat_statements';
+END
+$$;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0034_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryStatsSnapshot',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='Query Stats Snapshot Id')),
+                ('label', models.CharField(blank=True, max_length=255)),
+                ('statements', models.TextField(default='{}')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'query_stats_snapshots',
+                'ordering': ('created_at',),
+            },
+        ),
+        migrations.RunSQL(CREATE_PG_STAT_STATEMENTS, migrations.RunSQL.noop),
+    ]
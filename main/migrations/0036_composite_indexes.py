@@ -0,0 +1,49 @@
+# Generated by Django 2.2.5 on 2026-10-19 15:00
+
+from django.db import migrations, models
+
+from main.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('main', '0035_querystatssnapshot'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='customer',
+            index=models.Index(fields=['store', 'email'], name='main_customer_store_email_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='customer',
+            index=models.Index(fields=['store', 'phone_number'], name='main_customer_store_phone_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['store', 'confirmed', 'created_at'], name='main_order_store_confirmed_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['store', 'paid_on'], name='main_order_store_paid_on_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['store', 'payment_status'], name='main_order_store_payment_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='orderitem',
+            index=models.Index(fields=['product_stock', 'created_at'], name='main_orderitem_stock_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='orderitem',
+            index=models.Index(fields=['product', 'created_at'], name='main_orderitem_prod_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(fields=['store', 'is_active', 'created_at'], name='main_product_store_active_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.5 on 2026-10-19 16:00
+
+from django.db import migrations
+
+from main.operations import AddTrigramIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('main', '0036_composite_indexes'),
+    ]
+
+    operations = [
+        AddTrigramIndexConcurrently(
+            model_name='product',
+            field='name',
+            name='main_product_name_trgm',
+        ),
+        AddTrigramIndexConcurrently(
+            model_name='customer',
+            field='first_name',
+            name='main_customer_first_name_trgm',
+        ),
+        AddTrigramIndexConcurrently(
+            model_name='customer',
+            field='last_name',
+            name='main_customer_last_name_trgm',
+        ),
+        AddTrigramIndexConcurrently(
+            model_name='customer',
+            field='city',
+            name='main_customer_city_trgm',
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.2.5 on 2026-10-19 17:00
+
+from django.db import migrations, models
+
+from main.operations import AddIndexConcurrently, AddTrigramIndexConcurrently
+
+BATCH_SIZE = 10000
+
+
+def build_search_documents(apps, schema_editor):
+    # Batches of ids in order, each committed, to not lock every order at once
+    last_id = '00000000-0000-0000-0000-000000000000'
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                """
+                WITH batch AS (
+                    SELECT id FROM main_order WHERE id > %s ORDER BY id LIMIT %s
+                )
+                UPDATE main_order o
+                SET search_document = concat_ws(' ', o.number, NULLIF(c.first_name, ''), NULLIF(c.last_name, ''))
+                FROM batch, main_customer c
+                WHERE o.id = batch.id AND c.id = o.customer_id
+                RETURNING o.id
+                """,
+                [ last_id, BATCH_SIZE ]
+            )
+            ids = [ row[0] for row in cursor.fetchall() ]
+            if not ids:
+                break
+            last_id = max(ids)
+
+
+class Migration(migrations.Migration):
+    # The documents are built in batches and the indexes concurrently,
+    # outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('main', '0037_trigram_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(build_search_documents, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['number'], name='main_order_number_idx'),
+        ),
+        AddTrigramIndexConcurrently(
+            model_name='order',
+            field='search_document',
+            name='main_order_search_trgm',
+        ),
+    ]
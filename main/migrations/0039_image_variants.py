@@ -0,0 +1,34 @@
+# Generated by Django 2.2.5 on 2026-10-19 18:00
+
+from django.db import migrations, models
+import main.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0038_order_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='product_picture_variants',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='logo_variants',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='product_picture_url',
+            field=main.models.UniqueNameFileField(blank=True, null=True, upload_to='', variants_field='product_picture_variants'),
+        ),
+        migrations.AlterField(
+            model_name='store',
+            name='logo_url',
+            field=main.models.UniqueNameFileField(blank=True, null=True, upload_to='', variants_field='logo_variants'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.5 on 2026-10-19 19:00
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from main import constants
+
+
+def schedule_requeue_stale_emails(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTasks = apps.get_model('django_celery_beat', 'PeriodicTasks')
+    CrontabSchedule = apps.get_model('django_celery_beat', 'CrontabSchedule')
+
+    schedule = CrontabSchedule.objects.filter(
+        **constants.EVERY_FIVE_MINUTES
+    ).order_by('id').first() or CrontabSchedule.objects.create(**constants.EVERY_FIVE_MINUTES)
+    PeriodicTask.objects.update_or_create(
+        name='Requeue stale emails',
+        defaults={
+            'crontab': schedule,
+            'task': 'main.tasks.requeue_stale_emails',
+            'enabled': True,
+        }
+    )
+
+    # Let a running beat know the schedule changed
+    PeriodicTasks.objects.update_or_create(ident=1, defaults={'last_update': timezone.now()})
+
+
+def unschedule_requeue_stale_emails(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTask.objects.filter(name='Requeue stale emails').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0008_auto_20180914_1922'),
+        ('main', '0039_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(schedule_requeue_stale_emails, unschedule_requeue_stale_emails),
+    ]
@@ -12,13 +12,14 @@ from functools import reduce
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
 from django_celery_beat.managers import PeriodicTaskManager
 
-from django.db import models
+from django.db import models, connections, router
 from django.utils import timezone as dj_timezone
 from django.contrib.auth.models import BaseUserManager, AbstractUser
 from django.db.models import (
     Q,
     F,
     Sum,
+    Count,
     Value
 )
 from django.db.models.functions import (
@@ -31,13 +32,50 @@ from django_countries.fields import CountryField
 
 from .generators import generate_verification_code, generate_order_number
 from . import constants
+from .query_stats import fetch_statements, diff, rank
+from .db_router import reads_from_replica
+from .storage import staged_storage
 
 class UniqueNameFileField(models.ImageField):
+    """
+    Image saved under a new unique name. With ``variants_field``, uploads are
+    staged locally and the ``create_image_variants`` task moves them to the
+    default storage, saving the names of their variants in that field.
+    """
+
+    def __init__(self, *args, variants_field=None, **kwargs):
+        self.variants_field = variants_field
+        if variants_field:
+            kwargs.setdefault('storage', staged_storage)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.variants_field:
+            kwargs['variants_field'] = self.variants_field
+            if kwargs.get('storage') is staged_storage:
+                del kwargs['storage']
+        return name, path, args, kwargs
+
     def generate_filename(self, instance, filename):
         _, ext = os.path.splitext(filename)
         name = f"{uuid.uuid4().hex}{ext}"
         return super().generate_filename(instance, name)
 
+    def pre_save(self, model_instance, add):
+        file = getattr(model_instance, self.attname)
+        uploaded = bool(file) and not file._committed
+        file = super().pre_save(model_instance, add)
+        if uploaded and self.variants_field:
+            self.mark_staged(model_instance)
+        return file
+
+    def mark_staged(self, model_instance):
+        """Have ``create_image_variants`` process the staged image once ``model_instance`` is saved"""
+        # Declared after this field, so it is saved empty until the task runs
+        setattr(model_instance, self.variants_field, '')
+        model_instance.__dict__.setdefault('_staged_images', []).append(self.name)
+
 class UserManager(BaseUserManager):
     def _create_user(self, email, password, **extra_fields):
         """
@@ -251,7 +289,10 @@ class Store(models.Model):
         editable=False
     )
 
-    logo_url = UniqueNameFileField(blank=True, null=True)
+    logo_url = UniqueNameFileField(blank=True, null=True, variants_field='logo_variants')
+
+    # JSON names of the resized logos, see main.images
+    logo_variants = models.TextField(blank=True, default='', editable=False)
 
     name = models.CharField(
         verbose_name='Name',
@@ -307,6 +348,7 @@ class Store(models.Model):
         ordering = ('name',)
         verbose_name_plural = 'stores'
 
+    @reads_from_replica
     def get_profit_by_period( self, period=None ):
         if period not in [
             constants.LAST_WEEK,
@@ -350,6 +392,7 @@ class Store(models.Model):
         return sum(o.profit for o in orders)
 
 
+    @reads_from_replica
     def get_profit_report_by_period( self, period=None ):
         if period not in [
             constants.LAST_WEEK,
@@ -389,9 +432,11 @@ class Store(models.Model):
             queries
         ).order_by("date")
 
-        return metrics.values("date", "profit")
+        # Evaluated here, so that the read happens on the replica
+        return list( metrics.values("date", "profit") )
 
 
+    @reads_from_replica
     def get_orders_report_by_period( self, period=None ):
         if period not in [
             constants.LAST_WEEK,
@@ -430,8 +475,10 @@ class Store(models.Model):
             queries
         ).order_by("date")
 
-        return metrics.values("date", "orders")
+        # Evaluated here, so that the read happens on the replica
+        return list( metrics.values("date", "orders") )
 
+    @reads_from_replica
     def get_num_of_orders_report_by_period( self, period=None ):
         if period not in [
             constants.LAST_WEEK,
@@ -465,24 +512,14 @@ class Store(models.Model):
         if start and end:
             queries &= Q(created_at__range=[start, end])
 
-        all_orders = Order.objects.filter(
-            queries,
-            confirmed=True
-        ).order_by("created_at")
-
-        pending_orders = Order.objects.filter(
+        return Order.objects.filter(
             queries,
-            payment_status="PENDING",
             confirmed=True
-        ).order_by("created_at")
-
-        paid_orders = Order.objects.filter(
-            queries,
-            payment_status="PAID",
-            confirmed=True
-        ).order_by("created_at")
-
-        return { 'number_of_orders': all_orders.count(), 'number_of_pending_orders': pending_orders.count(), 'number_of_paid_orders': paid_orders.count() }
+        ).aggregate(
+            number_of_orders=Count("id"),
+            number_of_pending_orders=Count("id", filter=Q(payment_status="PENDING")),
+            number_of_paid_orders=Count("id", filter=Q(payment_status="PAID"))
+        )
 
     def get_low_products_stock( self ):
         products = Product.objects.filter(
@@ -495,6 +532,7 @@ class Store(models.Model):
 
         return low_stock_products
 
+    @reads_from_replica
     def get_best_selling_product_by_period( self, period=None ):
         if period not in [
             constants.LAST_WEEK,
@@ -648,7 +686,10 @@ class Product(models.Model):
         editable=False
     )
 
-    product_picture_url = UniqueNameFileField(blank=True, null=True)
+    product_picture_url = UniqueNameFileField(blank=True, null=True, variants_field='product_picture_variants')
+
+    # JSON names of the resized pictures, see main.images
+    product_picture_variants = models.TextField(blank=True, default='', editable=False)
 
     store = models.ForeignKey(
         Store,
@@ -697,6 +738,10 @@ class Product(models.Model):
     class Meta:
         ordering = ('created_at',)
         verbose_name_plural = 'products'
+        indexes = [
+            # Storefront
+            models.Index(fields=['store', 'is_active', 'created_at'], name='main_product_store_active_idx'),
+        ]
 
     @property
     def current_stock(self):
@@ -915,6 +960,11 @@ class Customer(models.Model):
     class Meta:
         ordering = ('created_at',)
         verbose_name_plural = 'customers'
+        indexes = [
+            # Checkout looks the customer up in the store
+            models.Index(fields=['store', 'email'], name='main_customer_store_email_idx'),
+            models.Index(fields=['store', 'phone_number'], name='main_customer_store_phone_idx'),
+        ]
 
     def get_ordered_products(self):
         return Product.objects.filter( order_items__order__customer__pk=self.pk ).distinct()
@@ -933,6 +983,32 @@ class Customer(models.Model):
         return f"{self.first_name} {self.last_name}"
 
 
+def get_search_names(customer):
+    return ' '.join( name for name in ( customer.first_name, customer.last_name ) if name )
+
+
+class OrderManager(models.Manager):
+    def update_search_documents(self, customer):
+        """Rebuild the search documents of the orders of a renamed customer"""
+        names = get_search_names(customer)
+        document = Concat( F('number'), Value(f' {names}') ) if names else F('number')
+        return self.filter( customer=customer ).exclude( search_document=document ).update( search_document=document )
+
+    def build_search_documents(self, store_id):
+        """Build the search documents of the orders of a store saved without one, e.g. bulk created"""
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {self.model._meta.db_table} o
+                SET search_document = concat_ws(' ', o.number, NULLIF(c.first_name, ''), NULLIF(c.last_name, ''))
+                FROM {Customer._meta.db_table} c
+                WHERE c.id = o.customer_id AND o.store_id = %s AND o.search_document = ''
+                """,
+                [ store_id ]
+            )
+            return cursor.rowcount
+
+
 class Order(models.Model):
     PAYMENT_STATUS = [
         ('PENDING', 'Not Paid'),
@@ -979,6 +1055,10 @@ class Order(models.Model):
 
     number = models.CharField(max_length=200, default=generate_order_number)
 
+    # Number and customer name, searched by the order lists instead of
+    # joining the customers
+    search_document = models.TextField( default='', blank=True, editable=False )
+
     created_at = models.DateTimeField(
         auto_now_add=True
     )
@@ -987,9 +1067,20 @@ class Order(models.Model):
         auto_now=True
     )
 
+    objects = OrderManager()
+
     class Meta:
         ordering = ('id',)
         verbose_name_plural = 'orders'
+        indexes = [
+            # Exact order number searches
+            models.Index(fields=['number'], name='main_order_number_idx'),
+            # Reports and lists of the orders of a store
+            models.Index(fields=['store', 'confirmed', 'created_at'], name='main_order_store_confirmed_idx'),
+            # Profit
+            models.Index(fields=['store', 'paid_on'], name='main_order_store_paid_on_idx'),
+            models.Index(fields=['store', 'payment_status'], name='main_order_store_payment_idx'),
+        ]
 
     @property
     def total_amount(self):
@@ -1022,6 +1113,19 @@ class Order(models.Model):
             ).get("num_of_products") 
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        # What the search document was built from, unless deferred
+        order._searched = ( order.__dict__.get('number'), order.__dict__.get('customer_id') )
+        return order
+
+    def save(self, *args, **kwargs):
+        if getattr(self, '_searched', None) != ( self.number, self.customer_id ):
+            self.search_document = ' '.join( part for part in ( self.number, get_search_names(self.customer) ) if part )
+            self._searched = ( self.number, self.customer_id )
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Order from {self.store.name} by {self.customer.first_name} {self.customer.last_name}"
 
@@ -1047,6 +1151,38 @@ class OrderConfirmationCode(models.Model):
         return f"Order Confirmation Code for { self.order.id }"
 
 
+class TimestampedMetricManager(models.Manager):
+    def upsert(self, rows, page_size=500):
+        """
+        Insert or update ``(store_id, date, value)`` rows with
+        ``INSERT ... ON CONFLICT (store_id, date) DO UPDATE``.
+        """
+        # A single statement can't touch the same row twice, keep the last value
+        values = {}
+        for store_id, date, value in rows:
+            values[(str(store_id), date)] = value
+
+        if not values:
+            return 0
+
+        field = self.model.METRIC_FIELD
+        table = self.model._meta.db_table
+        items = list(values.items())
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            for start in range(0, len(items), page_size):
+                page = items[start:start + page_size]
+                placeholders = ", ".join(["(%s, %s, %s, %s)"] * len(page))
+                params = []
+                for (store_id, date), value in page:
+                    params.extend([str(uuid.uuid4()), store_id, date, value])
+                cursor.execute(
+                    f"INSERT INTO {table} (id, store_id, date, {field}) VALUES {placeholders} "
+                    f"ON CONFLICT (store_id, date) DO UPDATE SET {field} = EXCLUDED.{field}",
+                    params
+                )
+        return len(values)
+
+
 class OrdersTimestampedMetric(models.Model):
     id = models.UUIDField(
         verbose_name='Order Metrics Id',
@@ -1065,49 +1201,32 @@ class OrdersTimestampedMetric(models.Model):
 
     date = models.DateField()
 
+    objects = TimestampedMetricManager()
+
+    METRIC_FIELD = 'orders'
+
     class Meta:
-        ordering = ('id',)
+        ordering = ('date',)
+        # The migration adds ``INCLUDE (orders)`` to this constraint so that
+        # reports are served by an index-only scan.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['store', 'date'],
+                name='main_ordersmetric_store_date_uniq'
+            )
+        ]
 
     def __str__(self):
         return f"Metric: {self.date}, {self.store.pk}"
 
 
-class StorePeriodicTaskManager(PeriodicTaskManager):
-    def schedule_create_store_orders_metrics(self, store):
-        schedule = CrontabSchedule.objects.create(
-            minute="*/5",
-            hour="*",
-            day_of_week="*",
-            day_of_month="*",
-            month_of_year="*"
-        )
-        obj, created = self.get_or_create(
-            store=store,
-            crontab=schedule,
-            name=f"Create store={store.id} orders report",
-            task="main.tasks.create_store_orders_metrics",
-            args=json.dumps([str(store.id)]),
-            enabled=True,
-        )
-        return obj
-
-    def schedule_create_store_profit_metrics(self, store):
-        schedule = CrontabSchedule.objects.create(
-            minute="*/5",
-            hour="*",
-            day_of_week="*",
-            day_of_month="*",
-            month_of_year="*"
-        )
-        obj, created = self.get_or_create(
-            store=store,
-            crontab=schedule,
-            name=f"Create store={store.id} profit report",
-            task="main.tasks.create_store_profit_metrics",
-            args=json.dumps([str(store.id)]),
-            enabled=True,
-        )
-        return obj
+def get_crontab_schedule(**fields):
+    """
+    Return the crontab row shared by every task on this schedule, creating
+    it the first time.
+    """
+    schedule = CrontabSchedule.objects.filter(**fields).order_by("id").first()
+    return schedule or CrontabSchedule.objects.create(**fields)
 
 
 class StorePeriodicTask(PeriodicTask):
@@ -1115,7 +1234,7 @@ class StorePeriodicTask(PeriodicTask):
         Store, on_delete=models.CASCADE, related_name="+", null=True, blank=True
     )
 
-    objects: StorePeriodicTaskManager = StorePeriodicTaskManager()
+    objects = PeriodicTaskManager()
 
 
 class ProfitTimestampedMetric(models.Model):
@@ -1136,8 +1255,20 @@ class ProfitTimestampedMetric(models.Model):
 
     date = models.DateField()
 
+    objects = TimestampedMetricManager()
+
+    METRIC_FIELD = 'profit'
+
     class Meta:
-        ordering = ('id',)
+        ordering = ('date',)
+        # The migration adds ``INCLUDE (profit)`` to this constraint so that
+        # reports are served by an index-only scan.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['store', 'date'],
+                name='main_profitmetric_store_date_uniq'
+            )
+        ]
 
     def __str__(self):
         return f"Metric: {self.date}, {self.store.pk}"
@@ -1184,6 +1315,11 @@ class OrderItem(models.Model):
     class Meta:
         ordering = ('id',)
         verbose_name_plural = 'order_items'
+        indexes = [
+            # Items ordered from a stock or of a product in a period
+            models.Index(fields=['product_stock', 'created_at'], name='main_orderitem_stock_date_idx'),
+            models.Index(fields=['product', 'created_at'], name='main_orderitem_prod_date_idx'),
+        ]
 
     @property
     def production_cost(self):
@@ -1244,3 +1380,176 @@ class Payment(models.Model):
     def __str__(self):
         return f"Payment of { self.order.pk } of {self.amount}"
 
+
+class EmailMessage(models.Model):
+    PENDING = 'PENDING'
+    SENDING = 'SENDING'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed')
+    ]
+
+    id = models.UUIDField(
+        verbose_name='Email Message Id',
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False
+    )
+
+    template_id = models.CharField(max_length=255)
+
+    # JSON list of recipients
+    tos = models.TextField()
+
+    subject = models.CharField(max_length=255)
+
+    # JSON template data
+    context = models.TextField()
+
+    status = models.CharField(
+        max_length=20,
+        choices=STATUSES,
+        default=PENDING
+    )
+
+    error = models.TextField(blank=True, null=True)
+
+    batch_id = models.UUIDField(blank=True, null=True)
+
+    # When a batch took it, see requeue_stale_emails
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    class Meta:
+        ordering = ('created_at',)
+        verbose_name_plural = 'email_messages'
+        indexes = [
+            models.Index(fields=['template_id', 'status', 'created_at'])
+        ]
+
+    @property
+    def personalization(self):
+        return ( json.loads(self.tos), self.subject, json.loads(self.context) )
+
+    def __str__(self):
+        return f"Email {self.subject} to {self.tos} ({self.status})"
+
+
+class OutboxMessageManager(models.Manager):
+    def enqueue(self, task, *args, **kwargs):
+        """
+        Store a call of ``task`` in the outbox. It is published by the relay
+        once the current transaction commits, or not at all if it rolls back.
+        """
+        message = self.create( task=task.name, args=json.dumps(args), kwargs=json.dumps(kwargs) )
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            # Delivered to the relay on commit
+            cursor.execute( f"NOTIFY {constants.OUTBOX_CHANNEL}" )
+        return message
+
+
+class OutboxMessage(models.Model):
+    id = models.UUIDField(
+        verbose_name='Outbox Message Id',
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False
+    )
+
+    task = models.CharField(max_length=255)
+
+    # JSON positional and keyword arguments of the task
+    args = models.TextField(default='[]')
+
+    kwargs = models.TextField(default='{}')
+
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True
+    )
+
+    objects = OutboxMessageManager()
+
+    class Meta:
+        ordering = ('created_at',)
+        verbose_name_plural = 'outbox_messages'
+
+
+class QueryStatsSnapshotManager(models.Manager):
+    def take(self, label='', using='default'):
+        """Store the current statistics of pg_stat_statements"""
+        return self.create( label=label, statements=json.dumps(fetch_statements(using)) )
+
+    def get_snapshot(self, reference):
+        """The snapshot with this id, or the latest one with this label"""
+        try:
+            return self.get( pk=uuid.UUID(reference) )
+        except ValueError:
+            snapshot = self.filter( label=reference ).last()
+            if not snapshot:
+                raise self.model.DoesNotExist(f"No snapshot {reference}")
+            return snapshot
+
+    def report(self, before=None, after=None, order='total_time', limit=20, using='default'):
+        """
+        Statements ranked by what they cost from the ``before`` snapshot to the
+        ``after`` one. Without ``after`` it is up to now, and without
+        ``before`` it starts from the snapshot preceding ``after``.
+        """
+        after = self.get_snapshot(after) if after else None
+        if before:
+            before = self.get_snapshot(before)
+        else:
+            snapshots = self.filter( created_at__lt=after.created_at ) if after else self.all()
+            before = snapshots.last()
+
+        statements = diff(
+            before.get_statements() if before else {},
+            after.get_statements() if after else fetch_statements(using)
+        )
+        return before, after, rank(statements, order, limit)
+
+
+class QueryStatsSnapshot(models.Model):
+    id = models.UUIDField(
+        verbose_name='Query Stats Snapshot Id',
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False
+    )
+
+    label = models.CharField(max_length=255, blank=True)
+
+    # JSON statistics of each statement, by query id
+    statements = models.TextField(default='{}')
+
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True
+    )
+
+    objects = QueryStatsSnapshotManager()
+
+    class Meta:
+        ordering = ('created_at',)
+        verbose_name_plural = 'query_stats_snapshots'
+
+    def get_statements(self):
+        return json.loads(self.statements)
+
+    def __str__(self):
+        return f"Query stats {self.label or self.id} of {self.created_at}"
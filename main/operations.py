@@ -0,0 +1,111 @@
+"""
+Migration operations for Postgres missing from Django 2.2.
+"""
+from django.db import DatabaseError
+from django.db.migrations.operations import AddIndex
+from django.db.migrations.operations.base import Operation
+
+
+def create_extension(schema_editor, name):
+    """Create the extension if this server has it, tell whether it is installed"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = %s", [ name ])
+        if cursor.fetchone():
+            return True
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = %s", [ name ])
+        if not cursor.fetchone():
+            return False
+    try:
+        schema_editor.execute(f"CREATE EXTENSION IF NOT EXISTS {schema_editor.quote_name(name)}")
+    except DatabaseError:
+        # Not trusted and we aren't a superuser
+        return False
+    return True
+
+
+def create_index_concurrently(schema_editor, name, statement):
+    """
+    Run ``statement``, a ``CREATE INDEX CONCURRENTLY`` of the index ``name``,
+    unless the index already exists
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [ name ])
+        row = cursor.fetchone()
+    if row and row[0]:
+        # Left invalid by a build that failed, e.g. on a duplicate
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY {schema_editor.quote_name(name)}")
+    elif row:
+        return
+    schema_editor.execute(statement)
+
+
+class AddIndexConcurrently(AddIndex):
+    """
+    ``AddIndex`` without locking the table against writes while the index is
+    built. Postgres can't build it in a transaction, so the migration needs
+    ``atomic = False``.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            statement = self.index.create_sql(model, schema_editor)
+            statement.template = statement.template.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+            create_index_concurrently(schema_editor, self.index.name, statement)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                f"DROP INDEX CONCURRENTLY IF EXISTS {schema_editor.quote_name(self.index.name)}"
+            )
+
+    def describe(self):
+        return f"Concurrently create index {self.index.name} on field(s) {', '.join(self.index.fields)} of model {self.model_name}"
+
+
+class AddTrigramIndexConcurrently(Operation):
+    """
+    GIN trigram index on ``UPPER(field)``, the expression of the case
+    insensitive lookups like ``icontains``, so ``LIKE '%term%'`` searches use
+    it. It is built like ``AddIndexConcurrently`` and skipped where the
+    pg_trgm extension can't be installed. Django 2.2 indexes can't hold
+    expressions, so it isn't part of the model state.
+    """
+    reduces_to_sql = False
+
+    def __init__(self, model_name, field, name):
+        self.model_name = model_name
+        self.field = field
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if not create_extension(schema_editor, 'pg_trgm'):
+            return
+        quote_name = schema_editor.quote_name
+        column = model._meta.get_field(self.field).column
+        create_index_concurrently(schema_editor, self.name, (
+            f"CREATE INDEX CONCURRENTLY {quote_name(self.name)} ON {quote_name(model._meta.db_table)} "
+            f"USING gin (UPPER({quote_name(column)}::text) gin_trgm_ops)"
+        ))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {schema_editor.quote_name(self.name)}")
+
+    def deconstruct(self):
+        return (
+            self.__class__.__qualname__,
+            [],
+            { 'model_name': self.model_name, 'field': self.field, 'name': self.name },
+        )
+
+    def describe(self):
+        return f"Concurrently create trigram index {self.name} on field {self.field} of model {self.model_name}"
@@ -0,0 +1,64 @@
+"""
+Relay of the transactional outbox.
+
+Request handlers don't publish tasks, they store them as OutboxMessage rows in
+their own transaction (``OutboxMessage.objects.enqueue``). The relay reads the
+committed rows in batches, publishes them over one broker connection and
+deletes them in the same transaction.
+
+A message is published with its row id as task id. If the relay dies after
+publishing but before committing, the batch is published again with the same
+ids, and tasks use them to ignore the duplicate.
+"""
+import json
+import select
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from soukoapi.celery import app
+
+from . import constants
+from .models import OutboxMessage
+
+
+def relay_outbox(batch_size=None):
+    """Publish a batch of outbox messages and return how many there were"""
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True).order_by(
+                "created_at"
+            )[:batch_size or settings.OUTBOX_BATCH_SIZE]
+        )
+        if not messages:
+            return 0
+
+        with app.producer_or_acquire() as producer:
+            for message in messages:
+                app.send_task(
+                    message.task,
+                    args=json.loads(message.args),
+                    kwargs=json.loads(message.kwargs),
+                    task_id=str(message.id),
+                    producer=producer
+                )
+        OutboxMessage.objects.filter(pk__in=[ message.pk for message in messages ]).delete()
+    return len(messages)
+
+
+def run_relay(poll_interval=None):
+    """
+    Relay the outbox forever, woken up by the NOTIFY of new messages and
+    checking at least every ``poll_interval`` seconds.
+    """
+    poll_interval = poll_interval or settings.OUTBOX_POLL_INTERVAL
+    with connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {constants.OUTBOX_CHANNEL}")
+    pg_connection = connection.connection
+
+    while True:
+        while relay_outbox():
+            pass
+        if select.select([pg_connection], [], [], poll_interval)[0]:
+            pg_connection.poll()
+            pg_connection.notifies.clear()
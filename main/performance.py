@@ -0,0 +1,136 @@
+"""
+Where the time of a request goes.
+
+``PerformanceMiddleware`` counts the SQL queries of each request and their
+time, the cache hits and misses (through the backends of ``main.cache``), the
+time spent in the view and the time spent serializing the response. It logs
+them as JSON on the ``main.performance`` logger, as a warning with the view
+name when the request made more than ``PERFORMANCE_QUERY_THRESHOLD`` queries.
+Staff users and a ``PERFORMANCE_SAMPLE_RATE`` fraction of requests also get
+them in a ``Server-Timing`` header.
+
+Queries made by other threads, like the dashboard sections, aren't counted.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.query_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.view_start = None
+        self.view_end = None
+        self.render_end = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # ``execute_wrapper`` of every connection
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+
+def get_request_stats():
+    """Stats of the request handled by this thread, if any"""
+    return getattr(_local, 'stats', None)
+
+
+def record_cache(hits, misses):
+    stats = get_request_stats()
+    if stats:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+def get_view_name(view_func):
+    view = getattr(view_func, 'view_class', view_func)
+    return f'{view.__module__}.{view.__qualname__}'
+
+
+class PerformanceMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = _local.stats = RequestStats()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        end = time.perf_counter()
+
+        view_end = stats.view_end or end
+        timings = {
+            'db': stats.query_time * 1000,
+            'view': (view_end - stats.view_start) * 1000 if stats.view_start else 0.0,
+            'serialize': ((stats.render_end or view_end) - view_end) * 1000,
+            'total': (end - start) * 1000,
+        }
+        self.log(request, response, stats, timings)
+
+        user = getattr(request, 'user', None)
+        if (user and user.is_staff) or random.random() < settings.PERFORMANCE_SAMPLE_RATE:
+            response['Server-Timing'] = self.get_server_timing(stats, timings)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = get_request_stats()
+        stats.view = get_view_name(view_func)
+        stats.view_start = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns
+        stats = get_request_stats()
+        stats.view_end = time.perf_counter()
+
+        def rendered(response):
+            stats.render_end = time.perf_counter()
+        response.add_post_render_callback(rendered)
+        return response
+
+    def get_server_timing(self, stats, timings):
+        return ', '.join([
+            f'db;dur={timings["db"]:.1f};desc="{stats.queries} queries"',
+            f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+            f'view;dur={timings["view"]:.1f}',
+            f'serialize;dur={timings["serialize"]:.1f}',
+            f'total;dur={timings["total"]:.1f}',
+        ])
+
+    def log(self, request, response, stats, timings):
+        too_many_queries = stats.queries > settings.PERFORMANCE_QUERY_THRESHOLD
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': stats.view,
+            'status': response.status_code,
+            'queries': stats.queries,
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+            'too_many_queries': too_many_queries,
+            **{ f'{name}_ms': round(value, 2) for name, value in timings.items() },
+        }
+        logger.log(logging.WARNING if too_many_queries else logging.INFO, json.dumps(record))
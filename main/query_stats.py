@@ -0,0 +1,162 @@
+"""
+Hot queries from ``pg_stat_statements``.
+
+When ``QUERY_TAGS`` is on, every query is sent with a trailing comment naming
+the view or the Celery task running it and the model of its first table,
+e.g. ``/*view='api.views.OrdersEndpoint',model='main.Order'*/``.
+``pg_stat_statements`` keeps one text per normalized statement, the one of its
+first call since the last reset, so the tags name the view that most likely
+issued it.
+
+Snapshots of the statistics are stored as ``QueryStatsSnapshot``; the
+``query-stats`` command and the staff-only ``/query-stats/`` view rank the
+statements by what they cost between two snapshots, or since one of them.
+"""
+import re
+import threading
+from functools import lru_cache
+
+from celery.signals import task_postrun, task_prerun
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .performance import get_request_stats
+
+ORDERS = ('total_time', 'calls', 'rows')
+
+TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"(\w+)"', re.IGNORECASE)
+TAGS_RE = re.compile(r"/\*((?:\w+='[^']*',?)+)\*/\s*$")
+TAG_RE = re.compile(r"(\w+)='([^']*)'")
+
+_local = threading.local()
+
+
+class QueryStatsUnavailable(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_table_models():
+    return { model._meta.db_table: model._meta.label for model in apps.get_models() }
+
+
+def get_query_source():
+    """The view or the task running on this thread"""
+    stats = get_request_stats()
+    return getattr(_local, 'task', None) or (stats and stats.view)
+
+
+def get_tags(sql):
+    tags = {}
+    source = get_query_source()
+    if source:
+        tags['view'] = source
+    match = TABLE_RE.search(sql)
+    if match and match.group(1) in get_table_models():
+        tags['model'] = get_table_models()[match.group(1)]
+    return tags
+
+
+def tag_query(execute, sql, params, many, context):
+    tags = get_tags(sql)
+    if tags:
+        sql = f"{sql} /*{','.join(f'{key}={value!r}' for key, value in tags.items())}*/"
+    return execute(sql, params, many, context)
+
+
+def parse_tags(query):
+    match = TAGS_RE.search(query)
+    return dict(TAG_RE.findall(match.group(1))) if match else {}
+
+
+@receiver(connection_created)
+def install_query_tags(connection=None, **kwargs):
+    if settings.QUERY_TAGS and connection.vendor == 'postgresql' and tag_query not in connection.execute_wrappers:
+        # First, as ``execute_wrapper()`` contexts open when the connection
+        # was created pop the last wrapper when they exit
+        connection.execute_wrappers.insert(0, tag_query)
+
+
+@task_prerun.connect
+def start_task_tags(task=None, **kwargs):
+    _local.task = task.name
+
+
+@task_postrun.connect
+def end_task_tags(**kwargs):
+    _local.task = None
+
+
+def fetch_statements(using='default'):
+    """
+    Cumulated statistics of the statements run on the database, by query id
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+        if not cursor.fetchone():
+            raise QueryStatsUnavailable(
+                "pg_stat_statements isn't installed, run CREATE EXTENSION pg_stat_statements"
+            )
+        try:
+            with transaction.atomic(using=using):
+                cursor.execute(
+                    "SELECT * FROM pg_stat_statements "
+                    "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())"
+                )
+                columns = [ column[0] for column in cursor.description ]
+                rows = [ dict(zip(columns, row)) for row in cursor.fetchall() ]
+        except DatabaseError as e:
+            # e.g. the library isn't in shared_preload_libraries
+            raise QueryStatsUnavailable(str(e).strip())
+
+    statements = {}
+    for row in rows:
+        # Postgres 13 split the planning time from the execution time
+        total_time = row['total_exec_time'] if 'total_exec_time' in row else row['total_time']
+        # The same statement run by other roles has its own row
+        statement = statements.setdefault(str(row['queryid']), {
+            'query': row['query'], 'calls': 0, 'total_time': 0.0, 'rows': 0
+        })
+        statement['calls'] += row['calls']
+        statement['total_time'] += total_time
+        statement['rows'] += row['rows']
+    return statements
+
+
+def diff(before, after):
+    """
+    What each statement of ``after`` cost since ``before``, both as returned by
+    ``fetch_statements``
+    """
+    statements = []
+    for queryid, statement in after.items():
+        previous = before.get(queryid)
+        # The statistics were reset in between
+        if previous and previous['calls'] > statement['calls']:
+            previous = None
+        calls = statement['calls'] - (previous['calls'] if previous else 0)
+        if calls <= 0:
+            continue
+        total_time = statement['total_time'] - (previous['total_time'] if previous else 0.0)
+        tags = parse_tags(statement['query'])
+        statements.append({
+            'queryid': queryid,
+            'query': statement['query'],
+            'view': tags.get('view'),
+            'model': tags.get('model'),
+            'calls': calls,
+            'total_time': total_time,
+            'mean_time': total_time / calls,
+            'rows': statement['rows'] - (previous['rows'] if previous else 0),
+        })
+    return statements
+
+
+def rank(statements, order='total_time', limit=20):
+    if order not in ORDERS:
+        raise ValueError(f"Rank by one of {', '.join(ORDERS)}")
+    return sorted(statements, key=lambda statement: statement[order], reverse=True)[:limit]
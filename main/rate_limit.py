@@ -0,0 +1,137 @@
+"""
+Rate limiting of the calls made to email and SMS providers, shared by every
+worker through Redis.
+
+Each provider has a token bucket refilled at ``rate`` requests per second up
+to ``burst`` tokens, configured in ``PROVIDER_RATE_LIMITS``. A call that finds
+the bucket empty is not made; the task is expected to retry once a token is
+available instead of sleeping in the worker.
+
+A circuit breaker stops calling a provider that keeps failing. After
+``CIRCUIT_BREAKER_THRESHOLD`` failures within ``CIRCUIT_BREAKER_WINDOW``
+seconds the circuit opens for ``CIRCUIT_BREAKER_COOLDOWN`` seconds, and every
+task of the provider is rescheduled after it. The circuit is then half-open
+for ``CIRCUIT_BREAKER_WINDOW`` seconds: the first failure opens it again, a
+success closes it.
+
+A provider that can't be reached or doesn't answer in time counts as a
+failure, like one answering with a rate limit or server error.
+"""
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import requests
+from django.conf import settings
+
+from soukoapi.celery import app
+
+BUCKET_KEY_PREFIX = "souko:bucket:"
+FAILURES_KEY_PREFIX = "souko:circuit-failures:"
+CIRCUIT_KEY_PREFIX = "souko:circuit-open:"
+HALF_OPEN_KEY_PREFIX = "souko:circuit-half-open:"
+
+# Raised by the provider clients when the provider is down or too slow
+TRANSPORT_ERRORS = ( requests.ConnectionError, requests.Timeout, aiohttp.ClientError )
+
+# Takes a token if there is one and returns the seconds until there is, or
+# until the circuit closes without taking one
+TAKE_TOKEN = """
+local open_for = redis.call('PTTL', KEYS[2])
+if open_for > 0 then
+    return tostring(open_for / 1000)
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class Throttled(Exception):
+    """The provider can't be called now, try again in ``retry_after`` seconds"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} throttled for {retry_after:.1f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class ProviderUnavailable(Throttled):
+    """The provider answered with a rate limit or server error"""
+
+
+@contextmanager
+def _redis():
+    with app.pool.acquire(block=True) as conn:
+        yield conn.default_channel.client
+
+
+def take(provider):
+    """
+    Take a token from the bucket of ``provider``, raise Throttled when the
+    circuit is open or the bucket is empty.
+    """
+    limit = settings.PROVIDER_RATE_LIMITS[provider]
+    with _redis() as client:
+        wait = client.eval(
+            TAKE_TOKEN, 2, f"{BUCKET_KEY_PREFIX}{provider}", f"{CIRCUIT_KEY_PREFIX}{provider}",
+            limit["rate"], limit["burst"], time.time()
+        )
+
+    if float(wait) > 0:
+        raise Throttled(provider, float(wait))
+
+
+def record_failure(provider):
+    key = f"{FAILURES_KEY_PREFIX}{provider}"
+    with _redis() as client:
+        pipe = client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, settings.CIRCUIT_BREAKER_WINDOW)
+        pipe.exists(f"{HALF_OPEN_KEY_PREFIX}{provider}")
+        failures, _, half_open = pipe.execute()
+        if failures >= settings.CIRCUIT_BREAKER_THRESHOLD or half_open:
+            pipe = client.pipeline()
+            pipe.set(f"{CIRCUIT_KEY_PREFIX}{provider}", failures, ex=settings.CIRCUIT_BREAKER_COOLDOWN)
+            # Outlives the failures, which expire during the cooldown
+            pipe.set(
+                f"{HALF_OPEN_KEY_PREFIX}{provider}", 1,
+                ex=settings.CIRCUIT_BREAKER_COOLDOWN + settings.CIRCUIT_BREAKER_WINDOW
+            )
+            pipe.execute()
+
+
+def record_success(provider):
+    with _redis() as client:
+        client.delete(f"{FAILURES_KEY_PREFIX}{provider}", f"{HALF_OPEN_KEY_PREFIX}{provider}")
+
+
+@contextmanager
+def provider_call(provider):
+    """
+    Wrap a call to ``provider`` so it is rate limited and its failures feed
+    the circuit breaker. Transport errors are raised as ProviderUnavailable.
+    """
+    take(provider)
+    try:
+        yield
+    except ProviderUnavailable:
+        record_failure(provider)
+        raise
+    except TRANSPORT_ERRORS as e:
+        record_failure(provider)
+        raise ProviderUnavailable(provider, settings.PROVIDER_RETRY_AFTER) from e
+    record_success(provider)
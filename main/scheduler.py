@@ -1,54 +1,72 @@
 # -*- coding: UTF-8 -*-
 from __future__ import unicode_literals
 
-import json
 from heapq import heappop, heappush
 
-from celery.beat import event_t
+from celery.beat import event_t, logger
 from celery.schedules import schedstate
+from django.conf import settings
 from django_celery_beat.schedulers import DatabaseScheduler
 
-from soukoapi.celery import app
+from .task_registry import (
+    get_task_signature,
+    mark_in_flight,
+    is_in_flight,
+    clear_in_flight,
+    get_queue_in_flight_count
+)
 
 
-def is_task_in_queue(task, queue_name=None):
-    queues = [queue_name] if queue_name else app.amqp.queues.keys()
-
-    for queue in queues:
-        if task in get_celery_queue_tasks(queue):
-            return True
-    return False
-
-
-def get_celery_queue_tasks(queue_name):
-    with app.pool.acquire(block=True) as conn:
-        tasks = conn.default_channel.client.lrange(queue_name, 0, -1)
-        decoded_tasks = []
-
-    for task in tasks:
-        j = json.loads(task)
-        task = j["headers"]["task"]
-        if task not in decoded_tasks:
-            decoded_tasks.append(task)
-    return decoded_tasks
+def get_entry_signature(entry):
+    return get_task_signature(entry.task, entry.args, entry.kwargs)
 
 
 class SmartScheduler(DatabaseScheduler):
     """
     Smart means that prevents duplicating of tasks in queues.
 
-    The aim is to execute tasks only once.
+    The aim is to execute tasks only once. Published tasks are tracked in the
+    in-flight registry by name and arguments until a worker finishes them, and
+    queues listed in ``SCHEDULER_QUEUE_CAPS`` never get more than their cap
+    of scheduled tasks in flight.
     """
 
+    def all_as_schedule(self):
+        # Same as DatabaseScheduler but without a query per entry for its schedule
+        s = {}
+        for model in self.Model.objects.enabled().select_related("crontab", "interval", "solar"):
+            try:
+                s[model.name] = self.Entry(model, app=self.app)
+            except ValueError:
+                pass
+        return s
+
+    def get_entry_queue(self, entry):
+        return self.app.amqp.router.route(
+            dict(entry.options), entry.task, entry.args, entry.kwargs
+        )["queue"].name
+
+    def is_queue_full(self, queue):
+        cap = settings.SCHEDULER_QUEUE_CAPS.get(queue)
+        return cap is not None and get_queue_in_flight_count(queue) >= cap
+
     def is_due(self, entry):
         is_due, next_time_to_run = entry.is_due()
 
-        if not is_due or not is_task_in_queue(  # duplicate wouldn't be created
-            entry.task
-        ):  # not in queue so let it run
+        if not is_due:
             return schedstate(is_due, next_time_to_run)
 
-        # Task should be run (is_due) and it is present in queue (is_task_in_queue)
+        if is_in_flight(get_entry_signature(entry)):
+            # Skip this run, the previous one hasn't finished yet
+            return self._requeue(entry, self.reserve, next_time_to_run)
+
+        if self.is_queue_full(self.get_entry_queue(entry)):
+            # Still due, try again once workers caught up
+            return self._requeue(entry, lambda entry: entry, self.max_interval)
+
+        return schedstate(is_due, next_time_to_run)
+
+    def _requeue(self, entry, get_next_entry, next_time_to_run):
         H = self._heap
 
         if not H:
@@ -57,7 +75,7 @@ class SmartScheduler(DatabaseScheduler):
         event = H[0]
         verify = heappop(H)
         if verify is event:
-            next_entry = self.reserve(entry)
+            next_entry = get_next_entry(entry)
             heappush(
                 H,
                 event_t(self._when(next_entry, next_time_to_run), event[1], next_entry),
@@ -66,3 +84,29 @@ class SmartScheduler(DatabaseScheduler):
             heappush(H, verify)
             next_time_to_run = min(verify[0], next_time_to_run)
         return schedstate(False, min(next_time_to_run, self.max_interval))
+
+    def apply_entry(self, entry, producer=None):
+        # Same as Scheduler.apply_entry, which expects a published task
+        logger.info('Scheduler: Sending due task %s (%s)', entry.name, entry.task)
+        try:
+            result = self.apply_async(entry, producer=producer, advance=False)
+        except Exception as exc:
+            logger.error('Message Error: %s', exc, exc_info=True)
+            return
+        if result is None:
+            logger.info('Scheduler: %s is already in flight, not sent', entry.name)
+        else:
+            logger.debug('%s sent. id->%s', entry.task, result.id)
+
+    def apply_async(self, entry, producer=None, advance=True, **kwargs):
+        """Publish the entry, None when the same task is already in flight"""
+        # Registered before publishing so a fast worker can't clear it first.
+        # Another beat or a fan out may have claimed it since is_due.
+        signature = get_entry_signature(entry)
+        if not mark_in_flight(signature, self.get_entry_queue(entry)):
+            return None
+        try:
+            return super().apply_async(entry, producer=producer, advance=advance, **kwargs)
+        except Exception:
+            clear_in_flight(signature)
+            raise
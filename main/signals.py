@@ -8,12 +8,15 @@ from django_rest_passwordreset.signals import reset_password_token_created
 
 from main.tasks import (
     send_email_async,
+    create_image_variants,
 )
 from .models import (
+    OutboxMessage,
     Store,
     StoreSubscription,
+    Customer,
     Order,
-    StorePeriodicTask
+    Product
 )
 
 @receiver(reset_password_token_created)
@@ -22,7 +25,8 @@ def password_reset_token_created(
 ):
     user = reset_password_token.user
     reset_password_url = f"account/auth/forgot-password/reset-password?token={reset_password_token.key}&email={reset_password_token.user.email}"
-    emailer = send_email_async.delay(
+    OutboxMessage.objects.enqueue(
+        send_email_async,
         template_id=settings.TEMPLATE_EMAIL_WITH_URL_ID,
         tos=[reset_password_token.user.email],
         subject='Souko - Reset Password',
@@ -36,9 +40,29 @@ def password_reset_token_created(
     )
 
 
+def enqueue_image_variants( instance ):
+    # Set by UniqueNameFileField on a new upload
+    for field_name in instance.__dict__.pop( '_staged_images', [] ):
+        OutboxMessage.objects.enqueue(
+            create_image_variants, instance._meta.label, str( instance.pk ), field_name
+        )
+
+
 @receiver(post_save, sender=Store)
 def store_created( sender, instance, created, **kwargs ):
     if created:
-        StorePeriodicTask.objects.schedule_create_store_orders_metrics( instance )
-        StorePeriodicTask.objects.schedule_create_store_profit_metrics( instance )
+        # Metrics are scheduled for every store by the fan out tasks
         StoreSubscription.objects.create(store=instance)
+    enqueue_image_variants( instance )
+
+
+@receiver(post_save, sender=Product)
+def product_saved( sender, instance, created, **kwargs ):
+    enqueue_image_variants( instance )
+
+
+@receiver(post_save, sender=Customer)
+def customer_saved( sender, instance, created, **kwargs ):
+    if not created:
+        # The name may have changed
+        Order.objects.update_search_documents(instance)
@@ -0,0 +1,112 @@
+"""
+Storage of the uploaded images.
+
+``StagedStorage`` writes uploads to a local directory, ``IMAGE_STAGING_ROOT``,
+instead of the default storage (S3), so a request doesn't wait on the upload.
+The ``create_image_variants`` task then moves them to the default storage
+along with their resized variants. Their url is the one of the default
+storage from the start.
+
+The web and worker processes must share ``IMAGE_STAGING_ROOT``, e.g. a
+volume mounted in both containers, or the workers don't find the uploads.
+It has no default outside ``DEBUG``.
+
+With ``IMAGE_CONTENT_ADDRESSED``, an upload is named after the SHA-256 of its
+content, hashed while it is streamed to the staging directory. The same image
+uploaded again reuses the stored file and its variants instead of being
+uploaded once more, so stored files may be shared by many rows and are never
+deleted with one of them.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.checks import Error, register
+from django.core.files.storage import FileSystemStorage, Storage, default_storage
+from django.utils.deconstruct import deconstructible
+
+
+def get_staging_storage():
+    return FileSystemStorage(location=settings.IMAGE_STAGING_ROOT)
+
+
+@register()
+def check_staging_root(app_configs, **kwargs):
+    if settings.IMAGE_STAGING_ROOT:
+        return []
+    return [ Error(
+        "IMAGE_STAGING_ROOT isn't set.",
+        hint="Set it to a directory shared by the web and worker processes, see main.storage.",
+        id="main.E001",
+    ) ]
+
+
+def copy_hashing(content, file):
+    """Copy ``content`` to ``file`` by chunks, returning the SHA-256 of the content"""
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+        file.write(chunk)
+    return digest.hexdigest()
+
+
+def get_content_name(name, digest):
+    """``name`` with its file name replaced by the hash of its content"""
+    _, extension = os.path.splitext(name)
+    return os.path.join(os.path.dirname(name), f"{digest}{extension.lower()}")
+
+
+@deconstructible
+class StagedStorage(Storage):
+
+    def _open(self, name, mode='rb'):
+        staging = get_staging_storage()
+        if staging.exists(name):
+            return staging.open(name, mode)
+        return default_storage.open(name, mode)
+
+    def _save(self, name, content):
+        if settings.IMAGE_CONTENT_ADDRESSED:
+            return self._save_by_content(name, content)
+        return get_staging_storage().save(name, content)
+
+    def _save_by_content(self, name, content):
+        staging = get_staging_storage()
+        os.makedirs(staging.location, exist_ok=True)
+        # In the staging directory, so it is moved rather than copied
+        with tempfile.NamedTemporaryFile(dir=staging.location, suffix='.upload', delete=False) as file:
+            name = get_content_name(name, copy_hashing(content, file))
+        if self.exists(name):
+            os.remove(file.name)
+            return name
+
+        path = staging.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(file.name, settings.FILE_UPLOAD_PERMISSIONS)
+        os.replace(file.name, path)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Names are unique, only check the local directory
+        return get_staging_storage().get_available_name(name, max_length=max_length)
+
+    def exists(self, name):
+        return get_staging_storage().exists(name) or default_storage.exists(name)
+
+    def delete(self, name):
+        get_staging_storage().delete(name)
+        default_storage.delete(name)
+
+    def size(self, name):
+        staging = get_staging_storage()
+        if staging.exists(name):
+            return staging.size(name)
+        return default_storage.size(name)
+
+    def url(self, name):
+        return default_storage.url(name)
+
+
+staged_storage = StagedStorage()
@@ -0,0 +1,102 @@
+"""
+Registry of the tasks published by the beat scheduler that haven't finished.
+
+Each in-flight task is a Redis key named after the task signature (name and
+arguments), so checking for a duplicate is a single EXISTS instead of a scan
+of every queue. Keys expire after ``SCHEDULER_INFLIGHT_TTL`` seconds so a task
+lost with its worker can't hold back its schedule forever.
+
+Signatures are also kept per queue in a sorted set scored by their expiry,
+which gives the scheduler the number of tasks in flight on a queue.
+"""
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+
+from celery import states
+from celery.signals import task_postrun, task_revoked
+from django.conf import settings
+
+from soukoapi.celery import app
+
+KEY_PREFIX = "souko:inflight:"
+QUEUE_KEY_PREFIX = "souko:inflight-queue:"
+
+
+def get_task_signature(task, args=None, kwargs=None):
+    """
+    Task name plus a hash of the canonical JSON form of its arguments, so
+    ``(store_id,)`` and ``[store_id]`` or reordered kwargs give the same key.
+    """
+    canonical = json.dumps(
+        {"args": list(args or []), "kwargs": kwargs or {}},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str
+    )
+    return f"{task}:{hashlib.sha1(canonical.encode()).hexdigest()}"
+
+
+def _get_key(signature):
+    return f"{KEY_PREFIX}{signature}"
+
+
+def _get_queue_key(queue):
+    return f"{QUEUE_KEY_PREFIX}{queue}"
+
+
+@contextmanager
+def _redis():
+    with app.pool.acquire(block=True) as conn:
+        yield conn.default_channel.client
+
+
+def mark_in_flight(signature, queue=None):
+    ttl = settings.SCHEDULER_INFLIGHT_TTL
+    with _redis() as client:
+        if not client.set(_get_key(signature), queue or "", nx=True, ex=ttl):
+            return False
+        if queue:
+            client.zadd(_get_queue_key(queue), {signature: time.time() + ttl})
+        return True
+
+
+def is_in_flight(signature):
+    with _redis() as client:
+        return bool(client.exists(_get_key(signature)))
+
+
+def clear_in_flight(signature):
+    key = _get_key(signature)
+    with _redis() as client:
+        pipe = client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        queue, _ = pipe.execute()
+        if queue:
+            client.zrem(_get_queue_key(queue.decode()), signature)
+
+
+def get_queue_in_flight_count(queue):
+    key = _get_queue_key(queue)
+    with _redis() as client:
+        pipe = client.pipeline()
+        # Forget the tasks whose key already expired
+        pipe.zremrangebyscore(key, "-inf", time.time())
+        pipe.zcard(key)
+        _, count = pipe.execute()
+        return count
+
+
+@task_postrun.connect
+def clear_finished_task(sender=None, args=None, kwargs=None, state=None, **extra):
+    # A retried task is still in flight
+    if state == states.RETRY:
+        return
+    clear_in_flight(get_task_signature(sender.name, args, kwargs))
+
+
+@task_revoked.connect
+def clear_revoked_task(sender=None, request=None, **extra):
+    clear_in_flight(get_task_signature(sender.name, request.args, request.kwargs))
@@ -1,16 +1,41 @@
+import io
+import json
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from dateutil.relativedelta import relativedelta
 from django.utils import timezone as dj_timezone
 from soukoapi.celery import app
 from celery import shared_task, Task
 
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
 from .utils.mail.emailer import (
-    Emailer
+    Emailer,
+    EmailRejected
+)
+from .utils.sms.sender import send, get_request as get_sms_request
+from .utils.async_sender import send_all, ProviderRejected
+from .rate_limit import provider_call, Throttled, ProviderUnavailable
+from .task_registry import (
+    get_task_signature,
+    mark_in_flight,
+    get_queue_in_flight_count
 )
-from .utils.sms.sender import send
+from .images import get_stored_variants, render_variants
+from .storage import get_staging_storage
 from . import models
 
+logger = logging.getLogger(__name__)
+
 @shared_task(
     bind=True,
     retry_backoff=True,
@@ -24,20 +49,175 @@ def send_email_async(
     context,
     index
 ):
-    Emailer( template_id, tos, subject, context, index ).send()
+    # Sent with the other emails of the template by send_email_batch. The
+    # task id keeps an outbox message published twice from being sent twice
+    models.EmailMessage.objects.get_or_create(
+        pk=self.request.id or uuid.uuid4(),
+        defaults={
+            'template_id': template_id,
+            'tos': json.dumps(tos),
+            'subject': subject,
+            'context': json.dumps(context)
+        }
+    )
+    schedule_email_batch(template_id)
 
 
-@shared_task(
-    bind=True,
-    retry_backoff=True,
-    retry_kwargs={"max_retries": 3},
-)
+def schedule_email_batch(template_id):
+    # One batch per template and window, however many emails arrive
+    if cache.add(f"email-batch-scheduled:{template_id}", 1, settings.EMAIL_BATCH_WINDOW):
+        send_email_batch.apply_async((template_id,), countdown=settings.EMAIL_BATCH_WINDOW)
+
+
+def chunk_by_recipients(messages, limit):
+    chunk, recipients = [], 0
+    for message in messages:
+        tos = len(message.personalization[0])
+        if chunk and recipients + tos > limit:
+            yield chunk
+            chunk, recipients = [], 0
+        chunk.append(message)
+        recipients += tos
+    if chunk:
+        yield chunk
+
+
+def send_email_chunk(template_id, messages):
+    """
+    Send the messages in one request and record the outcome of each. When
+    SendGrid rejects a batch the messages are sent one by one to find out
+    which recipients were refused.
+    """
+    pks = [ message.pk for message in messages ]
+    try:
+        with provider_call('sendgrid'):
+            Emailer.for_batch( template_id, [ message.personalization for message in messages ] ).send()
+    except EmailRejected as e:
+        if len(messages) > 1:
+            for message in messages:
+                send_email_chunk( template_id, [message] )
+            return
+        models.EmailMessage.objects.filter(pk__in=pks).update(
+            status=models.EmailMessage.FAILED, error=str(e)
+        )
+        return
+    models.EmailMessage.objects.filter(pk__in=pks).update(
+        status=models.EmailMessage.SENT, sent_at=dj_timezone.now()
+    )
+
+
+def send_email_chunks(template_id, chunks):
+    """
+    Send the chunks concurrently. Rejected chunks go through send_email_chunk
+    to find the refused recipients, Throttled is raised when some chunks
+    couldn't be sent now.
+    """
+    results = send_all([
+        Emailer.for_batch( template_id, [ message.personalization for message in chunk ] ).get_request()
+        for chunk in chunks
+    ])
+    sent, rejected, throttled = [], [], None
+    for chunk, error in zip(chunks, results):
+        if error is None:
+            sent.extend( message.pk for message in chunk )
+        elif isinstance(error, ProviderRejected):
+            rejected.append(chunk)
+        else:
+            throttled = error
+    # Before anything else can fail, or the batch would send them again
+    models.EmailMessage.objects.filter(pk__in=sent).update(
+        status=models.EmailMessage.SENT, sent_at=dj_timezone.now()
+    )
+    for chunk in rejected:
+        try:
+            send_email_chunk( template_id, chunk )
+        except Throttled as e:
+            throttled = e
+    if throttled:
+        raise throttled
+
+
+@shared_task(bind=True, max_retries=None)
+def send_email_batch(self, template_id):
+    limit = settings.SENDGRID_MAX_PERSONALIZATIONS
+    while True:
+        batch_id = uuid.uuid4()
+        with transaction.atomic():
+            messages = list(
+                models.EmailMessage.objects.select_for_update(skip_locked=True).filter(
+                    template_id=template_id, status=models.EmailMessage.PENDING
+                )[:limit * settings.EMAIL_BATCH_REQUESTS]
+            )
+            if not messages:
+                return
+            models.EmailMessage.objects.filter(pk__in=[ m.pk for m in messages ]).update(
+                status=models.EmailMessage.SENDING, batch_id=batch_id, claimed_at=dj_timezone.now()
+            )
+
+        try:
+            send_email_chunks(template_id, list(chunk_by_recipients(messages, limit)))
+        except Exception as e:
+            # Whatever wasn't sent goes back to the pending emails
+            models.EmailMessage.objects.filter(
+                batch_id=batch_id, status=models.EmailMessage.SENDING
+            ).update(status=models.EmailMessage.PENDING)
+            countdown = e.retry_after if isinstance(e, Throttled) else settings.EMAIL_BATCH_WINDOW
+            raise self.retry(exc=e, countdown=countdown)
+
+
+@shared_task(bind=True)
+def requeue_stale_emails(self):
+    """
+    Put back the emails a batch took more than ``EMAIL_SENDING_TIMEOUT``
+    seconds ago without an outcome, its worker died, and schedule a batch for
+    their templates. Those SendGrid took before the worker died are sent twice.
+    """
+    stale = models.EmailMessage.objects.filter(
+        status=models.EmailMessage.SENDING,
+        claimed_at__lt=dj_timezone.now() - timedelta(seconds=settings.EMAIL_SENDING_TIMEOUT)
+    )
+    template_ids = set(stale.values_list('template_id', flat=True))
+    stale.update(status=models.EmailMessage.PENDING)
+    for template_id in template_ids:
+        schedule_email_batch(template_id)
+
+
+@shared_task(bind=True, max_retries=None)
 def send_sms_async(
     self,
     body,
-    to
+    to,
+    failures=0
 ):
-    send( body, to )
+    """
+    Send an SMS. It is tried again after the provider failed, waiting twice
+    as long each time, up to ``NOTIFICATIONS_RETRIES`` times, ``failures``
+    so far. Throttled calls are only rescheduled.
+    """
+    try:
+        with provider_call('twilio'):
+            send( body, to )
+    except ProviderUnavailable as e:
+        if failures >= settings.NOTIFICATIONS_RETRIES:
+            raise
+        raise self.retry(args=[body, to], kwargs={"failures": failures + 1}, exc=e, countdown=e.retry_after * 2 ** failures)
+    except Throttled as e:
+        # Rescheduled rather than waiting in the worker
+        raise self.retry(exc=e, countdown=e.retry_after)
+
+
+@shared_task(bind=True)
+def send_sms_bulk(self, messages):
+    """
+    Send ``[body, to]`` messages concurrently. Those the provider couldn't
+    take now are sent again one by one by send_sms_async.
+    """
+    results = send_all([ get_sms_request( body, to ) for body, to in messages ])
+    for ( body, to ), error in zip(messages, results):
+        if isinstance(error, Throttled):
+            send_sms_async.apply_async(( body, to ), countdown=error.retry_after)
+        elif error:
+            logger.error(f"Can't send an SMS to {to}: {error}")
 
 
 @shared_task(bind=True)
@@ -45,11 +225,8 @@ def create_store_orders_metrics(self, store_id):
     try:
         store = models.Store.objects.get(pk=store_id)
         today = dj_timezone.now().date()
-        timestamped_metric, _ = models.OrdersTimestampedMetric.objects.get_or_create(
-            date=today, store=store
-        )
-        timestamped_metric.orders = store.orders.filter(created_at__year=today.year, created_at__month=today.month, created_at__day=today.day, confirmed=True).count()
-        timestamped_metric.save()
+        orders = store.orders.filter(created_at__year=today.year, created_at__month=today.month, created_at__day=today.day, confirmed=True).count()
+        models.OrdersTimestampedMetric.objects.upsert([ (store.id, today, orders) ])
     except ObjectDoesNotExist:
         pass
     except Exception as e:
@@ -61,15 +238,97 @@ def create_store_profit_metrics(self, store_id):
     try:
         store = models.Store.objects.get(pk=store_id)
         today = dj_timezone.now().date()
-        timestamped_metric, _ = models.ProfitTimestampedMetric.objects.get_or_create(
-            date=today, store=store
-        )
         orders = store.orders.filter(paid_on__year=today.year, paid_on__month=today.month, paid_on__day=today.day, confirmed=True)
-        timestamped_metric.profit = float( sum(o.profit for o in orders) )
-        timestamped_metric.save()
+        profit = float( sum(o.profit for o in orders) )
+        models.ProfitTimestampedMetric.objects.upsert([ (store.id, today, profit) ])
     except ObjectDoesNotExist:
         pass
     except Exception as e:
         print( str(e) )
 
 
+@shared_task(bind=True, max_retries=None)
+def fan_out_store_task(self, task_name, cursor=None):
+    """
+    Publish ``task_name`` once for every store, skipping the stores whose
+    previous run is still in flight. When the queue reaches its cap the
+    fan out retries later from the last store it published, ``cursor``.
+    """
+    task = app.tasks[task_name]
+    queue = app.amqp.router.route({}, task_name)["queue"].name
+    cap = settings.SCHEDULER_QUEUE_CAPS.get(queue)
+
+    stores = models.Store.objects.order_by("id").values_list("id", flat=True)
+    if cursor:
+        stores = stores.filter(id__gt=cursor)
+
+    in_flight = get_queue_in_flight_count(queue) if cap else 0
+    for store_id in stores.iterator():
+        if cap and in_flight >= cap:
+            # In the retried message, so any worker carries on from there
+            raise self.retry(args=[task_name], kwargs={"cursor": cursor}, countdown=settings.FAN_OUT_RETRY_DELAY)
+
+        args = [str(store_id)]
+        if mark_in_flight(get_task_signature(task_name, args), queue):
+            task.apply_async(args)
+            in_flight += 1
+        cursor = str(store_id)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def create_image_variants(self, model, pk, field_name):
+    """
+    Move an image staged by its ``UniqueNameFileField`` to the default
+    storage along with its resized variants, uploading
+    ``IMAGE_UPLOAD_WORKERS`` files at a time.
+
+    Retried when the image is neither staged nor stored, which happens when
+    the worker doesn't share ``IMAGE_STAGING_ROOT`` with the web.
+    """
+    model = apps.get_model(model)
+    variants_field = model._meta.get_field(field_name).variants_field
+    name = model.objects.filter(pk=pk).values_list(field_name, flat=True).first()
+    if not name:
+        return
+    staging = get_staging_storage()
+    try:
+        with staging.open(name) as staged:
+            files = { name: staged.read() }
+    except FileNotFoundError:
+        if not default_storage.exists(name):
+            logger.error(f"{name} isn't in {staging.location}, is IMAGE_STAGING_ROOT shared with the web?")
+            raise self.retry()
+        # Moved by another task. A content addressed image may be the one of
+        # other rows, stored with its variants already.
+        if settings.IMAGE_CONTENT_ADDRESSED:
+            model.objects.filter( pk=pk, **{ field_name: name, variants_field: '' } ).update(**{
+                variants_field: json.dumps(get_stored_variants(name)),
+            })
+        return
+
+    variants = {}
+    try:
+        for (variant, extension), variant_name, content in render_variants(name, io.BytesIO(files[name])):
+            files[variant_name] = content
+            variants.setdefault(variant, {})[extension] = variant_name
+    except OSError:
+        logger.exception(f"Can't resize {name}, only the original is kept")
+
+    def store(item):
+        file_name, content = item
+        # The same content, stored by the task of another row
+        if settings.IMAGE_CONTENT_ADDRESSED and default_storage.exists(file_name):
+            return file_name
+        return default_storage.save(file_name, ContentFile(content))
+
+    with ThreadPoolExecutor(settings.IMAGE_UPLOAD_WORKERS) as executor:
+        saved = dict(zip(files, executor.map(store, files.items())))
+    variants = {
+        variant: { extension: saved[variant_name] for extension, variant_name in formats.items() }
+        for variant, formats in variants.items()
+    }
+    model.objects.filter( pk=pk, **{ field_name: name } ).update(**{
+        field_name: saved[name],
+        variants_field: json.dumps(variants),
+    })
+    staging.delete(name)
@@ -1,8 +1,23 @@
+import io
+import os
 import json
+import asyncio
 import datetime
+import hashlib
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
 from datetime import date, timedelta
+from unittest import skipUnless
 from unittest.mock import Mock, patch, MagicMock
 
+import requests
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+from celery.exceptions import Retry
+from django_celery_beat.models import PeriodicTask
 from django_rest_passwordreset.models import (
     ResetPasswordToken,
 )
@@ -10,7 +25,17 @@ from django_rest_passwordreset.models import (
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, router, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.models.expressions import RawSQL
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 from django.urls import reverse, resolve
 from django.contrib.auth import get_user_model
@@ -32,8 +57,39 @@ from .models import (
     ProductStock,
     Payment,
     OrdersTimestampedMetric,
-    SubscriptionPlan
+    ProfitTimestampedMetric,
+    get_crontab_schedule,
+    SubscriptionPlan,
+    EmailMessage,
+    OutboxMessage,
+    QueryStatsSnapshot
 )
+from .tasks import (
+    create_image_variants,
+    create_store_orders_metrics,
+    create_store_profit_metrics,
+    fan_out_store_task,
+    requeue_stale_emails,
+    send_email_async,
+    send_email_batch,
+    send_sms_async,
+    send_sms_bulk
+)
+from soukoapi.celery import app
+from .scheduler import SmartScheduler, get_entry_signature
+from .task_registry import get_task_signature
+from .utils.mail.fake_server import FakeSendGridServer
+from .utils.sms.fake_server import FakeTwilioServer
+from .utils.clients import get_client, get_pool_stats
+from .outbox import relay_outbox
+from .utils.async_sender import ProviderRejected
+from .storage import check_staging_root, get_staging_storage
+from .rate_limit import Throttled, ProviderUnavailable, take, provider_call
+from . import constants
+from . import benchmarks, data_generator, db_connections, db_router, metrics, performance, query_stats
+from api import dashboard, storefront
+from api.filters import has_trigram
+from api.urls import urlpatterns
 
 User = get_user_model()
 
@@ -78,9 +134,7 @@ class AuthenticationTest(TestCase):
         token = generate_jwt_token(self.user)
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
 
-    @patch("api.views.send_email_async.delay")
-    def test_user_signup(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_user_signup(self):
         payload = {
             'email' : 'guystephane00@gmail.com',
             'password' : '2_Password',
@@ -96,9 +150,8 @@ class AuthenticationTest(TestCase):
             content_type='application/json'
         )
         results = json.loads(response.content.decode('utf-8'))
-        self.assertEqual(send_email_async.call_count, 1)
+        self.assertEqual(OutboxMessage.objects.filter(task=send_email_async.name).count(), 1)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        send_email_async.assert_called()
 
     def test_user_login(self):
         client = APIClient()
@@ -123,9 +176,7 @@ class AuthenticationTest(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_302_FOUND)
 
-    @patch("main.signals.send_email_async.delay")
-    def test_users_resend_verification_code(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_users_resend_verification_code(self):
         payload = {
             'email': str(self.user_two.email)
         }
@@ -137,9 +188,7 @@ class AuthenticationTest(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
-    @patch("main.signals.send_email_async.delay")
-    def test_reset_password(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_reset_password(self):
         payload = {
             'email': str(self.user.email)
         }
@@ -150,9 +199,8 @@ class AuthenticationTest(TestCase):
             content_type='application/json'
         )
         results = json.loads(response.content.decode('utf-8'))
-        self.assertEqual(send_email_async.call_count, 1)
+        self.assertEqual(OutboxMessage.objects.filter(task=send_email_async.name).count(), 1)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        send_email_async.assert_called()
 
     def test_user_reset_password_confirm(self):
         payload = {
@@ -1111,9 +1159,7 @@ class AnonymousOrderTest(TestCase):
 
         self.client = APIClient()
 
-    @patch("api.views.send_email_async.delay")
-    def test_place_order(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_place_order(self):
         payload = {
             'order': {
                 'store_id': str(self.store.pk),
@@ -1137,10 +1183,9 @@ class AnonymousOrderTest(TestCase):
             content_type='application/json'
         )
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(OutboxMessage.objects.filter(task=send_email_async.name).count(), 1)
 
-    @patch("api.views.send_email_async.delay")
-    def test_users_resend_verification_code(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_users_resend_verification_code(self):
         payload = {
             'order_id': str(self.order.id)
         }
@@ -1152,9 +1197,7 @@ class AnonymousOrderTest(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
-    @patch("api.views.send_email_async.delay")
-    def test_confirm_order(self, send_email_async):
-        send_email_async.return_value = Mock()
+    def test_confirm_order(self):
         url = reverse('customers_confirm_order', kwargs={'pk': self.store.pk})
         payload = { 'code': self.code.code }
         response = self.client.post(
@@ -1163,6 +1206,7 @@ class AnonymousOrderTest(TestCase):
             content_type='application/json'
         )
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(OutboxMessage.objects.filter(task=send_email_async.name).count(), 1)
 
 
 class ReportTest(TestCase):
@@ -1314,4 +1358,1485 @@ class ReportTest(TestCase):
             content_type='application/json'
         )
         results = json.loads(response.content.decode('utf-8'))
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_orders_report_counts(self):
+        report = self.store.get_num_of_orders_report_by_period(period=3)
+        self.assertEqual(report, {
+            'number_of_orders': 2,
+            'number_of_pending_orders': 0,
+            'number_of_paid_orders': 2
+        })
+
+    def test_dashboard(self):
+        cache.clear()
+        response = self.client.get(
+            f"{reverse('store_dashboard', kwargs={'pk': self.store.pk})}?period=3",
+            content_type='application/json'
+        )
+        results = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(results.keys()), {'profit', 'orders', 'stock'})
+        self.assertEqual(results['orders']['number_of_orders']['number_of_orders'], 2)
+
+    @patch("api.dashboard.get_profit_section")
+    def test_dashboard_sections_are_cached(self, get_profit_section):
+        cache.clear()
+        get_profit_section.return_value = { 'profit': 0, 'profit_report': [] }
+        with patch.dict("api.dashboard.SECTIONS", { 'profit': get_profit_section }):
+            for _ in range(2):
+                response = self.client.get(
+                    f"{reverse('store_dashboard', kwargs={'pk': self.store.pk})}?period=3",
+                    content_type='application/json'
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_profit_section.call_count, 1)
+
+class TimestampedMetricTest(TestCase):
+
+    def setUp(self):
+        self.store = Store.objects.create(**{
+            'name': 'Noir Life',
+            'phone_number': '+233209456202'
+        })
+
+        self.store_two = Store.objects.create(**{
+            'name': 'Blanc Life',
+            'phone_number': '+233209456203'
+        })
+
+    def test_upsert_inserts_and_updates(self):
+        today = date.today()
+        OrdersTimestampedMetric.objects.upsert([
+            (self.store.id, today, 1),
+            (self.store_two.id, today, 4),
+        ])
+        OrdersTimestampedMetric.objects.upsert([
+            (self.store.id, today, 2),
+            (self.store.id, today, 3),
+        ])
+
+        self.assertEqual(OrdersTimestampedMetric.objects.count(), 2)
+        self.assertEqual(OrdersTimestampedMetric.objects.get(store=self.store).orders, 3)
+        self.assertEqual(OrdersTimestampedMetric.objects.get(store=self.store_two).orders, 4)
+
+    def test_duplicate_metric_is_rejected(self):
+        ProfitTimestampedMetric.objects.create(store=self.store, date=date.today())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ProfitTimestampedMetric.objects.create(store=self.store, date=date.today())
+
+    def test_metric_tasks_keep_one_row_per_day(self):
+        create_store_orders_metrics(str(self.store.id))
+        create_store_orders_metrics(str(self.store.id))
+        create_store_profit_metrics(str(self.store.id))
+        create_store_profit_metrics(str(self.store.id))
+
+        self.assertEqual(OrdersTimestampedMetric.objects.filter(store=self.store).count(), 1)
+        self.assertEqual(ProfitTimestampedMetric.objects.filter(store=self.store).count(), 1)
+
+    def test_dedupe_migration_keeps_one_row_per_day(self):
+        migration = import_module('main.migrations.0030_dedupe_timestamped_metrics')
+        # The models as the migration sees them, ordered by id
+        apps = MigrationLoader(connection).project_state(( 'main', '0029_auto_20210705_0815' )).apps
+        today = date.today()
+        with connection.cursor() as cursor:
+            # Rolled back with the test
+            cursor.execute('ALTER TABLE main_orderstimestampedmetric DROP CONSTRAINT main_ordersmetric_store_date_uniq')
+            cursor.execute('ALTER TABLE main_profittimestampedmetric DROP CONSTRAINT main_profitmetric_store_date_uniq')
+        for orders in ( 1, 3, 2 ):
+            OrdersTimestampedMetric.objects.create( store=self.store, date=today, orders=orders )
+        for profit in ( None, 10.0 ):
+            ProfitTimestampedMetric.objects.create( store=self.store, date=today, profit=profit )
+        OrdersTimestampedMetric.objects.create( store=self.store, date=today - timedelta(days=1), orders=5 )
+        OrdersTimestampedMetric.objects.create( store=self.store_two, date=today, orders=4 )
+
+        migration.dedupe_metrics(apps, None)
+
+        self.assertEqual(
+            sorted(OrdersTimestampedMetric.objects.values_list('store__name', 'date', 'orders')),
+            [ ( 'Blanc Life', today, 4 ), ( 'Noir Life', today - timedelta(days=1), 5 ), ( 'Noir Life', today, 3 ) ]
+        )
+        self.assertEqual(list(ProfitTimestampedMetric.objects.values_list('profit', flat=True)), [ 10.0 ])
+
+
+class SmartSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.scheduler = SmartScheduler.__new__(SmartScheduler)
+        self.scheduler._heap = []
+        self.scheduler.max_interval = 5
+        self.scheduler.app = app
+        self.entry = MagicMock(
+            task='main.tasks.create_store_orders_metrics',
+            args=['4d3c5a6e-3f1b-4c3e-9a43-1d0b7e3c2f10'],
+            kwargs={}
+        )
+        self.entry.is_due.return_value = (True, 300)
+
+    def test_entry_and_worker_signatures_match(self):
+        self.assertEqual(
+            get_entry_signature(self.entry),
+            get_task_signature(self.entry.task, tuple(self.entry.args), {})
+        )
+
+    def test_signature_depends_on_arguments(self):
+        self.assertNotEqual(
+            get_task_signature(self.entry.task, ['store-one']),
+            get_task_signature(self.entry.task, ['store-two'])
+        )
+        self.assertEqual(
+            get_task_signature(self.entry.task, [], {'a': 1, 'b': 2}),
+            get_task_signature(self.entry.task, (), {'b': 2, 'a': 1})
+        )
+
+    def test_entry_queue_follows_routes(self):
+        self.entry.options = {}
+        self.assertEqual(self.scheduler.get_entry_queue(self.entry), 'fetch_reports')
+
+    @patch("main.scheduler.get_queue_in_flight_count")
+    @patch("main.scheduler.is_in_flight")
+    def test_due_entry_runs_when_not_in_flight(self, is_in_flight, get_queue_in_flight_count):
+        is_in_flight.return_value = False
+        get_queue_in_flight_count.return_value = 0
+        self.entry.options = {}
+        self.assertEqual(tuple(self.scheduler.is_due(self.entry)), (True, 300))
+
+    @patch("main.scheduler.get_queue_in_flight_count")
+    @patch("main.scheduler.is_in_flight")
+    def test_due_entry_waits_when_queue_is_full(self, is_in_flight, get_queue_in_flight_count):
+        is_in_flight.return_value = False
+        get_queue_in_flight_count.return_value = settings.SCHEDULER_QUEUE_CAPS['fetch_reports']
+        self.entry.options = {}
+        self.assertEqual(tuple(self.scheduler.is_due(self.entry)), (False, 5))
+
+    @patch("main.scheduler.is_in_flight")
+    def test_due_entry_is_deferred_when_in_flight(self, is_in_flight):
+        is_in_flight.return_value = True
+        self.assertEqual(tuple(self.scheduler.is_due(self.entry)), (False, 5))
+
+    @patch("main.scheduler.clear_in_flight")
+    @patch("main.scheduler.mark_in_flight")
+    @patch("main.scheduler.DatabaseScheduler.apply_async")
+    def test_failed_publish_clears_registry(self, apply_async, mark_in_flight, clear_in_flight):
+        mark_in_flight.return_value = True
+        apply_async.side_effect = Exception("Broker is down")
+        self.entry.options = {}
+        with self.assertRaises(Exception):
+            self.scheduler.apply_async(self.entry)
+        mark_in_flight.assert_called_once_with(get_entry_signature(self.entry), 'fetch_reports')
+        clear_in_flight.assert_called_once_with(get_entry_signature(self.entry))
+
+    @patch("main.scheduler.mark_in_flight")
+    @patch("main.scheduler.DatabaseScheduler.apply_async")
+    def test_entry_claimed_since_is_due_is_not_published(self, apply_async, mark_in_flight):
+        # Another beat or a fan out published it first
+        mark_in_flight.return_value = False
+        self.entry.options = {}
+
+        self.assertIsNone(self.scheduler.apply_async(self.entry))
+        self.scheduler.apply_entry(self.entry)
+
+        apply_async.assert_not_called()
+
+
+class StoreScheduleTest(TestCase):
+
+    def setUp(self):
+        self.stores = [
+            Store.objects.create(name=f'Store {i}') for i in range(3)
+        ]
+        cache.clear()
+
+    def test_schedules_share_one_crontab(self):
+        first = get_crontab_schedule(**constants.EVERY_FIVE_MINUTES)
+        second = get_crontab_schedule(**constants.EVERY_FIVE_MINUTES)
+        self.assertEqual(first.pk, second.pk)
+
+    def test_fan_out_tasks_are_scheduled(self):
+        self.assertEqual(
+            PeriodicTask.objects.filter(task='main.tasks.fan_out_store_task').count(), 2
+        )
+
+    @patch("main.tasks.create_store_orders_metrics.apply_async")
+    @patch("main.tasks.mark_in_flight")
+    def test_fan_out_publishes_each_store_once(self, mark_in_flight, apply_async):
+        # The second store's previous run is still in flight
+        in_flight = get_task_signature('main.tasks.create_store_orders_metrics', [str(self.stores[1].id)])
+        mark_in_flight.side_effect = lambda signature, queue: signature != in_flight
+
+        with self.settings(SCHEDULER_QUEUE_CAPS={}):
+            fan_out_store_task('main.tasks.create_store_orders_metrics')
+
+        published = { call[0][0][0] for call in apply_async.call_args_list }
+        self.assertEqual(published, { str(self.stores[0].id), str(self.stores[2].id) })
+
+    @patch("main.tasks.fan_out_store_task.retry")
+    @patch("main.tasks.get_queue_in_flight_count")
+    @patch("main.tasks.create_store_orders_metrics.apply_async")
+    @patch("main.tasks.mark_in_flight")
+    def test_fan_out_stops_at_queue_cap(self, mark_in_flight, apply_async, get_queue_in_flight_count, retry):
+        mark_in_flight.return_value = True
+        get_queue_in_flight_count.return_value = 0
+        retry.side_effect = Retry()
+
+        with self.settings(SCHEDULER_QUEUE_CAPS={'fetch_reports': 2}):
+            with self.assertRaises(Retry):
+                fan_out_store_task('main.tasks.create_store_orders_metrics')
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(retry.call_args[1]['args'], [ 'main.tasks.create_store_orders_metrics' ])
+        self.assertEqual(retry.call_args[1]['kwargs'], {
+            'cursor': sorted(str(store.id) for store in self.stores)[1]
+        })
+
+    @patch("main.task_registry.clear_in_flight")
+    @patch("main.tasks.get_queue_in_flight_count")
+    @patch("main.tasks.create_store_orders_metrics.apply_async")
+    @patch("main.tasks.mark_in_flight")
+    def test_fan_out_retry_resumes_after_cursor(self, mark_in_flight, apply_async, get_queue_in_flight_count, clear_in_flight):
+        mark_in_flight.return_value = True
+        get_queue_in_flight_count.return_value = 0
+
+        # Run eagerly, the retried message is run right away with its args and kwargs
+        with self.settings(SCHEDULER_QUEUE_CAPS={'fetch_reports': 2}):
+            result = fan_out_store_task.apply(args=[ 'main.tasks.create_store_orders_metrics' ])
+
+        self.assertEqual(result.state, 'RETRY')
+        published = [ call[0][0][0] for call in apply_async.call_args_list ]
+        self.assertEqual(published, sorted(str(store.id) for store in self.stores))
+
+    @patch("main.tasks.create_store_orders_metrics.apply_async")
+    @patch("main.tasks.mark_in_flight")
+    def test_fan_out_resumes_after_cursor(self, mark_in_flight, apply_async):
+        mark_in_flight.return_value = True
+        stores = sorted(str(store.id) for store in self.stores)
+
+        with self.settings(SCHEDULER_QUEUE_CAPS={}):
+            fan_out_store_task('main.tasks.create_store_orders_metrics', cursor=stores[0])
+
+        self.assertEqual([ call[0][0][0] for call in apply_async.call_args_list ], stores[1:])
+
+
+class EmailBatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = FakeSendGridServer().start()
+        self.addCleanup(self.server.stop)
+        sendgrid_settings = self.settings(SENDGRID_API_KEY='key', SENDGRID_API_HOST=self.server.url)
+        sendgrid_settings.enable()
+        self.addCleanup(sendgrid_settings.disable)
+        for name in ("take", "record_failure", "record_success"):
+            patcher = patch(f"main.rate_limit.{name}")
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def queue_emails(self, recipients):
+        with patch("main.tasks.send_email_batch.apply_async") as apply_async:
+            for recipient in recipients:
+                send_email_async( 'template', [recipient], 'Hello', {'name': recipient}, 0 )
+        return apply_async
+
+    def test_emails_are_queued_in_one_batch(self):
+        apply_async = self.queue_emails([ f'customer{i}@example.com' for i in range(5) ])
+
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(EmailMessage.objects.filter(status=EmailMessage.PENDING).count(), 5)
+
+    def test_batch_is_sent_in_one_request(self):
+        self.queue_emails([ f'customer{i}@example.com' for i in range(5) ])
+
+        send_email_batch('template')
+
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(EmailMessage.objects.filter(status=EmailMessage.SENT).count(), 5)
+
+    def test_batch_respects_personalizations_limit(self):
+        self.queue_emails([ f'customer{i}@example.com' for i in range(5) ])
+
+        with self.settings(SENDGRID_MAX_PERSONALIZATIONS=2):
+            send_email_batch('template')
+
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(EmailMessage.objects.filter(status=EmailMessage.SENT).count(), 5)
+
+    def test_rejected_email_does_not_fail_the_batch(self):
+        self.queue_emails([ 'first@example.com', 'customer@invalid', 'last@example.com' ])
+
+        send_email_batch('template')
+
+        self.assertEqual(
+            set(EmailMessage.objects.filter(status=EmailMessage.SENT).values_list('tos', flat=True)),
+            { json.dumps(['first@example.com']), json.dumps(['last@example.com']) }
+        )
+        self.assertEqual(EmailMessage.objects.get(status=EmailMessage.FAILED).tos, json.dumps(['customer@invalid']))
+
+    @patch("main.tasks.send_email_batch.retry")
+    def test_overloaded_provider_reschedules_batch(self, retry):
+        retry.side_effect = Retry()
+        self.server.responses = [429]
+        self.queue_emails([ f'customer{i}@example.com' for i in range(3) ])
+
+        with self.assertRaises(Retry):
+            send_email_batch('template')
+
+        self.assertEqual(retry.call_args[1]['countdown'], 30)
+        self.record_failure.assert_called_once_with('sendgrid')
+        self.assertEqual(EmailMessage.objects.filter(status=EmailMessage.PENDING).count(), 3)
+
+    @patch("main.tasks.send_email_batch.retry")
+    def test_throttled_batch_does_not_call_provider(self, retry):
+        retry.side_effect = Retry()
+        self.take.side_effect = Throttled('sendgrid', 0.5)
+        self.queue_emails([ 'customer@example.com' ])
+
+        with self.assertRaises(Retry):
+            send_email_batch('template')
+
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual(retry.call_args[1]['countdown'], 0.5)
+        self.assertEqual(EmailMessage.objects.get().status, EmailMessage.PENDING)
+
+    @patch("main.tasks.send_email_batch.retry")
+    @patch("main.tasks.send_email_chunk")
+    @patch("main.tasks.send_all")
+    def test_accepted_chunk_is_not_sent_again(self, send_all, send_email_chunk, retry):
+        retry.side_effect = Retry()
+        send_all.return_value = [ None, ProviderRejected('sendgrid', 400, 'Bad Request') ]
+        send_email_chunk.side_effect = Throttled('sendgrid', 1)
+        self.queue_emails([ 'first@example.com', 'customer@invalid' ])
+
+        with self.settings(SENDGRID_MAX_PERSONALIZATIONS=1):
+            with self.assertRaises(Retry):
+                send_email_batch('template')
+
+        self.assertEqual(EmailMessage.objects.get(status=EmailMessage.SENT).tos, json.dumps(['first@example.com']))
+        self.assertEqual(EmailMessage.objects.get(status=EmailMessage.PENDING).tos, json.dumps(['customer@invalid']))
+        self.assertEqual(retry.call_args[1]['countdown'], 1)
+
+    def test_emails_of_a_dead_batch_are_requeued(self):
+        self.queue_emails([ 'stale@example.com', 'sending@example.com' ])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        EmailMessage.objects.update(status=EmailMessage.SENDING, claimed_at=now)
+        EmailMessage.objects.filter(tos=json.dumps(['stale@example.com'])).update(
+            claimed_at=now - timedelta(seconds=settings.EMAIL_SENDING_TIMEOUT + 1)
+        )
+        # The batch window of the queued emails is over
+        cache.clear()
+
+        with patch("main.tasks.send_email_batch.apply_async") as apply_async:
+            requeue_stale_emails()
+
+        self.assertEqual(EmailMessage.objects.get(status=EmailMessage.PENDING).tos, json.dumps(['stale@example.com']))
+        self.assertEqual(EmailMessage.objects.get(status=EmailMessage.SENDING).tos, json.dumps(['sending@example.com']))
+        apply_async.assert_called_once_with(('template',), countdown=settings.EMAIL_BATCH_WINDOW)
+
+    def test_requeue_stale_emails_is_scheduled(self):
+        self.assertTrue(PeriodicTask.objects.filter(task='main.tasks.requeue_stale_emails', enabled=True).exists())
+
+    @patch("main.tasks.send_sms_async.retry")
+    @patch("main.tasks.send")
+    def test_overloaded_sms_provider_reschedules_sms(self, send, retry):
+        retry.side_effect = Retry()
+        send.side_effect = ProviderUnavailable('twilio', 60)
+
+        with self.assertRaises(Retry):
+            send_sms_async('Your order is ready', '+233200000000')
+
+        self.assertEqual(retry.call_args[1]['countdown'], 60)
+        self.assertEqual(retry.call_args[1]['kwargs'], { 'failures': 1 })
+        self.record_failure.assert_called_once_with('twilio')
+
+    @patch("main.tasks.send_sms_async.retry")
+    @patch("main.tasks.send")
+    def test_unreachable_sms_provider_is_a_failure(self, send, retry):
+        retry.side_effect = Retry()
+        send.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(Retry):
+            send_sms_async('Your order is ready', '+233200000000')
+
+        self.assertIsInstance(retry.call_args[1]['exc'], ProviderUnavailable)
+        self.assertEqual(retry.call_args[1]['countdown'], settings.PROVIDER_RETRY_AFTER)
+        self.record_failure.assert_called_once_with('twilio')
+
+    @patch("main.tasks.send_sms_async.retry")
+    @patch("main.tasks.send")
+    def test_failed_sms_backs_off_then_gives_up(self, send, retry):
+        retry.side_effect = Retry()
+        send.side_effect = requests.Timeout()
+
+        with self.assertRaises(Retry):
+            send_sms_async('Your order is ready', '+233200000000', failures=2)
+        self.assertEqual(retry.call_args[1]['countdown'], settings.PROVIDER_RETRY_AFTER * 4)
+        self.assertEqual(retry.call_args[1]['kwargs'], { 'failures': 3 })
+
+        with self.assertRaises(ProviderUnavailable):
+            send_sms_async('Your order is ready', '+233200000000', failures=settings.NOTIFICATIONS_RETRIES)
+        self.assertEqual(retry.call_count, 1)
+
+    @patch("main.tasks.send_sms_async.retry")
+    @patch("main.tasks.send")
+    def test_throttled_sms_keeps_its_failures(self, send, retry):
+        retry.side_effect = Retry()
+        self.take.side_effect = Throttled('twilio', 2)
+
+        with self.assertRaises(Retry):
+            send_sms_async('Your order is ready', '+233200000000', failures=1)
+
+        self.assertEqual(retry.call_args[1]['countdown'], 2)
+        self.assertNotIn('kwargs', retry.call_args[1])
+        send.assert_not_called()
+
+
+
+class ProviderClientTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeSendGridServer().start()
+        self.addCleanup(self.server.stop)
+        sendgrid_settings = self.settings(SENDGRID_API_KEY='key', SENDGRID_API_HOST=self.server.url)
+        sendgrid_settings.enable()
+        self.addCleanup(sendgrid_settings.disable)
+
+    def test_client_is_reused(self):
+        self.assertIs(get_client('sendgrid'), get_client('sendgrid'))
+
+    @patch("main.utils.clients.os.getpid")
+    def test_forked_process_gets_its_own_client(self, getpid):
+        getpid.return_value = 1
+        parent = get_client('sendgrid')
+        getpid.return_value = 2
+        self.assertIsNot(get_client('sendgrid'), parent)
+
+    def test_requests_reuse_connections(self):
+        message = {'personalizations': [{'to': [{'email': 'customer@example.com'}]}]}
+        for _ in range(3):
+            get_client('sendgrid').send(message=message)
+
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(get_pool_stats()['sendgrid'], {'connections': 1, 'requests': 3, 'idle': 1})
+
+
+class SmsBulkTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeTwilioServer(latency=0.2).start()
+        self.addCleanup(self.server.stop)
+        twilio_settings = self.settings(
+            TWILIO_API_HOST=self.server.url, TWILIO_ACCOUNT_SID='AC123',
+            TWILIO_AUTH_TOKEN='token', TWILIO_NUMBER='+233200000001'
+        )
+        twilio_settings.enable()
+        self.addCleanup(twilio_settings.disable)
+        for name in ("take", "record_failure", "record_success"):
+            patcher = patch(f"main.rate_limit.{name}")
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_messages_are_sent_concurrently(self):
+        messages = [ [f'Order {i} is ready', f'+2332000{i:05}'] for i in range(100) ]
+
+        send_sms_bulk(messages)
+
+        self.assertEqual(self.server.requests, 100)
+        self.assertEqual({ message['To'] for message in self.server.messages }, { to for _, to in messages })
+        # Sent one at a time, 100 messages would take 20 seconds
+        self.assertGreater(self.server.peak_concurrent, 50)
+
+    @patch("main.tasks.send_sms_async.apply_async")
+    def test_throttled_messages_are_rescheduled(self, apply_async):
+        self.server.responses = [503]
+        self.server.retry_after = 30
+
+        send_sms_bulk([ ['Your order is ready', '+233200000002'] ])
+        # Rejected numbers aren't tried again
+        with self.assertLogs('main.tasks', 'ERROR'):
+            send_sms_bulk([ ['Your order is ready', '+000'] ])
+
+        apply_async.assert_called_once_with(( 'Your order is ready', '+233200000002' ), countdown=30)
+
+
+class OutboxTest(TestCase):
+
+    def enqueue_email(self, recipient):
+        return OutboxMessage.objects.enqueue(
+            send_email_async,
+            template_id='template',
+            tos=[recipient],
+            subject='Hello',
+            context={'name': recipient},
+            index=0
+        )
+
+    def test_rolled_back_messages_are_not_kept(self):
+        with transaction.atomic():
+            self.enqueue_email('customer@example.com')
+            transaction.set_rollback(True)
+
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    @patch("main.outbox.app.producer_or_acquire")
+    @patch("main.outbox.app.send_task")
+    def test_relay_publishes_and_clears_the_outbox(self, send_task, producer_or_acquire):
+        messages = [ self.enqueue_email(f'customer{i}@example.com') for i in range(3) ]
+
+        self.assertEqual(relay_outbox(batch_size=2), 2)
+        self.assertEqual(relay_outbox(batch_size=2), 1)
+        self.assertEqual(relay_outbox(batch_size=2), 0)
+
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(
+            [ call[1]['task_id'] for call in send_task.call_args_list ],
+            [ str(message.id) for message in messages ]
+        )
+        self.assertEqual(send_task.call_args[1]['kwargs']['tos'], ['customer2@example.com'])
+
+    @patch("main.task_registry.clear_in_flight")
+    @patch("main.tasks.send_email_batch.apply_async")
+    def test_republished_message_is_sent_once(self, apply_async, clear_in_flight):
+        kwargs = { 'template_id': 'template', 'tos': ['customer@example.com'], 'subject': 'Hello', 'context': {}, 'index': 0 }
+        for _ in range(2):
+            send_email_async.apply(kwargs=kwargs, task_id='f3b1c6a8-7d29-4d44-9b8e-2f5a1e0c9d11')
+
+        self.assertEqual(EmailMessage.objects.count(), 1)
+
+
+class RunWorkerTest(TestCase):
+
+    def setUp(self):
+        self.get_worker_command = import_module("main.management.commands.run-worker").get_worker_command
+
+    def test_pool_consumes_its_own_queues(self):
+        for name, pool in settings.WORKER_POOLS.items():
+            command = self.get_worker_command(name, pool)
+            self.assertEqual(command[command.index("-Q") + 1], ",".join(pool["queues"]))
+            self.assertIn(f"{name}@%h", command)
+
+    def test_pool_tuning(self):
+        pool = { "queues": ["fetch_reports"], "autoscale": (4, 1), "prefetch_multiplier": 1, "max_tasks_per_child": 100 }
+        command = self.get_worker_command("reports", pool)
+
+        self.assertIn("--autoscale=4,1", command)
+        self.assertIn("--prefetch-multiplier=1", command)
+        self.assertIn("--max-tasks-per-child=100", command)
+
+    def test_pools_serve_metrics_on_their_own_port(self):
+        get_worker_env = import_module("main.management.commands.run-worker").get_worker_env
+        with self.settings(WORKER_METRICS_PORT="9101"), patch.dict("os.environ", { "PROMETHEUS_MULTIPROC_DIR": "/tmp/metrics" }):
+            env = get_worker_env("reports", 1)
+
+        self.assertEqual(env["WORKER_METRICS_PORT"], "9102")
+        self.assertEqual(env["PROMETHEUS_MULTIPROC_DIR"], "/tmp/metrics/reports")
+
+
+class BenchmarkTest(TestCase):
+
+    def test_every_route_is_benchmarked(self):
+        self.assertEqual(
+            { endpoint.url_name for endpoint in benchmarks.ENDPOINTS },
+            { pattern.name for pattern in urlpatterns }
+        )
+
+    def test_endpoints_succeed_on_seeded_store(self):
+        fixtures = benchmarks.seed(20)
+
+        for result in benchmarks.run(fixtures, repeat=1):
+            with self.subTest(endpoint=result.name):
+                self.assertLess(result.status, 400)
+                self.assertGreater(result.queries, 0)
+
+    def test_compare_reports_regressions(self):
+        baselines = { 'GET orders': { 'p50': 10.0, 'p95': 20.0, 'queries': 5, 'bytes': 1000 } }
+        thresholds = { 'latency': 1.5, 'latency_slack': 5, 'queries': 0, 'bytes': 1.1 }
+
+        within = benchmarks.Result('GET orders', 200, 12.0, 34.0, 5, 1100)
+        self.assertEqual(benchmarks.compare([within], baselines, thresholds), [])
+
+        regressed = benchmarks.Result('GET orders', 200, 12.0, 36.0, 6, 1200)
+        self.assertEqual(len(benchmarks.compare([regressed], baselines, thresholds)), 3)
+
+
+class DataGeneratorTest(TestCase):
+
+    def test_orders_are_skewed_towards_whale_stores(self):
+        config = { **data_generator.DEFAULTS, 'stores': 100, 'orders': 100000 }
+        stores = data_generator.plan_stores(config)
+
+        self.assertEqual(sum(store.orders for store in stores), 100000)
+        self.assertGreater(sum(store.orders for store in stores[:5]), 30000)
+        self.assertEqual(stores, data_generator.plan_stores(config))
+
+    def test_generated_dataset(self):
+        stores = data_generator.generate({ 'seed': 7, 'stores': 3, 'orders': 300, 'batch_size': 100 })
+
+        for store in stores:
+            orders = Order.objects.filter(store_id=store.id)
+            self.assertEqual(orders.count(), store.orders)
+            self.assertEqual(Customer.objects.filter(store_id=store.id).count(), store.customers)
+            self.assertTrue(OrderItem.objects.filter(order__store_id=store.id).exists())
+            self.assertEqual(
+                sum(OrdersTimestampedMetric.objects.filter(store_id=store.id).values_list('orders', flat=True)),
+                orders.filter(confirmed=True).count()
+            )
+        self.assertTrue(
+            self.client.login(email=data_generator.get_owner_email(7, 0), password=data_generator.PASSWORD)
+        )
+
+
+class PerformanceMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(**{
+            'email': 'guy@ampersandllc.co',
+            'password': '2Password_',
+            'first_name' : 'Guy',
+            'username': 'guitoo',
+            'last_name' : 'Tanoh',
+            'is_email_confirmed': True
+        })
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + generate_jwt_token(self.user))
+
+    def test_server_timing_for_staff(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('categories')))
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('categories'))
+
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+
+    def test_server_timing_for_sampled_requests(self):
+        with self.settings(PERFORMANCE_SAMPLE_RATE=1):
+            response = self.client.get(reverse('categories'))
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+    def test_requests_over_query_threshold_are_flagged(self):
+        with self.settings(PERFORMANCE_QUERY_THRESHOLD=1), self.assertLogs('main.performance', 'WARNING') as logs:
+            self.client.get(reverse('categories'))
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertTrue(record['too_many_queries'])
+        self.assertEqual(record['view'], 'api.views.CategoriesEndpoint')
+        self.assertGreater(record['queries'], 1)
+
+    def test_cache_hits_are_counted(self):
+        stats = performance.RequestStats()
+        performance._local.stats = stats
+        self.addCleanup(setattr, performance._local, 'stats', None)
+
+        cache.set('performance-test', 1)
+        self.assertEqual(cache.get('performance-test'), 1)
+        self.assertEqual(cache.get('missing', 'default'), 'default')
+        cache.get_many(['performance-test', 'missing'])
+
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (2, 2))
+
+
+@override_settings(METRICS_TOKEN='secret')
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient(SERVER_NAME='localhost')
+
+    def get_metrics(self):
+        return self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+
+    def get_sample(self, name, labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_counted_per_view(self):
+        labels = { 'view': 'api.views.CategoriesEndpoint', 'method': 'GET', 'status': '401' }
+        before = self.get_sample('souko_http_requests_total', labels)
+
+        self.client.get(reverse('categories'))
+        response = self.get_metrics()
+
+        self.assertEqual(self.get_sample('souko_http_requests_total', labels), before + 1)
+        self.assertIn(b'souko_http_requests_total{', response.content)
+        self.assertIn(b'souko_celery_queue_depth', response.content)
+
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.get_metrics().status_code, status.HTTP_200_OK)
+
+    def test_metrics_are_closed_without_token(self):
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+            with self.settings(DEBUG=True):
+                self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_200_OK)
+
+    def test_queue_depth(self):
+        with self.settings(REDIS_URL='redis://localhost'), patch.object(metrics, 'get_queue_depths', return_value={ 'send_email': 3 }):
+            response = self.get_metrics()
+        self.assertIn(b'souko_celery_queue_depth{queue="send_email"} 3.0', response.content)
+
+    def test_task_runtime_and_retries(self):
+        task = create_store_orders_metrics
+        labels = { 'task': task.name, 'state': 'SUCCESS' }
+        runtime = self.get_sample('souko_celery_task_runtime_seconds_count', labels)
+        retries = self.get_sample('souko_celery_task_retries_total', { 'task': task.name })
+
+        metrics.record_task_start(task_id='task-id', task=task)
+        metrics.record_task_runtime(task_id='task-id', task=task, state='SUCCESS')
+        metrics.record_task_retry(sender=task)
+
+        self.assertEqual(self.get_sample('souko_celery_task_runtime_seconds_count', labels), runtime + 1)
+        self.assertEqual(self.get_sample('souko_celery_task_retries_total', { 'task': task.name }), retries + 1)
+
+
+class QueryStatsTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(**{
+            'email': 'guy@ampersandllc.co',
+            'password': '2Password_',
+            'first_name' : 'Guy',
+            'username': 'guitoo',
+            'last_name' : 'Tanoh',
+            'is_email_confirmed': True
+        })
+        self.before = {
+            '1': { 'query': "SELECT * FROM main_order /*view='api.views.OrdersEndpoint',model='main.Order'*/", 'calls': 10, 'total_time': 100.0, 'rows': 50 },
+            '2': { 'query': 'SELECT 1', 'calls': 5, 'total_time': 1.0, 'rows': 5 },
+        }
+        self.after = {
+            '1': { 'query': "SELECT * FROM main_order /*view='api.views.OrdersEndpoint',model='main.Order'*/", 'calls': 12, 'total_time': 160.0, 'rows': 60 },
+            '2': { 'query': 'SELECT 1', 'calls': 105, 'total_time': 11.0, 'rows': 105 },
+            '3': { 'query': 'SELECT 2', 'calls': 1, 'total_time': 5.0, 'rows': 1 },
+        }
+
+    def test_queries_are_tagged_with_view_and_model(self):
+        stats = performance.RequestStats()
+        stats.view = 'api.views.UsersEndpoint'
+        performance._local.stats = stats
+        self.addCleanup(setattr, performance._local, 'stats', None)
+
+        query = User.objects.annotate(query=RawSQL('current_query()', [])).values_list('query', flat=True).first()
+
+        self.assertTrue(query.endswith("/*view='api.views.UsersEndpoint',model='main.User'*/"))
+        self.assertEqual(query_stats.parse_tags(query), { 'view': 'api.views.UsersEndpoint', 'model': 'main.User' })
+
+    def test_diff_and_rank(self):
+        statements = query_stats.diff(self.before, self.after)
+
+        by_time = query_stats.rank(statements)
+        self.assertEqual([ statement['queryid'] for statement in by_time ], ['1', '2', '3'])
+        self.assertEqual(by_time[0]['calls'], 2)
+        self.assertEqual(by_time[0]['mean_time'], 30.0)
+        self.assertEqual(by_time[0]['view'], 'api.views.OrdersEndpoint')
+        self.assertEqual(by_time[0]['model'], 'main.Order')
+
+        self.assertEqual(query_stats.rank(statements, 'calls', 1)[0]['queryid'], '2')
+
+    def test_reset_statistics_count_from_zero(self):
+        after = { '1': dict(self.before['1'], calls=3, total_time=9.0, rows=3) }
+        self.assertEqual(query_stats.diff(self.before, after)[0]['calls'], 3)
+
+    @patch('main.models.fetch_statements')
+    def test_report_since_latest_snapshot(self, fetch_statements):
+        QueryStatsSnapshot.objects.create(label='old', statements='{}')
+        snapshot = QueryStatsSnapshot.objects.create(label='release', statements=json.dumps(self.before))
+        fetch_statements.return_value = self.after
+
+        before, after, statements = QueryStatsSnapshot.objects.report(order='rows')
+
+        self.assertEqual((before, after), (snapshot, None))
+        self.assertEqual(statements[0]['rows'], 100)
+        self.assertEqual(QueryStatsSnapshot.objects.report(after='release')[0].label, 'old')
+
+    @patch('main.models.fetch_statements')
+    def test_view_is_staff_only(self, fetch_statements):
+        fetch_statements.return_value = self.after
+        self.client.force_login(self.user)
+        url = reverse('query_stats')
+
+        self.assertEqual(self.client.get(url, SERVER_NAME='localhost').status_code, status.HTTP_302_FOUND)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url, { 'order': 'calls', 'limit': 2 }, SERVER_NAME='localhost')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([ statement['queryid'] for statement in response.json()['statements'] ], ['2', '1'])
+
+    @patch('main.models.fetch_statements', side_effect=query_stats.QueryStatsUnavailable('not installed'))
+    def test_command_without_extension(self, fetch_statements):
+        with self.assertRaisesMessage(CommandError, 'not installed'):
+            call_command('query-stats', '--snapshot')
+
+
+class IndexTest(TestCase):
+
+    def setUp(self):
+        self.fixtures = benchmarks.seed(200)
+        self.end = datetime.datetime.now(datetime.timezone.utc)
+        self.start = self.end - timedelta(days=30)
+        # Most of the history is older than the reports' periods
+        past = self.start - timedelta(days=365)
+        Order.objects.exclude( pk=self.fixtures.order.pk ).update( created_at=past, paid_on=past.date(), payment_status='PAID' )
+        OrderItem.objects.exclude( order=self.fixtures.order ).update( created_at=past )
+        Product.objects.exclude( pk=self.fixtures.product.pk ).update( is_active=False )
+        with connection.cursor() as cursor:
+            for model in ( Order, Customer, Product, OrderItem ):
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+            # Tables this small are cheaper to scan, the plans tell which index would be used
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index):
+        self.assertIn(index, queryset.explain())
+
+    def test_order_reports(self):
+        store = self.fixtures.store
+        self.assertUsesIndex(
+            Order.objects.filter( store=store, confirmed=True, created_at__range=[self.start, self.end] ),
+            'main_order_store_confirmed_idx'
+        )
+        self.assertUsesIndex(
+            Order.objects.filter( store=store, confirmed=True, paid_on__range=[self.start, self.end] ),
+            'main_order_store_paid_on_idx'
+        )
+        self.assertUsesIndex(Order.objects.filter( store=store, payment_status='PENDING' ), 'main_order_store_payment_idx')
+
+    def test_checkout_customer_lookups(self):
+        customer = self.fixtures.customer
+        self.assertUsesIndex(
+            Customer.objects.filter( store=customer.store, email=customer.email ), 'main_customer_store_email_idx'
+        )
+        self.assertUsesIndex(
+            Customer.objects.filter( store=customer.store, phone_number='+233244000000' ), 'main_customer_store_phone_idx'
+        )
+
+    def test_storefront_products(self):
+        self.assertUsesIndex(
+            Product.objects.filter( store=self.fixtures.store, is_active=True ).order_by('created_at'),
+            'main_product_store_active_idx'
+        )
+
+    def test_ordered_items_in_period(self):
+        self.assertUsesIndex(
+            self.fixtures.stock.order_items.filter( created_at__range=[self.start, self.end] ),
+            'main_orderitem_stock_date_idx'
+        )
+        self.assertUsesIndex(
+            self.fixtures.product.order_items.filter( created_at__range=[self.start, self.end] ),
+            'main_orderitem_prod_date_idx'
+        )
+
+
+class TrigramSearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(**{
+            'email': 'guy@ampersandllc.co',
+            'password': '2Password_',
+            'first_name' : 'Guy',
+            'username': 'guitoo',
+            'last_name' : 'Tanoh',
+            'is_email_confirmed': True
+        })
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + generate_jwt_token(self.user))
+        self.store = Store.objects.create( name='Souko', phone_number='+233209456202' )
+        for first_name, last_name, city in [
+            ( 'Amadou', 'Diallo', 'Accra' ),
+            ( 'Kofi', 'Boateng', 'Kumasi' ),
+            ( 'Ama', 'Mensah', 'Accra' ),
+        ]:
+            Customer.objects.create( store=self.store, first_name=first_name, last_name=last_name, city=city )
+
+    def search(self, search, **params):
+        response = self.client.get(
+            reverse('store_customers', kwargs={ 'pk': self.store.pk }), { 'search': search, **params }
+        )
+        return [ customer['first_name'] for customer in response.data['results'] ]
+
+    def test_matches_like_search_filter(self):
+        self.assertCountEqual(self.search('ama'), ['Amadou', 'Ama'])
+        self.assertCountEqual(self.search('ama mensah'), ['Ama'])
+        self.assertEqual(self.search('xyz'), [])
+
+    def test_unranked_without_trigram(self):
+        with patch('api.filters.has_trigram', return_value=False):
+            self.assertEqual(self.search('ama'), ['Ama', 'Amadou'])
+
+    def test_ranked_by_similarity(self):
+        if not has_trigram('default'):
+            self.skipTest("pg_trgm isn't installed")
+        self.assertEqual(self.search('amadou'), ['Amadou'])
+        self.assertEqual(self.search('ama'), ['Ama', 'Amadou'])
+        self.assertEqual(self.search('ama', ordering='created_at'), ['Amadou', 'Ama'])
+
+    def test_large_match_sets_are_not_ranked(self):
+        if not has_trigram('default'):
+            self.skipTest("pg_trgm isn't installed")
+        for limit, ranked in ( ( 2, True ), ( 1, False ) ):
+            with self.settings(SEARCH_RANK_MAX_MATCHES=limit), CaptureQueriesContext(connection) as queries:
+                self.assertCountEqual(self.search('ama'), ['Ama', 'Amadou'])
+            self.assertEqual(any( 'SIMILARITY' in query['sql'] for query in queries ), ranked)
+
+    def test_trigram_indexes_are_used(self):
+        if not has_trigram('default'):
+            self.skipTest("pg_trgm isn't installed")
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for field in ( 'first_name', 'last_name', 'city' ):
+            plan = Customer.objects.filter( **{ f'{field}__icontains': 'ama' } ).explain()
+            self.assertIn(f'main_customer_{field}_trgm', plan)
+        self.assertIn('main_product_name_trgm', Product.objects.filter( name__icontains='bag' ).explain())
+
+
+class OrderSearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(**{
+            'email': 'guy@ampersandllc.co',
+            'password': '2Password_',
+            'first_name' : 'Guy',
+            'username': 'guitoo',
+            'last_name' : 'Tanoh',
+            'is_email_confirmed': True
+        })
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + generate_jwt_token(self.user))
+        self.store = Store.objects.create( name='Souko', phone_number='+233209456202' )
+        self.ama = Customer.objects.create( store=self.store, first_name='Ama', last_name='Mensah' )
+        self.kofi = Customer.objects.create( store=self.store, first_name='Kofi', last_name='Boateng' )
+        self.order = Order.objects.create( store=self.store, customer=self.ama )
+        self.other_order = Order.objects.create( store=self.store, customer=self.kofi )
+
+    def search(self, search):
+        response = self.client.get(reverse('store_orders', kwargs={ 'pk': self.store.pk }), { 'search': search })
+        return [ order['id'] for order in response.data['results'] ]
+
+    def test_document_is_built_on_save(self):
+        self.assertEqual(self.order.search_document, f'{self.order.number} Ama Mensah')
+
+        order = Order.objects.get( pk=self.order.pk )
+        order.delivery_fee = 10.0
+        # The document is only rebuilt when the number or the customer change
+        with self.assertNumQueries(1):
+            order.save()
+
+        order.customer = self.kofi
+        order.save()
+        self.assertEqual(Order.objects.get( pk=order.pk ).search_document, f'{order.number} Kofi Boateng')
+
+    def test_renamed_customer(self):
+        self.ama.first_name = 'Akosua'
+        self.ama.save()
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.search_document, f'{self.order.number} Akosua Mensah')
+
+    def test_bulk_created_orders(self):
+        order = Order.objects.bulk_create([ Order( store=self.store, customer=self.kofi ) ])[0]
+
+        self.assertEqual(Order.objects.build_search_documents(self.store.pk), 1)
+        order.refresh_from_db()
+        self.assertEqual(order.search_document, f'{order.number} Kofi Boateng')
+
+    def test_search(self):
+        self.assertEqual(self.search('mensah'), [ str(self.order.pk) ])
+        self.assertEqual(self.search('ama mensah'), [ str(self.order.pk) ])
+        self.assertEqual(self.search(self.other_order.number[:6]), [ str(self.other_order.pk) ])
+        self.assertEqual(self.search(self.other_order.number.lower()), [ str(self.other_order.pk) ])
+
+    def test_order_number_lookup_uses_index(self):
+        Order.objects.bulk_create([ Order( store=self.store, customer=self.kofi ) for i in range(300) ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE main_order')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = Order.objects.filter( store=self.store, number=self.order.number ).explain()
+        self.assertIn('main_order_number_idx', plan)
+
+
+class DatabaseConnectionTest(TestCase):
+
+    def setUp(self):
+        # A connection outside of the transaction of the test
+        self.connection = connection.copy()
+        self.connection.settings_dict['CONN_HEALTH_CHECKS'] = True
+        self.addCleanup(self.connection.close)
+
+    def query(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def test_checked_once_per_request(self):
+        self.query()
+        with patch.object(self.connection, 'is_usable', wraps=self.connection.is_usable) as is_usable:
+            self.connection.close_if_unusable_or_obsolete()
+            self.query()
+            self.query()
+        self.assertEqual(is_usable.call_count, 1)
+
+    def test_closed_connection_is_replaced(self):
+        self.query()
+        closed = self.connection.connection
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [ closed.get_backend_pid() ])
+
+        self.connection.close_if_unusable_or_obsolete()
+        self.query()
+        self.assertIsNot(self.connection.connection, closed)
+
+    def test_wrappers_of_connections_created_in_a_request(self):
+        stats = performance.RequestStats()
+        with self.connection.execute_wrapper(stats):
+            self.query()
+        self.assertEqual(self.connection.execute_wrappers, [ query_stats.tag_query ])
+        self.assertEqual(stats.queries, 1)
+
+    def test_tasks_close_old_connections(self):
+        with patch.object(db_connections, 'close_old_connections') as close_old_connections:
+            db_connections.start_task_connections(task=Mock(request=Mock(is_eager=True)))
+            close_old_connections.assert_not_called()
+            db_connections.end_task_connections(task=Mock(request=Mock(is_eager=False)))
+        close_old_connections.assert_called_once_with()
+
+
+@override_settings(REPLICA_DATABASES=['replica_0'])
+class ReplicaRouterTest(TestCase):
+
+    def setUp(self):
+        # The writes of the previous tests pinned this thread
+        db_router._local.pinned = False
+        self.factory = RequestFactory(HTTP_AUTHORIZATION='Token client')
+        self.middleware = db_router.ReplicaMiddleware(self.read)
+        self.addCleanup(cache.delete, db_router.get_sticky_key(self.factory.get('/')))
+
+    def read(self, request):
+        return HttpResponse(router.db_for_read(Store))
+
+    def request(self, request, middleware=None):
+        """Database the request read from"""
+        return ( middleware or self.middleware )(request).content.decode()
+
+    def test_safe_requests_read_from_replicas(self):
+        self.assertEqual(self.request(self.factory.get('/')), 'replica_0')
+        self.assertEqual(self.request(self.factory.head('/')), 'replica_0')
+        self.assertEqual(router.db_for_read(Store), 'default')
+        self.assertEqual(router.db_for_write(Store), 'default')
+
+    def test_reads_after_a_write_are_sticky(self):
+        self.assertEqual(self.request(self.factory.post('/')), 'default')
+        self.assertEqual(self.request(self.factory.get('/')), 'default')
+        # Other clients don't see the write before the replicas
+        self.assertEqual(self.request(self.factory.get('/', HTTP_AUTHORIZATION='Token other')), 'replica_0')
+
+        cache.delete(db_router.get_sticky_key(self.factory.get('/')))
+        self.assertEqual(self.request(self.factory.get('/')), 'replica_0')
+
+    def test_reads_after_a_write_in_a_safe_request(self):
+        def write_then_read(request):
+            router.db_for_write(Store)
+            return self.read(request)
+
+        self.assertEqual(self.request(self.factory.get('/'), db_router.ReplicaMiddleware(write_then_read)), 'default')
+
+    def test_reports_read_from_replicas(self):
+        read = db_router.reads_from_replica(lambda: router.db_for_read(Store))
+
+        self.assertEqual(read(), 'replica_0')
+        with db_router.use_primary():
+            self.assertEqual(read(), 'default')
+        with self.settings(REPLICA_DATABASES=[]):
+            self.assertEqual(read(), 'default')
+
+    @override_settings(REPLICA_DATABASES=['replica_0', 'replica_1'])
+    def test_requests_read_from_one_replica(self):
+        def read_twice(request):
+            return HttpResponse(f"{router.db_for_read(Store)} {router.db_for_read(Customer)}")
+
+        with patch.object(db_router.random, 'choice', side_effect=[ 'replica_0', 'replica_1', 'replica_1', 'replica_0' ]):
+            self.assertEqual(self.request(self.factory.get('/'), db_router.ReplicaMiddleware(read_twice)), 'replica_0 replica_0')
+            self.assertEqual(self.request(self.factory.get('/'), db_router.ReplicaMiddleware(read_twice)), 'replica_1 replica_1')
+
+    @override_settings(REPLICA_DATABASES=['replica_0', 'replica_1'])
+    def test_dashboard_sections_read_from_the_replica_of_the_request(self):
+        sections = { 'profit': lambda store, period: router.db_for_read(Store) }
+        with patch.dict(dashboard.SECTIONS, sections), ThreadPoolExecutor(1) as executor:
+            # In a thread, which closes its connections
+            compute = executor.submit(dashboard._compute_section_in_thread, Mock(pk=1), 'profit', 3, False, 'replica_1')
+            self.assertEqual(compute.result(), 'replica_1')
+        cache.delete(dashboard.get_section_cache_key(Mock(pk=1), 'profit', 3))
+
+    def test_writes_set_a_sticky_cookie(self):
+        # A login, without credentials yet
+        response = self.middleware(RequestFactory().post('/'))
+        self.assertEqual(response.cookies[db_router.STICKY_COOKIE]['max-age'], settings.REPLICA_STICKY_SECONDS)
+
+        request = RequestFactory(HTTP_AUTHORIZATION='Token new').get('/')
+        request.COOKIES[db_router.STICKY_COOKIE] = '1'
+        self.assertEqual(self.request(request), 'default')
+        self.assertEqual(self.request(RequestFactory(HTTP_AUTHORIZATION='Token new').get('/')), 'replica_0')
+
+    def test_reports_are_evaluated_on_replicas(self):
+        store = Store.objects.create( name='Souko', phone_number='+233209456202' )
+        ProfitTimestampedMetric.objects.create( store=store, profit=10.0, date=date.today() )
+        OrdersTimestampedMetric.objects.create( store=store, orders=2, date=date.today() )
+        db_router._local.pinned = False
+
+        # The replica of each read, from the test database standing in for it
+        replicas = []
+        with patch.object(db_router.ReplicaRouter, 'db_for_read', lambda *args, **hints: replicas.append(db_router.get_replica())):
+            profit_report = store.get_profit_report_by_period(period=constants.ALL_TIME)
+            orders_report = store.get_orders_report_by_period(period=constants.ALL_TIME)
+
+        self.assertEqual(replicas, [ 'replica_0', 'replica_0' ])
+
+        self.assertEqual(profit_report, [ { 'date': date.today(), 'profit': 10.0 } ])
+        self.assertEqual(orders_report, [ { 'date': date.today(), 'orders': 2 } ])
+
+
+class StorefrontTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.store = Store.objects.create( name='Souko', phone_number='+233209456202' )
+        self.url = reverse('store_for_customers', kwargs={ 'pk': self.store.pk })
+        self.products_url = reverse('store_products_for_customers', kwargs={ 'pk': self.store.pk })
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def wsgi_application(self, environ, start_response):
+        start_response('404 Not Found', [ ('Content-Type', 'application/json') ])
+        return [ json.dumps({ 'path': environ['PATH_INFO'], 'query': environ['QUERY_STRING'] }).encode() ]
+
+    def request(self, application, path):
+        async def get():
+            async with TestClient(TestServer(application, loop=self.loop), loop=self.loop) as client:
+                response = await client.get(path)
+                return response.status, await response.read()
+        return self.loop.run_until_complete(get())
+
+    def test_anonymous_responses_are_cached(self):
+        response = self.client.get(self.url, HTTP_ORIGIN='http://shop.example')
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url, HTTP_ORIGIN='http://shop.example')
+
+        self.assertEqual(cached.status_code, status.HTTP_200_OK)
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['Access-Control-Allow-Origin'], 'http://shop.example')
+
+    def test_responses_are_cached_by_media_type(self):
+        self.client.get(self.url, HTTP_ACCEPT='application/json')
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        page = self.client.get(self.url, HTTP_ACCEPT='text/html')
+
+        self.assertEqual(cached['Content-Type'], 'application/json')
+        self.assertEqual(page['Content-Type'], 'text/html; charset=utf-8')
+        # Varies on Cookie too
+        self.assertFalse(storefront.is_keyed(page))
+
+    def test_cache_key(self):
+        environ = { 'REQUEST_METHOD': 'GET', 'PATH_INFO': self.products_url }
+        key = storefront.get_cache_key(environ)
+
+        self.assertTrue(key)
+        self.assertNotEqual(storefront.get_cache_key({ **environ, 'QUERY_STRING': 'limit=1' }), key)
+        self.assertNotEqual(storefront.get_cache_key({ **environ, 'HTTP_ORIGIN': 'http://shop.example' }), key)
+        self.assertNotEqual(storefront.get_cache_key({ **environ, 'HTTP_ACCEPT': 'text/html' }), key)
+        self.assertIsNone(storefront.get_cache_key({ **environ, 'HTTP_AUTHORIZATION': 'Token invalid' }))
+        self.assertIsNone(storefront.get_cache_key({ **environ, 'REQUEST_METHOD': 'POST' }))
+        self.assertIsNone(storefront.get_cache_key({ **environ, 'PATH_INFO': reverse('stores') }))
+
+    def test_async_server(self):
+        # The Accept header of the aiohttp client
+        cached = self.client.get(self.url, HTTP_ACCEPT='*/*')
+        application = storefront.get_application(self.wsgi_application)
+
+        # Sent from the cache without running Django
+        self.assertEqual(self.request(application, self.url), (200, cached.content))
+        status_code, body = self.request(application, f'{self.products_url}?limit=1')
+        self.assertEqual(status_code, 404)
+        self.assertEqual(json.loads(body), { 'path': self.products_url, 'query': 'limit=1' })
+        self.assertEqual(self.request(application, reverse('stores'))[0], 404)
+
+
+class ImageVariantsTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # The local file system stands in for S3
+        settings_override = self.settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+            MEDIA_ROOT=f'{directory}/media',
+            MEDIA_URL='/media/',
+            IMAGE_STAGING_ROOT=f'{directory}/staging',
+            IMAGE_VARIANTS={ 'thumbnail': 16, 'large': 64 }
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(**{
+            'email': 'guy@ampersandllc.co',
+            'password': '2Password_',
+            'first_name': 'Guy',
+            'username': 'guitoo',
+            'last_name': 'Tanoh',
+            'is_email_confirmed': True
+        })
+        self.store = Store.objects.create( name='Souko', phone_number='+233209456202' )
+        self.product = Product.objects.create(**{
+            'store': self.store,
+            'name': 'Goyard Bags',
+            'buying_price': 170.0,
+            'selling_price': 300.0
+        })
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + generate_jwt_token(self.user))
+
+    def get_image(self, size=( 100, 50 )):
+        content = io.BytesIO()
+        Image.new('RGBA', size, ( 255, 0, 0, 128 )).save(content, 'PNG')
+        return SimpleUploadedFile('bag.png', content.getvalue(), content_type='image/png')
+
+    def upload(self):
+        url = reverse('product_details', kwargs={ 'pk': self.product.pk })
+        response = self.client.put(url, { 'product_picture_url': self.get_image() }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.product.refresh_from_db()
+        return self.product.product_picture_url.name
+
+    def test_upload_is_staged(self):
+        name = self.upload()
+
+        self.assertTrue(get_staging_storage().exists(name))
+        self.assertFalse(default_storage.exists(name))
+        message = OutboxMessage.objects.get(task=create_image_variants.name)
+        self.assertEqual(json.loads(message.args), [ 'main.Product', str(self.product.pk), 'product_picture_url' ])
+
+    def test_create_image_variants(self):
+        name = self.upload()
+        create_image_variants('main.Product', str(self.product.pk), 'product_picture_url')
+
+        self.product.refresh_from_db()
+        self.assertFalse(get_staging_storage().exists(name))
+        self.assertTrue(default_storage.exists(self.product.product_picture_url.name))
+        variants = json.loads(self.product.product_picture_variants)
+        self.assertEqual(set(variants), { 'thumbnail', 'large' })
+        with default_storage.open(variants['thumbnail']['webp']) as file:
+            self.assertEqual(Image.open(file).size, ( 16, 8 ))
+        with default_storage.open(variants['large']['jpeg']) as file:
+            self.assertEqual(Image.open(file).format, 'JPEG')
+
+        response = self.client.get(reverse('product_details', kwargs={ 'pk': self.product.pk }))
+        self.assertEqual(
+            response.data['product_picture_variants']['thumbnail']['webp'],
+            f"/media/{variants['thumbnail']['webp']}"
+        )
+
+    def test_tasks_of_replaced_uploads(self):
+        self.upload()
+        name = self.upload()
+        # One task per upload, both find the latest one
+        for _ in range(2):
+            create_image_variants('main.Product', str(self.product.pk), 'product_picture_url')
+
+        self.product.refresh_from_db()
+        self.assertFalse(get_staging_storage().exists(name))
+        self.assertTrue(default_storage.exists(self.product.product_picture_url.name))
+        self.assertTrue(self.product.product_picture_variants)
+
+    @patch('main.tasks.create_image_variants.retry')
+    def test_missing_staged_image_is_retried(self, retry):
+        retry.side_effect = Retry()
+        name = self.upload()
+        # Staged on another machine
+        get_staging_storage().delete(name)
+
+        with self.assertLogs('main.tasks', 'ERROR'), self.assertRaises(Retry):
+            create_image_variants('main.Product', str(self.product.pk), 'product_picture_url')
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.product_picture_url.name, name)
+        self.assertFalse(self.product.product_picture_variants)
+
+    def test_staging_root_is_required(self):
+        self.assertEqual(check_staging_root(None), [])
+        with self.settings(IMAGE_STAGING_ROOT=None):
+            self.assertEqual([ error.id for error in check_staging_root(None) ], [ 'main.E001' ])
+
+    def test_same_image_is_stored_once(self):
+        name = self.upload()
+        other = Product.objects.create( store=self.store, name='Goyard Wallet', buying_price=70.0, selling_price=120.0 )
+        other.product_picture_url = self.get_image()
+        other.save()
+
+        self.assertEqual(other.product_picture_url.name, name)
+        self.assertTrue(name.startswith(hashlib.sha256(self.get_image().read()).hexdigest()))
+        for product in ( self.product, other ):
+            create_image_variants('main.Product', str(product.pk), 'product_picture_url')
+            product.refresh_from_db()
+        self.assertEqual(other.product_picture_variants, self.product.product_picture_variants)
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 5)
+
+    @override_settings(IMAGE_CONTENT_ADDRESSED=False)
+    def test_deduplicate_images(self):
+        other = Product.objects.create( store=self.store, name='Goyard Wallet', buying_price=70.0, selling_price=120.0 )
+        for product in ( self.product, other ):
+            product.product_picture_url = self.get_image()
+            product.save()
+            create_image_variants('main.Product', str(product.pk), 'product_picture_url')
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 10)
+
+        call_command('deduplicate-images', '--delete', stdout=io.StringIO())
+
+        self.product.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(other.product_picture_url.name, self.product.product_picture_url.name)
+        self.assertEqual(other.product_picture_variants, self.product.product_picture_variants)
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 5)
+        for formats in json.loads(other.product_picture_variants).values():
+            for name in formats.values():
+                self.assertTrue(default_storage.exists(name))
+
+    def test_bulk_upload(self):
+        other = Product.objects.create( store=self.store, name='Goyard Wallet', buying_price=70.0, selling_price=120.0 )
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as images:
+            images.writestr(f'images/{self.product.pk}.png', self.get_image().read())
+            images.writestr('__MACOSX/images/._bag.png', b'')
+        url = reverse('store_product_images', kwargs={ 'pk': self.store.pk })
+
+        response = self.client.post(url, {
+            'archive': SimpleUploadedFile('images.zip', archive.getvalue()),
+            str(other.pk): self.get_image(( 40, 40 )),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({ product['id'] for product in response.data['products'] }, { str(self.product.pk), str(other.pk) })
+        for product in ( self.product, other ):
+            product.refresh_from_db()
+            self.assertTrue(get_staging_storage().exists(product.product_picture_url.name))
+        self.assertEqual(OutboxMessage.objects.filter(task=create_image_variants.name).count(), 2)
+
+    def test_bulk_upload_of_unknown_product(self):
+        url = reverse('store_product_images', kwargs={ 'pk': self.store.pk })
+        other_store = Store.objects.create( name='Other', phone_number='+233209456202' )
+        other = Product.objects.create( store=other_store, name='Goyard Wallet', buying_price=70.0, selling_price=120.0 )
+
+        response = self.client.post(url, {
+            str(self.product.pk): self.get_image(),
+            str(other.pk): self.get_image(),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], f'No product {other.pk} in this store')
+        self.assertFalse(OutboxMessage.objects.filter(task=create_image_variants.name).exists())
+
+    def test_bulk_upload_of_zip_bombs(self):
+        other = Product.objects.create( store=self.store, name='Goyard Wallet', buying_price=70.0, selling_price=120.0 )
+        url = reverse('store_product_images', kwargs={ 'pk': self.store.pk })
+
+        def post(*keys):
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as images:
+                for key in keys:
+                    # Compresses to a few KB
+                    images.writestr(f'{key}.png', bytes(1024 * 1024))
+            return self.client.post(url, { 'archive': SimpleUploadedFile('images.zip', archive.getvalue()) }, format='multipart')
+
+        with self.settings(IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE=1024 * 1024 - 1):
+            response = post(self.product.pk)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], f'{self.product.pk}.png is larger than 1024.0\xa0KB')
+
+        with self.settings(IMAGE_BULK_UPLOAD_MAX_SIZE=2 * 1024 * 1024 - 1):
+            response = post(self.product.pk, other.pk)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], 'The images are larger than 2.0\xa0MB in all')
+        self.assertFalse(OutboxMessage.objects.filter(task=create_image_variants.name).exists())
+
+
+@skipUnless(settings.REDIS_URL, "Rate limits are kept in Redis")
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        self.provider = 'test-provider'
+        with app.pool.acquire(block=True) as conn:
+            conn.default_channel.client.delete(
+                f'souko:bucket:{self.provider}', f'souko:circuit-open:{self.provider}',
+                f'souko:circuit-failures:{self.provider}', f'souko:circuit-half-open:{self.provider}'
+            )
+
+    def fail(self):
+        with self.assertRaises(ProviderUnavailable):
+            with provider_call(self.provider):
+                raise ProviderUnavailable(self.provider, 1)
+
+    def close_cooldown(self):
+        # As if the cooldown and the failures window were over
+        with app.pool.acquire(block=True) as conn:
+            conn.default_channel.client.delete(
+                f'souko:circuit-open:{self.provider}', f'souko:circuit-failures:{self.provider}'
+            )
+
+    def test_bucket_allows_burst_then_throttles(self):
+        with self.settings(PROVIDER_RATE_LIMITS={self.provider: {'rate': 1, 'burst': 3}}):
+            for _ in range(3):
+                take(self.provider)
+            with self.assertRaises(Throttled) as throttled:
+                take(self.provider)
+        self.assertGreater(throttled.exception.retry_after, 0)
+        self.assertLessEqual(throttled.exception.retry_after, 1)
+
+    def test_circuit_opens_after_failures(self):
+        limits = {self.provider: {'rate': 100, 'burst': 100}}
+        with self.settings(PROVIDER_RATE_LIMITS=limits, CIRCUIT_BREAKER_THRESHOLD=2, CIRCUIT_BREAKER_COOLDOWN=30):
+            for _ in range(2):
+                with self.assertRaises(ProviderUnavailable):
+                    with provider_call(self.provider):
+                        raise ProviderUnavailable(self.provider, 1)
+            with self.assertRaises(Throttled) as throttled:
+                take(self.provider)
+        self.assertGreater(throttled.exception.retry_after, 29)
+
+    def test_transport_errors_open_circuit(self):
+        limits = {self.provider: {'rate': 100, 'burst': 100}}
+        with self.settings(PROVIDER_RATE_LIMITS=limits, CIRCUIT_BREAKER_THRESHOLD=2, CIRCUIT_BREAKER_COOLDOWN=30):
+            for error in ( requests.ConnectionError(), requests.Timeout() ):
+                with self.assertRaises(ProviderUnavailable):
+                    with provider_call(self.provider):
+                        raise error
+            with self.assertRaises(Throttled):
+                take(self.provider)
+
+    def test_first_failure_after_cooldown_reopens_circuit(self):
+        limits = {self.provider: {'rate': 100, 'burst': 100}}
+        with self.settings(PROVIDER_RATE_LIMITS=limits, CIRCUIT_BREAKER_THRESHOLD=2, CIRCUIT_BREAKER_COOLDOWN=30):
+            for _ in range(2):
+                self.fail()
+            self.close_cooldown()
+            self.fail()
+            with self.assertRaises(Throttled):
+                take(self.provider)
+
+    def test_success_after_cooldown_closes_circuit(self):
+        limits = {self.provider: {'rate': 100, 'burst': 100}}
+        with self.settings(PROVIDER_RATE_LIMITS=limits, CIRCUIT_BREAKER_THRESHOLD=2, CIRCUIT_BREAKER_COOLDOWN=30):
+            for _ in range(2):
+                self.fail()
+            self.close_cooldown()
+            with provider_call(self.provider):
+                pass
+            self.fail()
+            take(self.provider)
+
+    def test_open_circuit_spends_no_token(self):
+        limits = {self.provider: {'rate': 0.001, 'burst': 1}}
+        with self.settings(PROVIDER_RATE_LIMITS=limits, CIRCUIT_BREAKER_THRESHOLD=1, CIRCUIT_BREAKER_COOLDOWN=30):
+            with app.pool.acquire(block=True) as conn:
+                conn.default_channel.client.set(f'souko:circuit-open:{self.provider}', 1, ex=30)
+            with self.assertRaises(Throttled):
+                take(self.provider)
+            self.close_cooldown()
+            # The only token of the bucket is still there
+            take(self.provider)
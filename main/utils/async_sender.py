@@ -0,0 +1,81 @@
+"""
+Concurrent provider calls for bulk notifications.
+
+``send_all`` makes many requests over one event loop and one aiohttp session,
+at most ``NOTIFICATIONS_CONCURRENCY`` in flight at a time, so a worker
+process isn't limited to one provider call per slot. Each request takes its
+token from the provider's rate limiter first and is retried on its own, up to
+``NOTIFICATIONS_RETRIES`` times, when the provider is overloaded or
+unreachable.
+"""
+import asyncio
+
+import aiohttp
+from django.conf import settings
+
+from .. import rate_limit
+from ..rate_limit import Throttled, ProviderUnavailable
+from .mail.emailer import get_retry_after
+
+
+class ProviderRejected(Exception):
+    """The provider refused the request, sending it again won't help"""
+
+    def __init__(self, provider, status, reason):
+        super().__init__(f"{provider} rejected the request with {status}: {reason}")
+        self.status = status
+
+
+def send_all(requests, concurrency=None):
+    """
+    Make ``requests`` concurrently and return the outcome of each in the same
+    order: None when it was accepted, ProviderRejected when it was refused, or
+    Throttled when it should be tried again after ``retry_after`` seconds.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _send_all(requests, concurrency or settings.NOTIFICATIONS_CONCURRENCY, loop)
+        )
+    finally:
+        loop.close()
+
+
+async def _send_all(requests, concurrency, loop):
+    semaphore = asyncio.Semaphore(concurrency, loop=loop)
+    connector = aiohttp.TCPConnector(limit=concurrency, loop=loop)
+    timeout = aiohttp.ClientTimeout(total=settings.PROVIDER_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, loop=loop) as session:
+        return await asyncio.gather(
+            *[ _send(session, semaphore, request, loop) for request in requests ],
+            loop=loop
+        )
+
+
+async def _send(session, semaphore, request, loop):
+    error = None
+    async with semaphore:
+        for attempt in range(settings.NOTIFICATIONS_RETRIES + 1):
+            try:
+                # The limiter is shared with the other workers through Redis
+                await loop.run_in_executor(None, rate_limit.take, request.provider)
+                async with session.request(request.method, request.url, **request.kwargs) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise ProviderUnavailable(request.provider, get_retry_after(response.headers))
+                    if response.status >= 400:
+                        return ProviderRejected(request.provider, response.status, await response.text())
+                await loop.run_in_executor(None, rate_limit.record_success, request.provider)
+                return None
+            except ProviderUnavailable as e:
+                await loop.run_in_executor(None, rate_limit.record_failure, request.provider)
+                error = e
+            except Throttled as e:
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                error = Throttled(request.provider, 0.5 * 2 ** attempt)
+
+            if error.retry_after > settings.NOTIFICATIONS_MAX_WAIT:
+                # Not worth holding the worker, the task reschedules it
+                return error
+            await asyncio.sleep(error.retry_after, loop=loop)
+    return error
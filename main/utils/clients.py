@@ -0,0 +1,154 @@
+"""
+Clients of the email and SMS providers, shared by the code of a process.
+
+Clients are created on first use, so each worker process gets its own after
+the fork instead of inheriting sockets opened by the parent, and then reused
+so requests go over the keep-alive connections of their pool. Changing a
+provider setting (``override_settings`` in tests) drops the clients.
+"""
+import io
+import os
+import threading
+from collections import namedtuple
+from urllib.error import HTTPError
+
+import sendgrid
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from python_http_client.exceptions import handle_error
+from requests import Session
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+PROVIDER_SETTINGS = (
+    'SENDGRID_API_KEY', 'SENDGRID_API_HOST', 'TWILIO_ACCOUNT_SID',
+    'TWILIO_AUTH_TOKEN', 'PROVIDER_POOL_SIZE', 'PROVIDER_TIMEOUT'
+)
+
+# A call to a provider for main.utils.async_sender, ``kwargs`` go to aiohttp
+ProviderRequest = namedtuple('ProviderRequest', 'provider method url kwargs')
+
+_factories = {}
+_clients = {}
+_sessions = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def register(name):
+    def decorator(factory):
+        _factories[name] = factory
+        return factory
+    return decorator
+
+
+def get_session(name):
+    """
+    Keep-alive session for ``name``, pooling up to ``PROVIDER_POOL_SIZE``
+    connections per host.
+    """
+    session = Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.PROVIDER_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    _sessions[name] = session
+    return session
+
+
+def get_client(name):
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # Forked, the clients belong to the parent
+            _clients.clear()
+            _sessions.clear()
+            _pid = os.getpid()
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+
+def reset_clients():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _clients.clear()
+        _sessions.clear()
+
+
+@receiver(setting_changed)
+def reset_clients_on_setting_changed(sender, setting, **kwargs):
+    if setting in PROVIDER_SETTINGS:
+        reset_clients()
+
+
+def get_pool_stats():
+    """
+    Connections opened, requests made and idle connections of the pools of
+    each provider created in this process.
+    """
+    stats = {}
+    for name, session in list(_sessions.items()):
+        pools = []
+        for adapter in set(session.adapters.values()):
+            containers = adapter.poolmanager.pools
+            # Other threads add pools as they call new hosts
+            with containers.lock:
+                pools += [ pool for pool in containers._container.values() if pool.pool ]
+        idle = 0
+        for pool in pools:
+            with pool.pool.mutex:
+                # The queue holds None for every connection not opened yet
+                idle += sum(1 for conn in pool.pool.queue if conn)
+        stats[name] = {
+            'connections': sum(pool.num_connections for pool in pools),
+            'requests': sum(pool.num_requests for pool in pools),
+            'idle': idle,
+        }
+    return stats
+
+
+class SendGridClient(object):
+    """
+    The mail send endpoint of ``sendgrid.SendGridAPIClient``, which opens a
+    new connection for every request, over a keep-alive session.
+    """
+
+    def __init__(self, api_key, host, session, timeout):
+        self.url = f'{host.rstrip("/")}/v3/mail/send'
+        self.session = session
+        self.timeout = timeout
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'User-Agent': f'sendgrid/{sendgrid.__version__};python',
+            'Accept': 'application/json',
+        }
+
+    def send(self, message):
+        response = self.session.post(self.url, json=message, headers=self.headers, timeout=self.timeout)
+        if response.status_code >= 400:
+            # Same exceptions as the sendgrid client
+            raise handle_error(HTTPError(
+                response.url, response.status_code, response.reason,
+                response.headers, io.BytesIO(response.content)
+            ))
+        return response
+
+
+@register('sendgrid')
+def create_sendgrid_client():
+    return SendGridClient(
+        settings.SENDGRID_API_KEY,
+        settings.SENDGRID_API_HOST,
+        get_session('sendgrid'),
+        settings.PROVIDER_TIMEOUT
+    )
+
+
+@register('twilio')
+def create_twilio_client():
+    http_client = TwilioHttpClient(timeout=settings.PROVIDER_TIMEOUT)
+    http_client.session = get_session('twilio')
+    return Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
@@ -1,6 +1,5 @@
 import logging
 import time
-import sendgrid
 from sendgrid.helpers.mail import (
     Mail, Content, To, Subject, Substitution,
     MimeType, TemplateId, From, DynamicTemplateData
@@ -9,20 +8,38 @@ from python_http_client import exceptions
 
 from django.conf import settings
 
+from ...rate_limit import ProviderUnavailable
+from ..clients import get_client, ProviderRequest
+
 logger = logging.getLogger(__name__)
 
-sg = sendgrid.SendGridAPIClient(getattr(settings, 'SENDGRID_API_KEY'))
+
+class EmailRejected(Exception):
+    """SendGrid refused the request as invalid, sending it again won't help"""
+
 
 class Emailer(object):
-    def __init__(self, template_id, tos, subject, context, index):
+    def __init__(self, template_id, tos=None, subject=None, context=None, index=0):
         self.message = Mail()
         self._compose( template_id, subject )
-        self.add_personalization( tos, subject, context, index )
+        if tos:
+            self.add_personalization( tos, subject, context, index )
+
+    @classmethod
+    def for_batch(cls, template_id, messages):
+        """
+        One email with a personalization for each ``(tos, subject, context)``
+        """
+        emailer = cls( template_id, subject=messages[0][1] )
+        for index, ( tos, subject, context ) in enumerate( messages ):
+            emailer.add_personalization( tos, subject, context, index )
+        return emailer
 
     def _compose(self, template_id, subject):
         self.message.content = Content(MimeType.html, '<strong>Souko</strong>')
         self.message.template_id = TemplateId(template_id)
-        self.message.subject = subject
+        if subject:
+            self.message.subject = subject
         self.message.from_email = From(getattr(settings, 'SENDER_EMAIL'), 'Souko')
 
     def add_personalization(self, tos, subject, template_data, index):
@@ -30,16 +47,32 @@ class Emailer(object):
         self.message.subject = Subject(subject, p=index)
         self.message.dynamic_template_data = DynamicTemplateData(template_data, p=index)
 
+    def get_request(self):
+        client = get_client('sendgrid')
+        return ProviderRequest(
+            'sendgrid', 'POST', client.url, {'json': self.message.get(), 'headers': client.headers}
+        )
+
     def send(self):
         try:
-            response = sg.send(message=self.message.get())
+            response = get_client('sendgrid').send(message=self.message.get())
             return response.status_code
-        except (exceptions.InternalServerError, exceptions.ServiceUnavailableError,
-                exceptions.TooManyRequestsError) as e:
-            time.sleep(60)
-            self.send()
         except exceptions.BadRequestsError as e:
             logger.exception('[EXCEPTION] Bad request')
-            raise(Exception(e.reason))
-        except Exception as e:
+            raise(EmailRejected(e.reason))
+        except exceptions.HTTPError as e:
+            if e.status_code == 429 or e.status_code >= 500:
+                raise(ProviderUnavailable('sendgrid', get_retry_after(e.headers)))
             raise(e)
+
+
+def get_retry_after(headers):
+    """
+    Seconds SendGrid asked to wait, from ``Retry-After`` or the epoch in
+    ``X-RateLimit-Reset``
+    """
+    if headers.get('Retry-After'):
+        return max(float(headers['Retry-After']), 1)
+    if headers.get('X-RateLimit-Reset'):
+        return max(float(headers['X-RateLimit-Reset']) - time.time(), 1)
+    return getattr(settings, 'PROVIDER_RETRY_AFTER')
@@ -0,0 +1,119 @@
+"""
+Local stand-in for the SendGrid v3 mail send API, used by tests and
+throughput benchmarks.
+
+Requests are answered with 202 after ``latency`` seconds, like SendGrid
+accepting a message, and new connections wait ``handshake`` seconds first to
+stand for the TCP and TLS set up with the real API. A request with a recipient on the ``invalid`` domain is
+rejected with 400, and statuses put in ``responses`` are answered first, e.g.
+``[429, 503]`` to act like an overloaded SendGrid.
+"""
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, keep-alive clients would wait on delayed ACKs
+    disable_nagle_algorithm = True
+    accepted = 202
+    rejected = "@invalid"
+
+    def setup(self):
+        super().setup()
+        self.server.wait(self.server.handshake)
+
+    def read_messages(self, body):
+        """The messages of the request and their recipients"""
+        personalizations = json.loads(body).get("personalizations", [])
+        return personalizations, [ to["email"] for p in personalizations for to in p.get("to", []) ]
+
+    def do_POST(self):
+        messages, recipients = self.read_messages(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        with self.server.in_flight():
+            self.respond(messages, recipients)
+
+    def respond(self, messages, recipients):
+        self.server.wait()
+        status = self.server.next_response()
+        if status:
+            self._respond(status, {"errors": [{"message": "Unavailable"}]}, {"Retry-After": self.server.retry_after})
+            return
+        if any(self.rejected in recipient for recipient in recipients):
+            self._respond(400, {"errors": [{"message": "Invalid recipient", "field": "personalizations"}]})
+            return
+
+        self.server.record(messages)
+        self._respond(self.accepted)
+
+    def _respond(self, status, body=None, headers=None):
+        content = json.dumps(body).encode() if body else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSendGridServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Room for hundreds of clients connecting at once
+    request_queue_size = 1024
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, handshake=0.0, handler=FakeSendGridHandler):
+        super().__init__(address, handler)
+        self.latency = latency
+        self.handshake = handshake
+        self.responses = []
+        self.retry_after = 30
+        self.requests = 0
+        self.messages = []
+        self.concurrent = 0
+        self.peak_concurrent = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def wait(self, seconds=None):
+        self._stopped.wait(self.latency if seconds is None else seconds)
+
+    @contextmanager
+    def in_flight(self):
+        with self._lock:
+            self.concurrent += 1
+            self.peak_concurrent = max(self.peak_concurrent, self.concurrent)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.concurrent -= 1
+
+    def next_response(self):
+        with self._lock:
+            return self.responses.pop(0) if self.responses else None
+
+    def record(self, messages):
+        with self._lock:
+            self.requests += 1
+            self.messages.extend(messages)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,23 @@
+"""
+Local stand-in for the Twilio messages API, used by tests and benchmarks.
+Behaves like the fake SendGrid server; numbers starting with +000 are
+rejected.
+"""
+from urllib.parse import parse_qs
+
+from ..mail.fake_server import FakeSendGridHandler, FakeSendGridServer
+
+
+class FakeTwilioHandler(FakeSendGridHandler):
+    accepted = 201
+    rejected = "+000"
+
+    def read_messages(self, body):
+        message = { name: values[0] for name, values in parse_qs(body.decode()).items() }
+        return [message], [message.get("To", "")]
+
+
+class FakeTwilioServer(FakeSendGridServer):
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, handshake=0.0, handler=FakeTwilioHandler):
+        super().__init__(address, latency, handshake, handler)
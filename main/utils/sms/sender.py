@@ -1,14 +1,36 @@
 import logging
 
+import aiohttp
 from django.conf import settings
-from twilio.rest import Client
+from twilio.base.exceptions import TwilioRestException
+
+from ...rate_limit import ProviderUnavailable
+from ..clients import get_client, ProviderRequest
 
 logger = logging.getLogger(__name__)
 
 def send( body, to ):
-    client = Client( getattr( settings, 'TWILIO_ACCOUNT_SID' ), getattr( settings, 'TWILIO_AUTH_TOKEN' ) )
-    client.messages.create(
-        body=body,
-        from_=getattr( settings, 'TWILIO_NUMBER' ),
-        to=to
-    )
\ No newline at end of file
+    client = get_client( 'twilio' )
+    try:
+        client.messages.create(
+            body=body,
+            from_=getattr( settings, 'TWILIO_NUMBER' ),
+            to=to
+        )
+    except TwilioRestException as e:
+        if e.status == 429 or e.status >= 500:
+            raise ProviderUnavailable( 'twilio', getattr( settings, 'PROVIDER_RETRY_AFTER' ) )
+        raise
+
+
+def get_request( body, to ):
+    account_sid = getattr( settings, 'TWILIO_ACCOUNT_SID' )
+    return ProviderRequest(
+        'twilio',
+        'POST',
+        f"{getattr( settings, 'TWILIO_API_HOST' )}/2010-04-01/Accounts/{account_sid}/Messages.json",
+        {
+            'data': { 'Body': body, 'From': getattr( settings, 'TWILIO_NUMBER' ), 'To': to },
+            'auth': aiohttp.BasicAuth( account_sid, getattr( settings, 'TWILIO_AUTH_TOKEN' ) ),
+        }
+    )
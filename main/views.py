@@ -1,3 +1,26 @@
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
 
-# Create your views here.
+from .models import QueryStatsSnapshot
+
+
+@staff_member_required
+def query_stats(request):
+    """
+    Hot queries since the latest snapshot, or between the ``before`` and
+    ``after`` snapshots (ids or labels)
+    """
+    try:
+        before, after, statements = QueryStatsSnapshot.objects.report(
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            order=request.GET.get('order', 'total_time'),
+            limit=int(request.GET.get('limit', 20))
+        )
+        return JsonResponse({
+            'before': str(before.pk) if before else None,
+            'after': str(after.pk) if after else None,
+            'statements': statements
+        })
+    except Exception as e:
+        return JsonResponse({"message": str(e)}, status=400)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 from datetime import timedelta
 import dj_database_url
 
@@ -43,6 +44,7 @@ CORS_EXPOSE_HEADERS = (
     'authorization',
     'x-csrftoken',
     'access-control-allow-origin',
+    'server-timing',
 )
 
 CORS_ALLOW_METHODS = (
@@ -108,6 +110,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers the other middlewares
+    'main.performance.PerformanceMiddleware',
+    'main.metrics.MetricsMiddleware',
+    'main.db_router.ReplicaMiddleware',
+    # Before the middlewares adding headers, which are cached with the response
+    'api.storefront.StorefrontCacheMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -151,9 +159,9 @@ WSGI_APPLICATION = 'soukoapi.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
+# DATABASE_URL, when set, replaces the DATABASE_* variables
 DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.postgresql_psycopg2",
+    "default": dj_database_url.parse(get_secret("DATABASE_URL")) if get_secret("DATABASE_URL") else {
         "NAME": get_secret("DATABASE_NAME"),
         "USER": get_secret("DATABASE_USER"),
         "PASSWORD": get_secret("DATABASE_PASSWORD"),
@@ -161,6 +169,38 @@ DATABASES = {
         "PORT": get_secret("DATABASE_PORT"),
     }
 }
+DATABASES["default"].update({
+    "ENGINE": "main.backends.postgresql",
+    # Seconds a connection is kept for the next requests or tasks of its
+    # process or thread, 0 to open one for each
+    "CONN_MAX_AGE": int(get_secret("DATABASE_CONN_MAX_AGE", 60)),
+    # Check a kept connection before the first query of a request or task
+    "CONN_HEALTH_CHECKS": get_secret("DATABASE_CONN_HEALTH_CHECKS", "true").lower() == "true",
+    # Behind PgBouncer in transaction pooling mode, where a cursor can't
+    # outlive its transaction, so querysets are iterated client side
+    "DISABLE_SERVER_SIDE_CURSORS": get_secret("DATABASE_PGBOUNCER", "false").lower() == "true",
+})
+
+# Streaming replicas of the default database, as "host[:port]" separated by
+# commas. Safe requests and the store reports read from them, see
+# main.db_router. Leave it empty to run the tests, which only use default
+REPLICA_DATABASES = []
+for index, replica in enumerate(filter(None, get_secret("DATABASE_REPLICA_HOSTS", "").split(","))):
+    host, _, port = replica.strip().partition(":")
+    DATABASES[f"replica_{index}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        # Tests read the replicas from the test database
+        "TEST": { "MIRROR": "default" },
+    }
+    REPLICA_DATABASES.append(f"replica_{index}")
+
+DATABASE_ROUTERS = ["main.db_router.ReplicaRouter"]
+
+# Seconds a client reads from the primary after a write, to see it while the
+# replicas catch up
+REPLICA_STICKY_SECONDS = int(get_secret("REPLICA_STICKY_SECONDS", 5))
 
 
 # Password validation
@@ -206,6 +246,57 @@ USE_TZ = True
 
 SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
 
+SENDGRID_API_HOST = os.environ.get('SENDGRID_API_HOST', 'https://api.sendgrid.com')
+
+# Most personalizations (and recipients) SendGrid accepts in one request
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+
+# Seconds emails are collected for before a batch is sent
+EMAIL_BATCH_WINDOW = int(get_secret("EMAIL_BATCH_WINDOW", 5))
+
+# Seconds after which the emails a batch is still sending are put back,
+# longer than any batch takes
+EMAIL_SENDING_TIMEOUT = int(get_secret("EMAIL_SENDING_TIMEOUT", 600))
+
+# Requests per second and burst allowed to each provider by all workers together
+PROVIDER_RATE_LIMITS = {
+    "sendgrid": {
+        "rate": float(get_secret("SENDGRID_RATE_LIMIT", 10)),
+        "burst": int(get_secret("SENDGRID_RATE_BURST", 20)),
+    },
+    "twilio": {
+        "rate": float(get_secret("TWILIO_RATE_LIMIT", 1)),
+        "burst": int(get_secret("TWILIO_RATE_BURST", 5)),
+    },
+}
+
+# Keep-alive connections kept per provider host in each process, and request timeout
+PROVIDER_POOL_SIZE = int(get_secret("PROVIDER_POOL_SIZE", 10))
+PROVIDER_TIMEOUT = 30
+
+# Provider calls a worker process keeps in flight when sending in bulk, how
+# many times each is retried and the longest it waits for the rate limiter
+NOTIFICATIONS_CONCURRENCY = int(get_secret("NOTIFICATIONS_CONCURRENCY", 200))
+NOTIFICATIONS_RETRIES = 3
+NOTIFICATIONS_MAX_WAIT = 5
+
+# SendGrid requests a batch of emails sends at the same time
+EMAIL_BATCH_REQUESTS = 10
+
+# Tasks the outbox relay publishes per transaction, and seconds between checks
+# of the outbox when no NOTIFY arrives
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_POLL_INTERVAL = 5
+
+# Seconds to wait when a provider is overloaded without saying for how long
+PROVIDER_RETRY_AFTER = 60
+
+# A provider failing this many times within the window is left alone for the
+# cooldown, then left alone again on its first failure within the next window
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_WINDOW = 60
+CIRCUIT_BREAKER_COOLDOWN = 120
+
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL')
 
 FRONTEND_BASE_URL = os.environ.get( 'FRONTEND_BASE_URL' )
@@ -224,6 +315,141 @@ EMAIL_USE_TLS = True
 
 REDIS_URL = os.environ.get("REDIS_URL")
 
+CACHES = {
+    "default": {
+        "BACKEND": "main.cache.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "souko",
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # A cache outage should slow requests down, not fail them
+            "IGNORE_EXCEPTIONS": True,
+        },
+    }
+} if REDIS_URL else {
+    "default": {
+        "BACKEND": "main.cache.LocMemCache",
+    }
+}
+
+# Seconds each section of the store dashboard is cached for
+DASHBOARD_CACHE_TTLS = {
+    "profit": int(get_secret("DASHBOARD_PROFIT_TTL", 300)),
+    "orders": int(get_secret("DASHBOARD_ORDERS_TTL", 60)),
+    "stock": int(get_secret("DASHBOARD_STOCK_TTL", 120)),
+}
+
+DASHBOARD_MAX_WORKERS = int(get_secret("DASHBOARD_MAX_WORKERS", 3))
+
+# Most matches of a search ranked by trigram similarity, larger match sets
+# keep the default ordering rather than ranking every row, see api.filters
+SEARCH_RANK_MAX_MATCHES = int(get_secret("SEARCH_RANK_MAX_MATCHES", 1000))
+
+# Seconds the anonymous storefront responses are cached for
+STOREFRONT_CACHE_TTL = int(get_secret("STOREFRONT_CACHE_TTL", 30))
+
+# Threads of an async storefront worker handling the requests missing from
+# the cache, each with its own database connection
+STOREFRONT_MAX_WORKERS = int(get_secret("STOREFRONT_MAX_WORKERS", 4))
+
+# Fraction of requests answered with a Server-Timing header, staff always get it
+PERFORMANCE_SAMPLE_RATE = float(get_secret("PERFORMANCE_SAMPLE_RATE", 0))
+
+# Requests making more queries are logged as warnings with their view
+PERFORMANCE_QUERY_THRESHOLD = int(get_secret("PERFORMANCE_QUERY_THRESHOLD", 50))
+
+# Token Prometheus sends as "Authorization: Bearer <token>" to read /metrics/.
+# Without one /metrics/ is only served with DEBUG on
+METRICS_TOKEN = get_secret("METRICS_TOKEN")
+
+# Port the main process of a celery worker serves its metrics on, run-worker
+# gives the following ones to its other pools
+WORKER_METRICS_PORT = get_secret("WORKER_METRICS_PORT")
+
+# Tag queries with a comment naming their view or task and model, for the
+# query-stats report
+QUERY_TAGS = get_secret("QUERY_TAGS", "true").lower() == "true"
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+    },
+    "loggers": {
+        "main.performance": {
+            "handlers": ["console"],
+            "level": get_secret("PERFORMANCE_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
+# Seconds after which a task published by beat is forgotten if no worker
+# reported it finished (e.g. the worker was killed)
+SCHEDULER_INFLIGHT_TTL = int(get_secret("SCHEDULER_INFLIGHT_TTL", 15 * 60))
+
+# Most scheduled tasks a queue may have in flight at once, queues that are
+# not listed have no cap
+SCHEDULER_QUEUE_CAPS = {
+    "fetch_reports": int(get_secret("SCHEDULER_FETCH_REPORTS_CAP", 200)),
+}
+
+# Seconds a store fan out waits for its queue to drain below the cap
+FAN_OUT_RETRY_DELAY = int(get_secret("FAN_OUT_RETRY_DELAY", 10))
+
+# Worker pools started by run-worker, each consuming its own queues so slow
+# reports never hold up notifications. Notification tasks are short and
+# mostly wait on providers, report tasks are long and leak memory over time.
+WORKER_POOLS = {
+    "notifications": {
+        "queues": ["send_email"],
+        "autoscale": (
+            int(get_secret("NOTIFICATIONS_WORKER_MAX_CONCURRENCY", 8)),
+            int(get_secret("NOTIFICATIONS_WORKER_MIN_CONCURRENCY", 2)),
+        ),
+        "prefetch_multiplier": int(get_secret("NOTIFICATIONS_WORKER_PREFETCH", 4)),
+        "max_tasks_per_child": 1000,
+    },
+    "reports": {
+        "queues": ["fetch_reports"],
+        "autoscale": (
+            int(get_secret("REPORTS_WORKER_MAX_CONCURRENCY", 4)),
+            int(get_secret("REPORTS_WORKER_MIN_CONCURRENCY", 1)),
+        ),
+        # One task at a time per process, a long report doesn't hold others back
+        "prefetch_multiplier": 1,
+        "max_tasks_per_child": 100,
+    },
+    "images": {
+        "queues": ["images"],
+        "concurrency": int(get_secret("IMAGES_WORKER_CONCURRENCY", 2)),
+        # Resizing is slow and takes memory
+        "prefetch_multiplier": 1,
+        "max_tasks_per_child": 100,
+    },
+    "default": {
+        "queues": ["celery"],
+        "concurrency": int(get_secret("DEFAULT_WORKER_CONCURRENCY", 2)),
+        "prefetch_multiplier": 4,
+        "max_tasks_per_child": 1000,
+    },
+}
+
+# Results of benchmark-endpoints the runs are compared to, per scale
+BENCHMARK_BASELINES = os.path.join(BASE_DIR, "main", "benchmark_baselines.json")
+
+# Allowed regression over a baseline: p95 ratio plus slack in ms, extra
+# queries, and response size ratio
+BENCHMARK_THRESHOLDS = {
+    "latency": float(get_secret("BENCHMARK_LATENCY_THRESHOLD", 1.5)),
+    "latency_slack": float(get_secret("BENCHMARK_LATENCY_SLACK", 5)),
+    "queries": 0,
+    "bytes": 1.1,
+}
+
 FILE_UPLOAD_HANDLERS = ("django.core.files.uploadhandler.TemporaryFileUploadHandler",)
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024
@@ -246,12 +472,44 @@ AWS_S3_COMPRESSED_IMAGES_DOMAIN = get_secret("AWS_S3_COMPRESSED_IMAGES_DOMAIN")
 
 DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
 
+# Local directory uploaded images are kept in until create_image_variants
+# moves them to the default storage. It must be shared by the web and worker
+# processes, so production settings have no default, see main.storage
+IMAGE_STAGING_ROOT = get_secret("IMAGE_STAGING_ROOT", os.path.join(tempfile.gettempdir(), "souko-uploads"))
+
+# Name uploaded images after the hash of their content, so the same image
+# is stored once, see main.storage
+IMAGE_CONTENT_ADDRESSED = get_secret("IMAGE_CONTENT_ADDRESSED", "true").lower() == "true"
+
+# Longest side in pixels of each variant of the uploaded images
+IMAGE_VARIANTS = {
+    "thumbnail": int(get_secret("IMAGE_THUMBNAIL_SIZE", 160)),
+    "small": int(get_secret("IMAGE_SMALL_SIZE", 480)),
+    "large": int(get_secret("IMAGE_LARGE_SIZE", 1200)),
+}
+
+IMAGE_QUALITY = int(get_secret("IMAGE_QUALITY", 80))
+
+# Files create_image_variants uploads at the same time
+IMAGE_UPLOAD_WORKERS = int(get_secret("IMAGE_UPLOAD_WORKERS", 4))
+
+# Images a bulk upload request saves at the same time, and at most
+IMAGE_BULK_UPLOAD_WORKERS = int(get_secret("IMAGE_BULK_UPLOAD_WORKERS", 4))
+IMAGE_BULK_UPLOAD_MAX_FILES = int(get_secret("IMAGE_BULK_UPLOAD_MAX_FILES", 200))
+
+# Largest image and images of a bulk upload request in bytes, uncompressed,
+# so a small zip can't fill the staging directory
+IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE = int(get_secret("IMAGE_BULK_UPLOAD_MAX_IMAGE_SIZE", 20 * 1024 * 1024))
+IMAGE_BULK_UPLOAD_MAX_SIZE = int(get_secret("IMAGE_BULK_UPLOAD_MAX_SIZE", 200 * 1024 * 1024))
+
 TWILIO_ACCOUNT_SID = get_secret("TWILIO_ACCOUNT_SID")
 
 TWILIO_AUTH_TOKEN = get_secret("TWILIO_AUTH_TOKEN")
 
 TWILIO_NUMBER = get_secret("TWILIO_NUMBER")
 
+TWILIO_API_HOST = get_secret("TWILIO_API_HOST", "https://api.twilio.com")
+
 
 TEMPLATE_EMAIL_WITH_URL_ID = os.environ.get("TEMPLATE_EMAIL_WITH_URL_ID")
 
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, unicode_literals
 import os
+import sys
 from celery import Celery
 from kombu import Queue, Exchange
 from django.conf import settings
@@ -19,15 +20,23 @@ app.conf.update(
     CELERY_TASK_RESULT_EXPIRES=3600,
     CELERY_IGNORE_RESULT=True,
     CELERY_ACKS_LATE=True,  # Allows executing task to be send to the next worker if current worker crushes.
+    # Keep the database connections between tasks, main.db_connections
+    # closes them like Django does between requests
+    CELERY_DB_REUSE_MAX=sys.maxsize,
     CELERY_QUEUES=(
         Queue("send_email", routing_key="send_email"),
         Queue("fetch_reports", routing_key="fetch_reports"),
+        Queue("images", routing_key="images"),
     ),
     CELERY_ROUTES={
         "main.tasks.send_email_async": {"queue": "send_email"},
+        "main.tasks.send_email_batch": {"queue": "send_email"},
+        "main.tasks.requeue_stale_emails": {"queue": "send_email"},
         "main.tasks.send_sms_async": {"queue": "send_email"},
+        "main.tasks.send_sms_bulk": {"queue": "send_email"},
         "main.tasks.create_store_orders_metrics": {"queue": "fetch_reports"},
-        "main.tasks.create_store_profit_metrics": {"queue": "fetch_reports"}
+        "main.tasks.create_store_profit_metrics": {"queue": "fetch_reports"},
+        "main.tasks.create_image_variants": {"queue": "images"}
     },
 )
 app.conf.broker_transport_options = {"queue_order_strategy": "priority"}
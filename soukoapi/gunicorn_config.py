@@ -0,0 +1,20 @@
+"""
+Gunicorn hooks, used with ``gunicorn --config soukoapi/gunicorn_config.py``.
+"""
+import os
+import shutil
+
+# Each worker writes its metrics there and /metrics/ adds them up
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/souko-metrics")
+
+
+def on_starting(server):
+    # Files of the workers of a previous run
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -10,6 +10,9 @@ ALLOWED_HOSTS = ["*"]
 
 STATICFILES_STORAGE = "whitenoise.storage.CompressedStaticFilesStorage"
 
+# A temporary directory is only seen by the processes of its machine
+IMAGE_STAGING_ROOT = get_secret("IMAGE_STAGING_ROOT")
+
 sentry_sdk.init(
     dsn=os.environ.get("SENTRY_DSN"),
     integrations=[DjangoIntegration()],
@@ -0,0 +1,19 @@
+"""
+Async storefront server, for the anonymous storefront requests (see
+api.storefront):
+
+    gunicorn soukoapi.storefront:application --worker-class aiohttp.GunicornWebWorker
+
+Django 2.2 can't serve ASGI, so it runs on aiohttp and hands Django the
+requests missing from the cache as WSGI.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+from api.storefront import get_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'soukoapi.prod_settings')
+
+application = get_application(get_wsgi_application())
@@ -17,11 +17,16 @@ from django.contrib import admin
 from django.http import JsonResponse
 from django.urls import path, include
 
+from main.metrics import metrics
+from main.views import query_stats
+
 def health(request):
     return JsonResponse({"message": "OK"})
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('health/', health, name="health"),
+    path('metrics/', metrics, name="metrics"),
+    path('query-stats/', query_stats, name="query_stats"),
     path("api/v1/", include("api.urls")),
 ]